@@ -8,10 +8,12 @@ import ptpython.repl
 from test_driver.driver import Driver
 from test_driver.logger import (
     CompositeLogger,
+    JSONLinesLogger,
     JunitXMLLogger,
     TerminalLogger,
     XMLLogger,
 )
+from test_driver.profiler import profiler
 
 
 class EnvDefault(argparse.Action):
@@ -102,6 +104,16 @@ def main() -> None:
         help="Enable JunitXML report generation to the given path",
         type=Path,
     )
+    arg_parser.add_argument(
+        "--json-log",
+        help="Enable a structured log in JSON lines format at the given path",
+        type=Path,
+    )
+    arg_parser.add_argument(
+        "--profile",
+        help="Write a profile of the test in Chrome's trace event format to the given path",
+        type=Path,
+    )
     arg_parser.add_argument(
         "testscript",
         action=EnvDefault,
@@ -121,6 +133,12 @@ def main() -> None:
     if args.junit_xml:
         logger.add_logger(JunitXMLLogger(output_directory / args.junit_xml))
 
+    if args.json_log:
+        logger.add_logger(JSONLinesLogger(output_directory / args.json_log))
+
+    if args.profile:
+        profiler.enable()
+
     if not args.keep_vm_state:
         logger.info("Machine state will be reset. To keep it, pass --keep-vm-state")
 
@@ -143,7 +161,14 @@ def main() -> None:
             )
         else:
             tic = time.time()
-            driver.run_tests()
+            try:
+                driver.run_tests()
+            finally:
+                if args.profile:
+                    profiler.write_trace(output_directory / args.profile)
+                    with logger.nested("profile summary"):
+                        for line in profiler.summary():
+                            logger.info(line)
             toc = time.time()
             logger.info(f"test script finished in {(toc - tic):.2f}s")
 
@@ -0,0 +1,117 @@
+import bisect
+import re
+import re._parser  # type: ignore[import-not-found]
+import threading
+import time
+from collections import deque
+from itertools import islice
+
+# Amount of console output kept for `wait_for_console_text`, older lines are
+# dropped once more than this has accumulated
+CONSOLE_BUFFER_SIZE = 1024 * 1024
+
+# How far before newly arrived output a match of a pattern without a maximum
+# length (e.g. `.*`) may start. Patterns with a maximum length only look back
+# as far as their longest match could reach.
+CONSOLE_MATCH_LOOKBACK = 64 * 1024
+
+
+def match_lookback(pattern: re.Pattern[str]) -> int:
+    """How far before newly arrived output a match of `pattern` may start,
+    i.e. the length of its longest possible match, capped at
+    `CONSOLE_MATCH_LOOKBACK`.
+    """
+    try:
+        _, longest = re._parser.parse(pattern.pattern, pattern.flags).getwidth()
+    except Exception:
+        # The parser is internal to `re`, so be prepared for it to change
+        return CONSOLE_MATCH_LOOKBACK
+    return min(int(longest), CONSOLE_MATCH_LOOKBACK)
+
+
+class ConsoleBuffer:
+    """A bounded buffer of the lines a machine wrote to its serial console.
+
+    Positions in the output ("cursors") are absolute character offsets that
+    stay valid while older output is dropped, so callers can remember where
+    they left off and only look at what arrived since.
+
+    Lines are kept as they arrive, together with the cursor they start at,
+    so appending a line takes constant time and only the part of the output
+    a search needs is ever joined.
+    """
+
+    def __init__(self, size: int = CONSOLE_BUFFER_SIZE) -> None:
+        self.size = size
+        self.lines: deque[str] = deque()
+        # The cursor each line in `lines` starts at
+        self.starts: deque[int] = deque()
+        # The cursor pointing behind the last line
+        self.total = 0
+        self.condition = threading.Condition()
+
+    @property
+    def end(self) -> int:
+        """The cursor pointing behind all output received so far"""
+        with self.condition:
+            return self.total
+
+    def append(self, line: str) -> None:
+        with self.condition:
+            self.lines.append(line + "\n")
+            self.starts.append(self.total)
+            self.total += len(line) + 1
+            while len(self.lines) > 1 and self.total - self.starts[1] >= self.size:
+                self.lines.popleft()
+                self.starts.popleft()
+            self.condition.notify_all()
+
+    def window(self, start: int) -> tuple[int, str]:
+        """The output from the line containing the cursor `start` on, as far
+        as it is still kept, together with the cursor it starts at.
+        Must be called with `condition` held.
+        """
+        if not self.lines:
+            return (self.total, "")
+        index = max(bisect.bisect_right(self.starts, start) - 1, 0)
+        # Windows are mostly close to the end
+        lines = list(islice(reversed(self.lines), len(self.lines) - index))
+        return (self.starts[index], "".join(reversed(lines)))
+
+    def text(self, start: int = 0) -> str:
+        """The output from the cursor `start` on, as far as it is still kept"""
+        with self.condition:
+            begin, data = self.window(start)
+            return data[max(start - begin, 0) :]
+
+    def search(
+        self, regex: str, start: int, timeout: float | None = None
+    ) -> int | None:
+        """Wait until `regex` matches the output from the cursor `start` on.
+        Returns the cursor behind the match, or None if there was none within
+        `timeout` seconds.
+
+        Output is searched once as it arrives: later searches only look at
+        the new output and as much before it as a match of `regex` can be
+        long. For patterns without a maximum length that is
+        `CONSOLE_MATCH_LOOKBACK` characters, so their matches are only found
+        if they start at most that far before the line that completes them.
+        """
+        pattern = re.compile(regex, re.MULTILINE)
+        lookback = match_lookback(pattern)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        searched = start
+
+        with self.condition:
+            while True:
+                begin = max(start, searched - lookback)
+                offset, data = self.window(begin)
+                match = pattern.search(data, max(begin - offset, 0))
+                if match is not None:
+                    return offset + match.end()
+                searched = self.total
+
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
@@ -3,7 +3,8 @@ import re
 import signal
 import tempfile
 import threading
-from collections.abc import Callable, Iterator
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import AbstractContextManager, contextmanager
 from pathlib import Path
 from typing import Any
@@ -109,10 +110,14 @@ class Driver:
                 except Exception as e:
                     self.logger.error(f"Error during cleanup of vlan{vlan.nr}: {e}")
 
-    def subtest(self, name: str) -> Iterator[None]:
-        """Group logs under a given test name"""
+    def subtest(self, name: str, restore: str | None = None) -> Iterator[None]:
+        """Group logs under a given test name, optionally restoring all
+        machines to the named snapshot first (see `snapshot_all`)
+        """
         with self.logger.subtest(name):
             try:
+                if restore is not None:
+                    self.restore_all(restore)
                 yield
             except Exception as e:
                 self.logger.error(f'Test "{name}" failed with error: "{e}"')
@@ -120,8 +125,8 @@ class Driver:
 
     def test_symbols(self) -> dict[str, Any]:
         @contextmanager
-        def subtest(name: str) -> Iterator[None]:
-            return self.subtest(name)
+        def subtest(name: str, restore: str | None = None) -> Iterator[None]:
+            return self.subtest(name, restore)
 
         general_symbols = dict(
             start_all=self.start_all,
@@ -180,16 +185,59 @@ class Driver:
     def start_all(self) -> None:
         """Start all machines"""
         with self.logger.nested("start all VMs"):
-            for machine in self.machines:
-                machine.start()
+            self.parallel(lambda machine: machine.start())
 
     def join_all(self) -> None:
         """Wait for all machines to shut down"""
         with self.logger.nested("wait for all VMs to finish"):
-            for machine in self.machines:
-                machine.wait_for_shutdown()
+            self.parallel(lambda machine: machine.wait_for_shutdown())
             self.race_timer.cancel()
 
+    def snapshot_all(self, name: str = Machine.BOOT_SNAPSHOT) -> None:
+        """Snapshot all running machines, see `Machine.snapshot`"""
+        with self.logger.nested(f"snapshot all VMs as '{name}'"):
+            self.parallel(
+                lambda machine: machine.snapshot(name),
+                [machine for machine in self.machines if machine.booted],
+            )
+
+    def restore_all(self, name: str = Machine.BOOT_SNAPSHOT) -> None:
+        """Restore all running machines to a snapshot taken by `snapshot_all`"""
+        with self.logger.nested(f"restore all VMs to '{name}'"):
+            self.parallel(
+                lambda machine: machine.restore_snapshot(name),
+                [machine for machine in self.machines if machine.booted],
+            )
+
+    def parallel(
+        self,
+        action: Callable[[Machine], Any],
+        machines: Iterable[Machine] | None = None,
+    ) -> list[Any]:
+        """Run `action` on all machines (or the given ones) concurrently and
+        return the results in the same order, e.g.
+        `driver.parallel(lambda m: m.wait_for_unit("multi-user.target"))`.
+        Waits for all actions to finish and re-raises the first exception.
+        """
+        machines = list(self.machines if machines is None else machines)
+        if not machines:
+            return []
+
+        with ThreadPoolExecutor(
+            max_workers=len(machines), thread_name_prefix="parallel"
+        ) as executor:
+            futures = [executor.submit(action, machine) for machine in machines]
+
+        errors = []
+        for machine, future in zip(machines, futures):
+            if (error := future.exception()) is not None:
+                machine.log(f"parallel action failed: {error}")
+                errors.append(error)
+        if errors:
+            raise errors[0]
+
+        return [future.result() for future in futures]
+
     def terminate_test(self) -> None:
         # This will be usually running in another thread than
         # the thread actually executing the test script.
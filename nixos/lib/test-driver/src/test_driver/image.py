@@ -0,0 +1,126 @@
+import hashlib
+import struct
+import subprocess
+import zlib
+from pathlib import Path
+
+
+class PPMImage:
+    """An 8-bit RGB image as written by QEMU's `screendump`, kept in memory
+    so that it can be converted and processed without helper processes.
+    """
+
+    width: int
+    height: int
+    data: bytes
+
+    def __init__(self, width: int, height: int, data: bytes) -> None:
+        if len(data) != width * height * 3:
+            raise ValueError(
+                f"expected {width * height * 3} bytes of pixel data, got {len(data)}"
+            )
+        self.width = width
+        self.height = height
+        self.data = data
+
+    @classmethod
+    def from_bytes(cls, raw: bytes) -> "PPMImage":
+        # The header consists of the magic number, width, height and maximum
+        # value separated by whitespace, with `#` starting a comment. A single
+        # whitespace character separates it from the pixel data.
+        fields: list[bytes] = []
+        pos = 0
+        while len(fields) < 4:
+            while raw[pos : pos + 1].isspace():
+                pos += 1
+            if raw[pos : pos + 1] == b"#":
+                pos = raw.index(b"\n", pos)
+                continue
+            end = pos
+            while end < len(raw) and not raw[end : end + 1].isspace():
+                end += 1
+            fields.append(raw[pos:end])
+            pos = end
+        magic, width, height, maxval = fields
+        if magic != b"P6" or maxval != b"255":
+            raise ValueError(f"unsupported image format {magic!r} ({maxval!r})")
+        return cls(int(width), int(height), raw[pos + 1 :])
+
+    @classmethod
+    def from_file(cls, path: str | Path) -> "PPMImage":
+        with open(path, "rb") as f:
+            return cls.from_bytes(f.read())
+
+    def digest(self) -> bytes:
+        return hashlib.blake2b(self.data, digest_size=16).digest()
+
+    def to_ppm(self) -> bytes:
+        return b"P6\n%d %d\n255\n" % (self.width, self.height) + self.data
+
+    def to_png(self) -> bytes:
+        def chunk(kind: bytes, payload: bytes) -> bytes:
+            return (
+                struct.pack(">I", len(payload))
+                + kind
+                + payload
+                + struct.pack(">I", zlib.crc32(kind + payload))
+            )
+
+        stride = self.width * 3
+        # Every scanline is prefixed with its filter type, 0 meaning none
+        scanlines = b"".join(
+            b"\0" + self.data[offset : offset + stride]
+            for offset in range(0, len(self.data), stride)
+        )
+        return (
+            b"\x89PNG\r\n\x1a\n"
+            + chunk(
+                b"IHDR", struct.pack(">IIBBBBB", self.width, self.height, 8, 2, 0, 0, 0)
+            )
+            + chunk(b"IDAT", zlib.compress(scanlines))
+            + chunk(b"IEND", b"")
+        )
+
+
+def preprocess_for_ocr(image: PPMImage, negate: bool = False) -> bytes:
+    """Turn a screenshot into an upscaled, high contrast grayscale image that
+    OCR engines cope with better, returned as PNG.
+
+    The image is piped through ImageMagick rather than written to files.
+    """
+    magick_args = [
+        "-filter",
+        "Catrom",
+        "-density",
+        "72",
+        "-resample",
+        "300",
+        "-contrast",
+        "-normalize",
+        "-despeckle",
+        "-type",
+        "grayscale",
+        "-sharpen",
+        "1",
+        "-posterize",
+        "3",
+    ]
+    if negate:
+        magick_args.append("-negate")
+    magick_args += [
+        "-gamma",
+        "100",
+        "-blur",
+        "1x65535",
+    ]
+
+    ret = subprocess.run(
+        ["magick", "convert", "ppm:-", *magick_args, "png:-"],
+        input=image.to_ppm(),
+        capture_output=True,
+    )
+    if ret.returncode != 0:
+        raise Exception(
+            f"Image processing failed with exit code {ret.returncode}, stderr: {ret.stderr.decode()}"
+        )
+    return ret.stdout
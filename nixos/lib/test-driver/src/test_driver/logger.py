@@ -1,14 +1,18 @@
 import atexit
 import codecs
+import functools
+import json
 import os
+import re
 import sys
+import threading
 import time
 import unicodedata
 from abc import ABC, abstractmethod
 from collections.abc import Iterator
 from contextlib import ExitStack, contextmanager
 from pathlib import Path
-from queue import Empty, Queue
+from queue import Empty, Queue, SimpleQueue
 from typing import Any
 from xml.sax.saxutils import XMLGenerator
 from xml.sax.xmlreader import AttributesImpl
@@ -16,6 +20,37 @@ from xml.sax.xmlreader import AttributesImpl
 from colorama import Fore, Style
 from junit_xml import TestCase, TestSuite
 
+# Control characters within ASCII, which serial consoles mostly consist of
+_ASCII_CONTROL_CHARACTERS = re.compile(r"[\x00-\x1f\x7f]+")
+
+
+@functools.cache
+def _control_character_table() -> dict[int, None]:
+    """A translation table deleting all characters of the Basic Multilingual
+    Plane in the Unicode "Other" categories (control, format, surrogate,
+    private use and unassigned).
+    """
+    return {
+        code: None
+        for code in range(0x10000)
+        if unicodedata.category(chr(code))[0] == "C"
+    }
+
+
+def sanitise(message: str) -> str:
+    """Remove control and other non-printable characters from a message"""
+    # Printable strings can't contain such characters, this is by far the
+    # most common case and cheap to check
+    if message.isprintable():
+        return message
+    if message.isascii():
+        return _ASCII_CONTROL_CHARACTERS.sub("", message)
+    message = message.translate(_control_character_table())
+    # Characters beyond the BMP are rare enough to be checked one by one
+    if max(message, default="") > "\uffff":
+        return "".join(ch for ch in message if unicodedata.category(ch)[0] != "C")
+    return message
+
 
 class AbstractLogger(ABC):
     @abstractmethod
@@ -228,6 +263,12 @@ class XMLLogger(AbstractLogger):
         self.logfile_handle = codecs.open(outfile, "wb")
         self.xml = XMLGenerator(self.logfile_handle, encoding="utf-8")
         self.queue: Queue[dict[str, str]] = Queue()
+        # Machines may log from several threads, e.g. in `Driver.parallel`
+        self.lock = threading.RLock()
+        # Nested blocks of threads other than the main one are recorded as a
+        # list of XML events, and only written once they end, so blocks of
+        # concurrent threads don't interleave
+        self.local = threading.local()
 
         self._print_serial_logs = True
 
@@ -240,17 +281,30 @@ class XMLLogger(AbstractLogger):
         self.logfile_handle.close()
 
     def sanitise(self, message: str) -> str:
-        return "".join(ch for ch in message if unicodedata.category(ch)[0] != "C")
+        return sanitise(message)
 
     def maybe_prefix(self, message: str, attributes: dict[str, str]) -> str:
         if "machine" in attributes:
             return f"{attributes['machine']}: {message}"
         return message
 
+    def emit(self, *events: tuple[str, Any]) -> None:
+        """Write XML events, as `(method of XMLGenerator, argument)`, or
+        record them while this thread is inside a recorded nested block"""
+        recorded = getattr(self.local, "events", None)
+        if recorded is not None:
+            recorded.extend(events)
+            return
+        with self.lock:
+            for method, arg in events:
+                getattr(self.xml, method)(*arg)
+
     def log_line(self, message: str, attributes: dict[str, str]) -> None:
-        self.xml.startElement("line", attrs=AttributesImpl(attributes))
-        self.xml.characters(message)
-        self.xml.endElement("line")
+        self.emit(
+            ("startElement", ("line", AttributesImpl(attributes))),
+            ("characters", (message,)),
+            ("endElement", ("line",)),
+        )
 
     def info(self, *args, **kwargs) -> None:  # type: ignore
         self.log(*args, **kwargs)
@@ -262,8 +316,9 @@ class XMLLogger(AbstractLogger):
         self.log(*args, **kwargs)
 
     def log(self, message: str, attributes: dict[str, str] = {}) -> None:
-        self.drain_log_queue()
-        self.log_line(message, attributes)
+        with self.lock:
+            self.drain_log_queue()
+            self.log_line(message, attributes)
 
     def print_serial_logs(self, enable: bool) -> None:
         self._print_serial_logs = enable
@@ -278,6 +333,9 @@ class XMLLogger(AbstractLogger):
         self.queue.put(item)
 
     def drain_log_queue(self) -> None:
+        # Serial output goes into the main document, not recorded blocks
+        if getattr(self.local, "events", None) is not None:
+            return
         try:
             while True:
                 item = self.queue.get_nowait()
@@ -294,16 +352,126 @@ class XMLLogger(AbstractLogger):
 
     @contextmanager
     def nested(self, message: str, attributes: dict[str, str] = {}) -> Iterator[None]:
-        self.xml.startElement("nest", attrs=AttributesImpl({}))
-        self.xml.startElement("head", attrs=AttributesImpl(attributes))
-        self.xml.characters(message)
-        self.xml.endElement("head")
+        record = (
+            threading.current_thread() is not threading.main_thread()
+            and getattr(self.local, "events", None) is None
+        )
+        if record:
+            self.local.events = []
+        self.drain_log_queue()
 
         tic = time.time()
-        self.drain_log_queue()
-        yield
-        self.drain_log_queue()
-        toc = time.time()
-        self.log(f"(finished: {message}, in {toc - tic:.2f} seconds)")
+        try:
+            self.emit(
+                ("startElement", ("nest", AttributesImpl({}))),
+                ("startElement", ("head", AttributesImpl(attributes))),
+                ("characters", (message,)),
+                ("endElement", ("head",)),
+            )
+            yield
+        finally:
+            toc = time.time()
+            self.drain_log_queue()
+            self.log_line(f"(finished: {message}, in {toc - tic:.2f} seconds)", {})
+            self.emit(("endElement", ("nest",)))
+            if record:
+                events, self.local.events = self.local.events, None
+                with self.lock:
+                    self.drain_log_queue()
+                    self.emit(*events)
+
+
+class JSONLinesLogger(AbstractLogger):
+    """Writes a structured log with one JSON object per line. The objects
+    are serialised and written by a dedicated thread, so logging (serial
+    output in particular) costs the test script no more than a queue
+    insertion. Nested blocks and subtests are recorded with their duration.
+    """
+
+    _CLOSE = object()
+
+    def __init__(self, outfile: Path) -> None:
+        self.outfile = outfile
+        self.queue: SimpleQueue[Any] = SimpleQueue()
+        self._print_serial_logs = True
+        self.closed = False
+        self.writer = threading.Thread(
+            target=self._write_records, name="json-logger", daemon=True
+        )
+        self.writer.start()
+        atexit.register(self.close)
 
-        self.xml.endElement("nest")
+    def _write_records(self) -> None:
+        with open(self.outfile, "w") as f:
+            while (record := self.queue.get()) is not self._CLOSE:
+                record["message"] = sanitise(record["message"])
+                f.write(json.dumps(record) + "\n")
+                # Don't lag behind when the test is idle, but write in large
+                # chunks while there is a lot to log
+                if self.queue.empty():
+                    f.flush()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(self._CLOSE)
+        self.writer.join()
+
+    def _record(self, kind: str, message: str, attributes: dict[str, str]) -> None:
+        self.queue.put(
+            {"time": time.time(), "type": kind, "message": message, **attributes}
+        )
+
+    def log(self, message: str, attributes: dict[str, str] = {}) -> None:
+        self._record("log", message, attributes)
+
+    @contextmanager
+    def subtest(self, name: str, attributes: dict[str, str] = {}) -> Iterator[None]:
+        with self._timed("subtest", name, attributes):
+            yield
+
+    @contextmanager
+    def nested(self, message: str, attributes: dict[str, str] = {}) -> Iterator[None]:
+        with self._timed("nested", message, attributes):
+            yield
+
+    @contextmanager
+    def _timed(
+        self, kind: str, message: str, attributes: dict[str, str]
+    ) -> Iterator[None]:
+        self._record(f"{kind}_start", message, attributes)
+        tic = time.monotonic()
+        status = "failed"
+        try:
+            yield
+            status = "succeeded"
+        finally:
+            self.queue.put(
+                {
+                    "time": time.time(),
+                    "type": f"{kind}_end",
+                    "message": message,
+                    "duration": time.monotonic() - tic,
+                    "status": status,
+                    **attributes,
+                }
+            )
+
+    def info(self, *args, **kwargs) -> None:  # type: ignore
+        self._record("info", args[0], kwargs.get("attributes", {}))
+
+    def warning(self, *args, **kwargs) -> None:  # type: ignore
+        self._record("warning", args[0], kwargs.get("attributes", {}))
+
+    def error(self, *args, **kwargs) -> None:  # type: ignore
+        self._record("error", args[0], kwargs.get("attributes", {}))
+
+    def log_serial(self, message: str, machine: str) -> None:
+        if not self._print_serial_logs:
+            return
+
+        self._record("serial", message, {"machine": machine})
+
+    def print_serial_logs(self, enable: bool) -> None:
+        self._print_serial_logs = enable
@@ -1,7 +1,9 @@
 import base64
-import io
+import hashlib
+import itertools
+import json
+import math
 import os
-import queue
 import re
 import select
 import shlex
@@ -9,18 +11,22 @@ import shutil
 import socket
 import subprocess
 import sys
+import tarfile
 import tempfile
 import threading
 import time
-from collections.abc import Callable, Iterable
-from contextlib import _GeneratorContextManager, nullcontext
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager, nullcontext
 from pathlib import Path
-from queue import Queue
 from typing import Any
 
+from test_driver.console import ConsoleBuffer
+from test_driver.image import PPMImage, preprocess_for_ocr
 from test_driver.logger import AbstractLogger
+from test_driver.profiler import profiler
 
-from .qmp import QMPSession
+from .qmp import QMP_COMMAND_TIMEOUT, QMPSession
 
 CHAR_TO_KEY = {
     "A": "shift-a",
@@ -90,67 +96,52 @@ def make_command(args: list) -> str:
     return " ".join(map(shlex.quote, (map(str, args))))
 
 
-def _preprocess_screenshot(screenshot_path: str, negate: bool = False) -> str:
-    magick_args = [
-        "-filter",
-        "Catrom",
-        "-density",
-        "72",
-        "-resample",
-        "300",
-        "-contrast",
-        "-normalize",
-        "-despeckle",
-        "-type",
-        "grayscale",
-        "-sharpen",
-        "1",
-        "-posterize",
-        "3",
-    ]
-    out_file = screenshot_path
-
-    if negate:
-        magick_args.append("-negate")
-        out_file += ".negative"
-
-    magick_args += [
-        "-gamma",
-        "100",
-        "-blur",
-        "1x65535",
+def _key_events(key: str) -> list[dict[str, Any]] | None:
+    """Translate a `sendkey` style key combination, e.g. `shift-0x0C`, into
+    the QMP input events that press its keys in order and release them in
+    reverse order. Returns None if the combination cannot be translated.
+    """
+    keys: list[dict[str, Any]] = []
+    for name in key.split("-"):
+        if re.fullmatch(r"0x[0-9a-fA-F]+", name):
+            keys.append({"type": "number", "data": int(name, 16)})
+        elif re.fullmatch(r"[a-z0-9_]+", name):
+            keys.append({"type": "qcode", "data": name})
+        else:
+            return None
+    return [{"type": "key", "data": {"down": True, "key": k}} for k in keys] + [
+        {"type": "key", "data": {"down": False, "key": k}} for k in reversed(keys)
     ]
-    out_file += ".png"
-
-    ret = subprocess.run(
-        ["magick", "convert"] + magick_args + [screenshot_path, out_file],
-        capture_output=True,
-    )
-
-    if ret.returncode != 0:
-        raise Exception(
-            f"Image processing failed with exit code {ret.returncode}, stdout: {ret.stdout.decode()}, stderr: {ret.stderr.decode()}"
-        )
-
-    return out_file
 
 
 def _perform_ocr_on_screenshot(
-    screenshot_path: str, model_ids: Iterable[int]
+    screenshot: PPMImage,
+    model_ids: Iterable[int],
+    until: Callable[[str], bool] | None = None,
 ) -> list[str]:
+    """Run tesseract with every model on the screenshot as well as on its
+    preprocessed and negated variants, all concurrently. If `until` is given,
+    stop as soon as it accepts one of the results and return only the results
+    finished by then. Tesseract processes still running when returning or
+    raising are killed.
+    """
     if shutil.which("tesseract") is None:
         raise Exception("OCR requested but enableOCR is false")
 
-    processed_image = _preprocess_screenshot(screenshot_path, negate=False)
-    processed_negative = _preprocess_screenshot(screenshot_path, negate=True)
-
-    model_results = []
-    for image in [screenshot_path, processed_image, processed_negative]:
-        for model_id in model_ids:
-            ret = subprocess.run(
+    model_ids = list(model_ids)
+    stopped = False
+    processes: list[subprocess.Popen] = []
+    lock = threading.Lock()
+
+    def ocr(image: Future[bytes], model_id: int) -> str:
+        data = image.result()
+        with lock:
+            if stopped:
+                return ""
+            process = subprocess.Popen(
                 [
                     "tesseract",
-                    image,
+                    "stdin",
                     "-",
                     "--oem",
                     str(model_id),
@@ -159,24 +150,105 @@ def _perform_ocr_on_screenshot(
                     "--psm",
                     "11",
                 ],
-                capture_output=True,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
             )
-            if ret.returncode != 0:
-                raise Exception(f"OCR failed with exit code {ret.returncode}")
-            model_results.append(ret.stdout.decode("utf-8"))
+            processes.append(process)
+        stdout, _ = process.communicate(data)
+        if process.returncode != 0 and not stopped:
+            raise Exception(f"OCR failed with exit code {process.returncode}")
+        return stdout.decode("utf-8")
+
+    original: Future[bytes] = Future()
+    original.set_result(screenshot.to_ppm())
+
+    # One worker per tesseract run plus the two preprocessing steps, which
+    # makes sure that waiting for the latter cannot starve the pool.
+    executor = ThreadPoolExecutor(
+        max_workers=3 * len(model_ids) + 2, thread_name_prefix="ocr"
+    )
+    try:
+        images = [
+            original,
+            executor.submit(preprocess_for_ocr, screenshot, negate=False),
+            executor.submit(preprocess_for_ocr, screenshot, negate=True),
+        ]
+        jobs = [
+            executor.submit(ocr, image, model_id)
+            for image in images
+            for model_id in model_ids
+        ]
+
+        if until is None:
+            return [job.result() for job in jobs]
 
-    return model_results
+        finished = []
+        for job in as_completed(jobs):
+            text = job.result()
+            finished.append(text)
+            if until(text):
+                break
+        return finished
+    finally:
+        # Whether we stop early or a run or `until` failed, do not leave
+        # tesseract processes behind, and keep workers from starting more
+        with lock:
+            stopped = True
+            outstanding = list(processes)
+        for process in outstanding:
+            process.kill()
+            process.wait()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+# Bounds of the exponential backoff between two calls in `retry`
+RETRY_MIN_INTERVAL = 0.05
+RETRY_MAX_INTERVAL = 1.0
+
+# Bounds of the time a single command spends polling a condition inside
+# the guest, see `Machine.wait_for_guest_condition`
+GUEST_POLL_MIN_SLICE = 1.0
+GUEST_POLL_MAX_SLICE = 8.0
+# Bounds of the exponential backoff between two evaluations of the condition
+# inside the guest
+GUEST_POLL_MIN_INTERVAL = 0.1
+GUEST_POLL_MAX_INTERVAL = 1.0
+
+# Size of the pieces `Machine.copy_from_host_via_shell` sends with a single
+# command. The guest shell holds the encoded piece in memory, several times
+# over, so this bounds the memory the copy takes in the guest.
+SHELL_COPY_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Seconds after which a thread waiting for output of the guest shell notices
+# that a snapshot restore reset the shell state
+SHELL_RESET_CHECK_INTERVAL = 1.0
+
+# Ends the input sent to a command as a here-document, it cannot occur in
+# base64 encoded data
+SHELL_INPUT_DELIMITER = "__NIXOS_TEST_INPUT_END__"
+
+# Number of key events `Machine.send_chars` sends with a single QMP command,
+# small enough for the event queues of QEMU's keyboards to absorb the burst.
+# Every character takes at least two events, pressing and releasing its key.
+KEY_BATCH_EVENTS = 16
 
 
 def retry(fn: Callable, timeout: int = 900) -> None:
-    """Call the given function repeatedly, with 1 second intervals,
-    until it returns True or a timeout is reached.
+    """Call the given function repeatedly until it returns True or a timeout
+    is reached. The intervals between calls start at 50 milliseconds and back
+    off exponentially up to 1 second, so conditions that hold early are
+    noticed early without long waits costing more calls than necessary.
     """
+    deadline = time.monotonic() + timeout
+    interval = RETRY_MIN_INTERVAL
 
-    for _ in range(timeout):
-        if fn(False):
-            return
-        time.sleep(1)
+    while time.monotonic() < deadline:
+        with profiler.span("retry", "retry"):
+            if fn(False):
+                return
+        time.sleep(max(0.0, min(interval, deadline - time.monotonic())))
+        interval = min(interval * 2, RETRY_MAX_INTERVAL)
 
     if not fn(True):
         raise Exception(f"action timed out after {timeout} seconds")
@@ -197,6 +269,7 @@ class StartCommand:
         qmp_socket_path: Path,
         shell_socket_path: Path,
         allow_reboot: bool = False,
+        loadvm: str | None = None,
     ) -> str:
         display_opts = ""
         display_available = any(x in os.environ for x in ["DISPLAY", "WAYLAND_DISPLAY"])
@@ -213,6 +286,8 @@ class StartCommand:
         )
         if not allow_reboot:
             qemu_opts += " -no-reboot"
+        if loadvm is not None:
+            qemu_opts += f" -loadvm {shlex.quote(loadvm)}"
 
         return (
             f"{self._cmd}"
@@ -239,6 +314,13 @@ class StartCommand:
         )
         return env
 
+    @property
+    def cache_key(self) -> str:
+        """Identifies the machine configuration, as the start script is a
+        store path that changes with it.
+        """
+        return hashlib.sha256(self._cmd.encode()).hexdigest()
+
     def run(
         self,
         state_dir: Path,
@@ -247,10 +329,15 @@ class StartCommand:
         qmp_socket_path: Path,
         shell_socket_path: Path,
         allow_reboot: bool,
+        loadvm: str | None = None,
     ) -> subprocess.Popen:
         return subprocess.Popen(
             self.cmd(
-                monitor_socket_path, qmp_socket_path, shell_socket_path, allow_reboot
+                monitor_socket_path,
+                qmp_socket_path,
+                shell_socket_path,
+                allow_reboot,
+                loadvm,
             ),
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
@@ -292,6 +379,7 @@ class Machine:
     monitor_path: Path
     qmp_path: Path
     shell_path: Path
+    snapshots_path: Path
 
     start_command: StartCommand
     keep_vm_state: bool
@@ -301,15 +389,40 @@ class Machine:
     monitor: socket.socket | None
     qmp_client: QMPSession | None
     shell: socket.socket | None
+    shell_buffer: bytes
     serial_thread: threading.Thread | None
 
     booted: bool
     connected: bool
-    # Store last serial console lines for use
-    # of wait_for_console_text
-    last_lines: Queue = Queue()
+    # Whether the guest shell understands the framed output protocol and
+    # can run several commands at once, determined when connecting to the
+    # backdoor shell
+    framed_shell: bool
+    concurrent_shell: bool
+    # Frames that were read from the shell by one thread on behalf of another
+    frame_ids: Iterator[int]
+    frames: dict[int, tuple[int, bytes]]
+    frame_condition: threading.Condition
+    frame_reader_busy: bool
+    # Counts resets of the shell state (see `_reset_shell_state`), commands
+    # sent before a reset never get their frame
+    shell_generation: int
+    frame_reader_generation: int
+    shell_send_lock: threading.Lock
+    async_executor: ThreadPoolExecutor | None
+    # Last OCR results per set of models, with the digest of the screen
+    ocr_cache: dict[tuple[int, ...], tuple[bytes, list[str]]]
+    # Whether the machine has a USB keyboard, see `send_chars`
+    usb_keyboard: bool | None
+    # Serial console output for wait_for_console_text, which only looks at
+    # the output from `console_cursor` on
+    console: ConsoleBuffer
+    console_cursor: int
     callbacks: list[Callable]
 
+    # Name of the snapshot that is also used to skip booting on reruns
+    BOOT_SNAPSHOT = "booted"
+
     def __repr__(self) -> str:
         return f"<Machine '{self.name}'>"
 
@@ -339,6 +452,7 @@ class Machine:
         self.monitor_path = self.state_dir / "monitor"
         self.qmp_path = self.state_dir / "qmp"
         self.shell_path = self.state_dir / "shell"
+        self.snapshots_path = self.state_dir / "snapshots.json"
         if (not self.keep_vm_state) and self.state_dir.exists():
             self.cleanup_statedir()
         self.state_dir.mkdir(mode=0o700, exist_ok=True)
@@ -348,10 +462,25 @@ class Machine:
         self.monitor = None
         self.qmp_client = None
         self.shell = None
+        self.shell_buffer = b""
         self.serial_thread = None
 
         self.booted = False
         self.connected = False
+        self.framed_shell = False
+        self.concurrent_shell = False
+        self.frame_ids = itertools.count()
+        self.frames = {}
+        self.frame_condition = threading.Condition()
+        self.frame_reader_busy = False
+        self.shell_generation = 0
+        self.frame_reader_generation = 0
+        self.shell_send_lock = threading.Lock()
+        self.async_executor = None
+        self.ocr_cache = {}
+        self.usb_keyboard = None
+        self.console = ConsoleBuffer()
+        self.console_cursor = 0
 
     def is_up(self) -> bool:
         return self.booted and self.connected
@@ -362,10 +491,13 @@ class Machine:
     def log_serial(self, msg: str) -> None:
         self.logger.log_serial(msg, self.name)
 
-    def nested(self, msg: str, attrs: dict[str, str] = {}) -> _GeneratorContextManager:
+    @contextmanager
+    def nested(self, msg: str, attrs: dict[str, str] = {}) -> Iterator[None]:
         my_attrs = {"machine": self.name}
         my_attrs.update(attrs)
-        return self.logger.nested(msg, my_attrs)
+        category = "wait" if msg.startswith("waiting for") else "action"
+        with self.logger.nested(msg, my_attrs), profiler.span(msg, category, self.name):
+            yield
 
     def wait_for_monitor_prompt(self) -> str:
         assert self.monitor is not None
@@ -387,8 +519,9 @@ class Machine:
         self.run_callbacks()
         message = f"{command}\n".encode()
         assert self.monitor is not None
-        self.monitor.send(message)
-        return self.wait_for_monitor_prompt()
+        with profiler.span(command, "monitor", self.name):
+            self.monitor.send(message)
+            return self.wait_for_monitor_prompt()
 
     def wait_for_unit(
         self, unit: str, user: str | None = None, timeout: int = 900
@@ -523,12 +656,163 @@ class Machine:
                 break
         return "".join(output_buffer)
 
+    def _recv_from_shell(self) -> None:
+        shell = self.shell
+        assert shell
+        # A thread reading frames wakes up now and then to notice whether the
+        # shell state was reset, since the frame it waits for won't come then
+        while not select.select([shell], [], [], SHELL_RESET_CHECK_INTERVAL)[0]:
+            if (
+                self.frame_reader_busy
+                and self.frame_reader_generation != self.shell_generation
+            ):
+                raise Exception("shell state reset by snapshot restore")
+        chunk = shell.recv(65536)
+        if not chunk:
+            raise ConnectionError(f"lost connection to the guest shell of {self.name}")
+        self.shell_buffer += chunk
+
+    def _read_line_from_shell(self) -> bytes:
+        while (end := self.shell_buffer.find(b"\n")) == -1:
+            self._recv_from_shell()
+        line, self.shell_buffer = (
+            self.shell_buffer[:end],
+            self.shell_buffer[end + 1 :],
+        )
+        return line
+
+    def _read_exactly_from_shell(self, size: int) -> bytes:
+        while len(self.shell_buffer) < size:
+            self._recv_from_shell()
+        data, self.shell_buffer = (
+            self.shell_buffer[:size],
+            self.shell_buffer[size:],
+        )
+        return data
+
+    def _read_frame_from_shell(self) -> tuple[int, int, bytes]:
+        """Read one frame written by `__nixos_test_frame` (see
+        `_setup_framed_shell`): an `<id> <status> <length>` header line
+        followed by the raw output of the command.
+
+        If the connection is lost in the middle of the output, e.g. because
+        the command shut the machine down, the frame is returned with the
+        output received so far and status -1.
+        """
+        header = self._read_line_from_shell().decode()
+        try:
+            frame_id, status, length = map(int, header.split())
+        except ValueError:
+            raise Exception(f"malformed frame header from guest shell: {header!r}")
+        try:
+            return frame_id, status, self._read_exactly_from_shell(length)
+        except ConnectionError:
+            output, self.shell_buffer = self.shell_buffer, b""
+            return frame_id, -1, output
+
+    def _wait_for_frame(self, frame_id: int, generation: int) -> tuple[int, bytes]:
+        """Wait for the frame with the given id, of a command sent while the
+        shell state had the given generation. Whichever waiting thread gets
+        to the socket first reads frames and hands those that belong to
+        other commands over to their waiters.
+        """
+        with self.frame_condition:
+            while frame_id not in self.frames:
+                if generation != self.shell_generation:
+                    raise Exception("shell state reset by snapshot restore")
+                if self.frame_reader_busy:
+                    self.frame_condition.wait()
+                    continue
+
+                self.frame_reader_busy = True
+                self.frame_reader_generation = generation
+                self.frame_condition.release()
+                try:
+                    other_id, status, output = self._read_frame_from_shell()
+                finally:
+                    self.frame_condition.acquire()
+                    self.frame_reader_busy = False
+                    self.frame_condition.notify_all()
+                self.frames[other_id] = (status, output)
+            return self.frames.pop(frame_id)
+
+    def _send_to_shell(
+        self, command: str, input_lines: Iterable[bytes] | None = None
+    ) -> None:
+        """Send a command line to the guest shell, followed by the body of
+        its here-document if `input_lines` are given (see `_bash_command`).
+        """
+        assert self.shell
+        with self.shell_send_lock:
+            self.shell.sendall(f"{command}\n".encode())
+            if input_lines is not None:
+                for line in input_lines:
+                    self.shell.sendall(line)
+                self.shell.sendall(f"{SHELL_INPUT_DELIMITER}\n".encode())
+
+    def _bash_command(
+        self, command: str, timeout: float | None, with_input: bool = False
+    ) -> str:
+        # Always run command with shell opts
+        command = f"set -euo pipefail; {command}"
+
+        timeout_str = ""
+        if timeout is not None:
+            timeout_str = f"timeout {timeout}"
+
+        # While sh is bash on NixOS, this is not the case for every distro.
+        # We explicitly call bash here to allow for the driver to boot other distros as well.
+        bash_command = f"{timeout_str} bash -c {shlex.quote(command)}"
+        if with_input:
+            # The guest shell reads the here-document itself, so the input
+            # is not limited by the maximum length of an argument
+            bash_command += f" <<'{SHELL_INPUT_DELIMITER}'"
+        return bash_command
+
+    def _setup_framed_shell(self) -> None:
+        """Define the helper function of the framed protocol in the guest
+        shell and check that the guest has the tools it needs. Guests lacking
+        them (e.g. some non-NixOS distros) keep using base64 encoded output.
+
+        Commands running in the background write their frames under a
+        `flock`, so that several of them can share the shell concurrently.
+
+        A frame is written even if the output cannot be captured, e.g. when
+        `/tmp` is full, with status 255 and no output, so that nobody waits
+        for a frame that never comes.
+        """
+        assert self.shell
+        self.shell.send(
+            b"__nixos_test_frame() { "
+            b"local id=$1 f= rc=255 n=0 lock=/tmp/.nixos-test-frame.lock; shift; "
+            b'if f=$(mktemp); then "$@" > "$f"; rc=$?; '
+            b'n=$(wc -c < "$f") || { rc=255; n=0; }; fi; '
+            b'{ : >> "$lock"; } 2> /dev/null || lock=/dev/null; '
+            b"{ flock 9 2> /dev/null; "
+            b'printf \'%s %s %s\\n\' "$id" "$rc" "$n"; '
+            b'[ "$n" -eq 0 ] || head -c "$n" "$f"; '
+            b'} 9>> "$lock"; '
+            b'[ -z "$f" ] || rm -f "$f"; }; '
+            b"if command -v mktemp wc head > /dev/null 2>&1; then "
+            b"command -v flock > /dev/null 2>&1 && echo framed concurrent || echo framed; "
+            b"else echo base64; fi\n"
+        )
+        capabilities = self._read_line_from_shell().split()
+        self.framed_shell = b"framed" in capabilities
+        self.concurrent_shell = b"concurrent" in capabilities
+        if not self.framed_shell:
+            self.log(
+                "guest shell lacks mktemp, wc or head, falling back to base64 output"
+            )
+        elif not self.concurrent_shell:
+            self.log("guest shell lacks flock, commands will run one at a time")
+
     def execute(
         self,
         command: str,
         check_return: bool = True,
         check_output: bool = True,
-        timeout: int | None = 900,
+        timeout: float | None = 900,
     ) -> tuple[int, str]:
         """
         Execute a shell command, returning a list `(status, stdout)`.
@@ -543,14 +827,17 @@ class Machine:
 
         -   Dereferencing unset variables fails the command.
 
-        -   It will wait for stdout to be closed.
+        -   It will wait for the command to exit, and returns the output
+            written to stdout until then.
+
+        Output of processes the command leaves running, e.g. `sleep 365d &`
+        or `xclip -i`, which forks without closing stdout, is discarded once
+        the command has exited. Redirect their stdout to stderr `>&2`, to
+        `/dev/console` or to a file if it is of interest.
 
-        If the command detaches, it must close stdout, as `execute` will wait
-        for this to consume all output reliably. This can be achieved by
-        redirecting stdout to stderr `>&2`, to `/dev/console`, `/dev/null` or
-        a file. Examples of detaching commands are `sleep 365d &`, where the
-        shell forks a new process that can write to stdout and `xclip -i`, where
-        the `xclip` command itself forks without closing stdout.
+        On guests lacking `mktemp`, `wc` or `head`, `execute` instead waits
+        for stdout to be closed, so such commands must close it there, e.g. by
+        redirecting it to `/dev/null`.
 
         Takes an optional parameter `check_return` that defaults to `True`.
         Setting this parameter to `False` will not check for the return code
@@ -562,39 +849,113 @@ class Machine:
         `timeout` parameter, e.g., `execute(cmd, timeout=10)` or
         `execute(cmd, timeout=None)`. The default is 900 seconds.
         """
+        return self._execute(command, check_return, check_output, timeout)
+
+    def _execute(
+        self,
+        command: str,
+        check_return: bool = True,
+        check_output: bool = True,
+        timeout: float | None = 900,
+        input_lines: Iterable[bytes] | None = None,
+    ) -> tuple[int, str]:
+        """Implements `execute`, additionally feeding `input_lines` to the
+        standard input of the command. The lines must end with a newline and
+        must not contain `SHELL_INPUT_DELIMITER`.
+        """
         self.run_callbacks()
         self.connect()
 
-        # Always run command with shell opts
-        command = f"set -euo pipefail; {command}"
+        with profiler.span(command, "shell", self.name):
+            bash_command = self._bash_command(
+                command, timeout, with_input=input_lines is not None
+            )
 
-        timeout_str = ""
-        if timeout is not None:
-            timeout_str = f"timeout {timeout}"
+            assert self.shell
 
-        # While sh is bash on NixOS, this is not the case for every distro.
-        # We explicitly call bash here to allow for the driver to boot other distros as well.
-        out_command = (
-            f"{timeout_str} bash -c {shlex.quote(command)} | (base64 -w 0; echo)\n"
-        )
+            if not check_output:
+                # Nobody is going to read the output, make sure it does not end up
+                # in front of the reply to the next command.
+                self._send_to_shell(f"{bash_command} > /dev/null", input_lines)
+                return (-2, "")
+
+            if self.framed_shell:
+                # The exit status and the raw output arrive in a single
+                # length-prefixed frame, no base64 and no second round trip.
+                frame_id = next(self.frame_ids)
+                generation = self.shell_generation
+                self._send_to_shell(
+                    f"__nixos_test_frame {frame_id} {bash_command}", input_lines
+                )
+                try:
+                    rc, raw_output = self._wait_for_frame(frame_id, generation)
+                except ConnectionError:
+                    # Commands that shut the machine down never get to send
+                    # their frame
+                    if check_return:
+                        raise
+                    return (-1, "")
+                if not check_return:
+                    return (-1, raw_output.decode(errors="replace"))
+                return (rc, raw_output.decode(errors="replace"))
+
+            self._send_to_shell(f"{bash_command} | (base64 -w 0; echo)", input_lines)
+
+            # Get the output
+            output = base64.b64decode(self._next_newline_closed_block_from_shell())
+
+            if not check_return:
+                return (-1, output.decode())
+
+            # Get the return code
+            self.shell.send(b"echo ${PIPESTATUS[0]}\n")
+            rc = int(self._next_newline_closed_block_from_shell().strip())
+
+            return (rc, output.decode(errors="replace"))
+
+    def execute_async(
+        self, command: str, timeout: int | None = 900
+    ) -> Future[tuple[int, str]]:
+        """
+        Like `execute`, but runs the command in the background of the guest
+        shell and immediately returns a
+        [`Future`](https://docs.python.org/3/library/concurrent.futures.html#future-objects)
+        of `(status, stdout)`. Any number of commands can run concurrently
+        this way, while the test script keeps using the machine, e.g.
 
-        assert self.shell
-        self.shell.send(out_command.encode())
+        ```py
+        load = machine.execute_async("stress-ng --cpu 4 --timeout 60")
+        machine.wait_until_succeeds("journalctl -u foo | grep overloaded")
+        status, _ = load.result()
+        ```
+
+        Background commands read their standard input from `/dev/null`. On
+        guests whose shell cannot multiplex commands, this falls back to
+        running the command synchronously.
+        """
+        self.run_callbacks()
+        self.connect()
 
-        if not check_output:
-            return (-2, "")
+        if not self.concurrent_shell:
+            future: Future[tuple[int, str]] = Future()
+            future.set_result(self.execute(command, timeout=timeout))
+            return future
 
-        # Get the output
-        output = base64.b64decode(self._next_newline_closed_block_from_shell())
+        if self.async_executor is None:
+            self.async_executor = ThreadPoolExecutor(
+                thread_name_prefix=f"{self.name}-shell"
+            )
 
-        if not check_return:
-            return (-1, output.decode())
+        frame_id = next(self.frame_ids)
+        generation = self.shell_generation
+        bash_command = self._bash_command(command, timeout)
+        self._send_to_shell(f"__nixos_test_frame {frame_id} {bash_command} &")
 
-        # Get the return code
-        self.shell.send(b"echo ${PIPESTATUS[0]}\n")
-        rc = int(self._next_newline_closed_block_from_shell().strip())
+        def wait() -> tuple[int, str]:
+            rc, output = self._wait_for_frame(frame_id, generation)
+            return (rc, output.decode(errors="replace"))
 
-        return (rc, output.decode(errors="replace"))
+        return self.async_executor.submit(wait)
 
     def shell_interact(self, address: str | None = None) -> None:
         """
@@ -676,7 +1037,8 @@ class Machine:
 
     def wait_until_succeeds(self, command: str, timeout: int = 900) -> str:
         """
-        Repeat a shell command with 1-second intervals until it succeeds.
+        Repeat a shell command with intervals backing off from 50 milliseconds
+        to 1 second until it succeeds.
         Has a default timeout of 900 seconds which can be modified, e.g.
         `wait_until_succeeds(cmd, timeout=10)`. See `execute` for details on
         command execution.
@@ -737,16 +1099,15 @@ class Machine:
         if self.qmp_client is None:
             raise RuntimeError("QMP API is not ready yet, is the VM ready?")
 
-        start = time.time()
+        deadline = time.monotonic() + timeout
         while True:
-            evt = self.qmp_client.wait_for_event(timeout=timeout)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError
+            evt = self.qmp_client.wait_for_event(timeout=remaining)
             if event_filter(evt):
                 return evt
 
-            elapsed = time.time() - start
-            if elapsed >= timeout:
-                raise TimeoutError
-
     def get_tty_text(self, tty: str) -> str:
         status, output = self.execute(
             f"fold -w$(stty -F /dev/tty{tty} size | awk '{{print $2}}') /dev/vcs{tty}"
@@ -776,22 +1137,102 @@ class Machine:
         Simulate typing a sequence of characters on the virtual keyboard,
         e.g., `send_chars("foobar\n")` will type the string `foobar`
         followed by the Enter key.
+
+        Several characters are typed at once, except on machines with a USB
+        keyboard (e.g. on AArch64): it only takes one key event from its
+        queue per poll of the guest, so bursts would overflow it.
         """
         with self.nested(f"sending keys {repr(chars)}"):
+            if self.qmp_client is None or self._has_usb_keyboard():
+                for char in chars:
+                    self.send_key(char, delay, log=False)
+                return
+
+            events: list[dict[str, Any]] = []
+
+            def flush() -> None:
+                if not events:
+                    return
+                assert self.qmp_client is not None
+                self.qmp_client.send(
+                    "input-send-event", {"events": events}, timeout=QMP_COMMAND_TIMEOUT
+                )
+                events.clear()
+                if delay is not None:
+                    time.sleep(delay)
+
+            self.run_callbacks()
             for char in chars:
-                self.send_key(char, delay, log=False)
+                key_events = _key_events(CHAR_TO_KEY.get(char, char))
+                if key_events is None:
+                    # Leave it to the monitor to deal with whatever this is
+                    flush()
+                    self.send_key(char, delay, log=False)
+                    continue
+                if len(events) + len(key_events) > KEY_BATCH_EVENTS:
+                    flush()
+                events.extend(key_events)
+            flush()
+
+    def _has_usb_keyboard(self) -> bool:
+        """Whether QEMU emulates a USB keyboard for the machine"""
+        if self.usb_keyboard is None:
+            assert self.qmp_client is not None
+            self.usb_keyboard = any(
+                device["type"] == "child<usb-kbd>"
+                for path in ["/machine/peripheral", "/machine/peripheral-anon"]
+                for device in self.qmp_client.send(
+                    "qom-list", {"path": path}, timeout=QMP_COMMAND_TIMEOUT
+                )["return"]
+            )
+        return self.usb_keyboard
 
-    def wait_for_file(self, filename: str, timeout: int = 900) -> None:
+    def wait_for_guest_condition(self, condition: str, timeout: int = 900) -> None:
         """
-        Waits until the file exists in the machine's file system.
+        Wait until the shell `condition` succeeds in the guest, e.g.,
+        `wait_for_guest_condition("test -e /run/foo.pid")`.
+
+        Unlike `wait_until_succeeds`, the condition is re-evaluated by a loop
+        running inside the guest, first every 100 milliseconds and backing off
+        to once a second, so it is noticed quickly while only taking a shell
+        round trip every few seconds. The condition should therefore be cheap
+        and free of side effects.
+        Throws an exception on timeout.
         """
+        deadline = time.monotonic() + timeout
+        poll_slice = GUEST_POLL_MIN_SLICE
+
+        # The intervals the first command sleeps for before settling on the
+        # maximum, later commands only sleep for the maximum
+        backoff = []
+        interval = GUEST_POLL_MIN_INTERVAL
+        while interval < GUEST_POLL_MAX_INTERVAL:
+            backoff.append(str(interval))
+            interval *= 2
+
+        # Round down to hundredths, so the last slice ends by the deadline and
+        # never becomes `timeout 0`, which would not time out at all
+        while (remaining := math.floor((deadline - time.monotonic()) * 100) / 100) > 0:
+            command = f"until {condition}; do sleep {GUEST_POLL_MAX_INTERVAL}; done"
+            if backoff:
+                command = (
+                    f"for d in {' '.join(backoff)}; do"
+                    f" if {condition}; then exit 0; fi; sleep $d; done; {command}"
+                )
+                backoff = []
+            status, _ = self.execute(command, timeout=min(poll_slice, remaining))
+            if status == 0:
+                return
+            poll_slice = min(poll_slice * 2, GUEST_POLL_MAX_SLICE)
 
-        def check_file(_last_try: bool) -> bool:
-            status, _ = self.execute(f"test -e {filename}")
-            return status == 0
+        raise Exception(f"action timed out after {timeout} seconds")
 
+    def wait_for_file(self, filename: str, timeout: int = 900) -> None:
+        """
+        Waits until the file exists in the machine's file system.
+        """
         with self.nested(f"waiting for file '{filename}'"):
-            retry(check_file, timeout)
+            self.wait_for_guest_condition(f"test -e {filename}", timeout)
 
     def wait_for_open_port(
         self, port: int, addr: str = "localhost", timeout: int = 900
@@ -801,12 +1242,8 @@ class Machine:
         (default `localhost`).
         """
 
-        def port_is_open(_last_try: bool) -> bool:
-            status, _ = self.execute(f"nc -z {addr} {port}")
-            return status == 0
-
         with self.nested(f"waiting for TCP port {port} on {addr}"):
-            retry(port_is_open, timeout)
+            self.wait_for_guest_condition(f"nc -z {addr} {port}", timeout)
 
     def wait_for_open_unix_socket(
         self, addr: str, is_datagram: bool = False, timeout: int = 900
@@ -814,21 +1251,30 @@ class Machine:
         """
         Wait until a process is listening on the given UNIX-domain socket
         (default to a UNIX-domain stream socket).
-        """
 
-        nc_flags = [
-            "-z",
-            "-uU" if is_datagram else "-U",
-        ]
+        The socket is looked up in `/proc/net/unix` rather than connected to,
+        so the process under test doesn't see any probing connections. `addr`
+        must therefore be the path the socket was bound to.
+        """
 
-        def socket_is_open(_last_try: bool) -> bool:
-            status, _ = self.execute(f"nc {' '.join(nc_flags)} {addr}")
-            return status == 0
+        # Stream sockets must be listening (__SO_ACCEPTCON), datagram
+        # sockets only bound to the path, which ends the line
+        socket_type = (
+            '$5 == "0002"' if is_datagram else '$4 == "00010000" && $5 == "0001"'
+        )
+        program = (
+            f"NR > 1 && {socket_type}"
+            ' && substr($0, length($0) - length(path)) == " " path { found = 1 }'
+            " END { exit !found }"
+        )
+        condition = (
+            f"awk -v path={shlex.quote(addr)} {shlex.quote(program)} /proc/net/unix"
+        )
 
         with self.nested(
             f"waiting for UNIX-domain {'datagram' if is_datagram else 'stream'} on '{addr}'"
         ):
-            retry(socket_is_open, timeout)
+            self.wait_for_guest_condition(condition, timeout)
 
     def wait_for_closed_port(
         self, port: int, addr: str = "localhost", timeout: int = 900
@@ -838,12 +1284,8 @@ class Machine:
         (default `localhost`).
         """
 
-        def port_is_closed(_last_try: bool) -> bool:
-            status, _ = self.execute(f"nc -z {addr} {port}")
-            return status != 0
-
         with self.nested(f"waiting for TCP port {port} on {addr} to be closed"):
-            retry(port_is_closed, timeout)
+            self.wait_for_guest_condition(f"! nc -z {addr} {port}", timeout)
 
     def start_job(self, jobname: str, user: str | None = None) -> tuple[int, str]:
         return self.systemctl(f"start {jobname}", user)
@@ -890,6 +1332,9 @@ class Machine:
                 if b"Spawning backdoor root shell..." in chunk:
                     break
 
+            self._reset_shell_state()
+            self._setup_framed_shell()
+
             toc = time.time()
 
             self.log("connected to guest root shell")
@@ -912,22 +1357,37 @@ class Machine:
             {"image": os.path.basename(filename)},
         ):
             self.send_monitor_command(f"screendump {tmp}")
-            ret = subprocess.run(f"pnmtopng '{tmp}' > '{filename}'", shell=True)
-            os.unlink(tmp)
-            if ret.returncode != 0:
-                raise Exception("Cannot convert screenshot")
+            try:
+                image = PPMImage.from_file(tmp)
+            except (OSError, ValueError) as e:
+                raise Exception(f"Cannot convert screenshot: {e}")
+            finally:
+                if os.path.exists(tmp):
+                    os.unlink(tmp)
+            with open(filename, "wb") as f:
+                f.write(image.to_png())
 
     def copy_from_host_via_shell(self, source: str, target: str) -> None:
         """Copy a file from the host into the guest by piping it over the
         shell into the destination file. Works without host-guest shared folder.
+        The file is sent in pieces of a few megabytes, each as the input of
+        one command, so its size is neither limited by the maximum length of
+        a command line nor by the memory of the host or the guest.
         Prefer copy_from_host for whenever possible.
         """
-        with open(source, "rb") as fh:
-            content_b64 = base64.b64encode(fh.read()).decode()
-            self.succeed(
-                f"mkdir -p $(dirname {target})",
-                f"echo -n {content_b64} | base64 -d > {target}",
-            )
+
+        def run(command: str, input_lines: list[bytes] | None = None) -> None:
+            status, _ = self._execute(command, input_lines=input_lines)
+            if status != 0:
+                raise Exception(
+                    f"copying {source} to {target} failed (exit code {status})"
+                )
+
+        with self.nested(f"copying {source} to {target} via the shell"):
+            run(f"mkdir -p $(dirname {target}); : > {target}")
+            with open(source, "rb") as fh:
+                while chunk := fh.read(SHELL_COPY_CHUNK_SIZE):
+                    run(f"base64 -d >> {target}", [base64.encodebytes(chunk)])
 
     def copy_from_host(self, source: str, target: str) -> None:
         """
@@ -954,13 +1414,15 @@ class Machine:
             vm_shared_temp = Path("/tmp/shared") / shared_temp.name
             vm_intermediate = vm_shared_temp / host_src.name
 
-            self.succeed(make_command(["mkdir", "-p", vm_shared_temp]))
             if host_src.is_dir():
                 shutil.copytree(host_src, host_intermediate)
             else:
                 shutil.copy(host_src, host_intermediate)
-            self.succeed(make_command(["mkdir", "-p", vm_target.parent]))
-            self.succeed(make_command(["cp", "-r", vm_intermediate, vm_target]))
+            self.succeed(
+                make_command(["mkdir", "-p", vm_shared_temp, vm_target.parent])
+                + " && "
+                + make_command(["cp", "-r", vm_intermediate, vm_target])
+            )
 
     def copy_from_vm(self, source: str, target_dir: str = "") -> None:
         """Copy a file from the VM (specified by an in-VM source path) to a path
@@ -975,8 +1437,11 @@ class Machine:
             vm_intermediate = vm_shared_temp / vm_src.name
             intermediate = shared_temp / vm_src.name
             # Copy the file to the shared directory inside VM
-            self.succeed(make_command(["mkdir", "-p", vm_shared_temp]))
-            self.succeed(make_command(["cp", "-r", vm_src, vm_intermediate]))
+            self.succeed(
+                make_command(["mkdir", "-p", vm_shared_temp])
+                + " && "
+                + make_command(["cp", "-r", vm_src, vm_intermediate])
+            )
             abs_target = self.out_dir / target_dir / vm_src.name
             abs_target.parent.mkdir(exist_ok=True, parents=True)
             # Copy the file from the shared directory outside VM
@@ -985,15 +1450,98 @@ class Machine:
             else:
                 shutil.copy(intermediate, abs_target)
 
+    def copy_tree_from_host(
+        self, source: str, target: str, compress: bool = False
+    ) -> None:
+        """
+        Copies the contents of a directory from the host into the directory
+        `target` on the machine, e.g.,
+        `copy_tree_from_host("fixtures", "/var/lib/foo")`.
+
+        The tree is streamed as a single tar archive via the `shared_dir`
+        directory, so it is never held in memory, and unpacked by a single
+        command in the machine. Set `compress` to gzip the archive, which
+        pays off for large, compressible trees. Like with `copy_from_host`,
+        user:group of all files will be root:root.
+        """
+        host_src = Path(source)
+
+        def as_root(info: tarfile.TarInfo) -> tarfile.TarInfo:
+            info.uid = info.gid = 0
+            info.uname = info.gname = "root"
+            return info
+
+        with tempfile.TemporaryDirectory(dir=self.shared_dir) as shared_td:
+            shared_temp = Path(shared_td)
+            archive = shared_temp / "tree.tar"
+            vm_archive = Path("/tmp/shared") / shared_temp.name / archive.name
+
+            with tarfile.open(str(archive), "w|gz" if compress else "w|") as tar:
+                tar.add(host_src, arcname=".", filter=as_root)
+
+            self.succeed(
+                make_command(["mkdir", "-p", target])
+                + " && "
+                + make_command(
+                    ["tar", "-x", *(["-z"] if compress else []), "-f", vm_archive]
+                    + ["-C", target]
+                )
+            )
+
+    def copy_tree_from_vm(
+        self, source: str, target_dir: str = "", compress: bool = False
+    ) -> None:
+        """
+        Copy a file or directory tree from the VM to a path relative to
+        `$out`, like `copy_from_vm`, but packed into a single (optionally
+        gzip-compressed) tar archive by one command in the machine and
+        unpacked on the host while it is read. This is considerably faster
+        for large log or data collections.
+        """
+        vm_src = Path(source)
+        with tempfile.TemporaryDirectory(dir=self.shared_dir) as shared_td:
+            shared_temp = Path(shared_td)
+            archive = shared_temp / "tree.tar"
+            vm_archive = Path("/tmp/shared") / shared_temp.name / archive.name
+
+            self.succeed(
+                make_command(
+                    ["tar", "-c", *(["-z"] if compress else []), "-f", vm_archive]
+                    + ["-C", vm_src.parent, vm_src.name]
+                )
+            )
+
+            abs_target_dir = self.out_dir / target_dir
+            abs_target_dir.mkdir(exist_ok=True, parents=True)
+            with tarfile.open(str(archive), "r|*") as tar:
+                tar.extractall(abs_target_dir, filter="tar")
+
     def dump_tty_contents(self, tty: str) -> None:
         """Debugging: Dump the contents of the TTY<n>"""
         self.execute(f"fold -w 80 /dev/vcs{tty} | systemd-cat")
 
-    def _get_screen_text_variants(self, model_ids: Iterable[int]) -> list[str]:
+    def _get_screen_text_variants(
+        self, model_ids: Iterable[int], until: Callable[[str], bool] | None = None
+    ) -> list[str]:
         with tempfile.TemporaryDirectory() as tmpdir:
             screenshot_path = os.path.join(tmpdir, "ppm")
             self.send_monitor_command(f"screendump {screenshot_path}")
-            return _perform_ocr_on_screenshot(screenshot_path, model_ids)
+            screenshot = PPMImage.from_file(screenshot_path)
+
+        # Waiting for text mostly looks at the same screen over and over,
+        # only run OCR again once something changed
+        model_ids = tuple(model_ids)
+        digest = screenshot.digest()
+        cached = self.ocr_cache.get(model_ids)
+        if cached is not None and cached[0] == digest:
+            return list(cached[1])
+
+        with profiler.span("ocr", "ocr", self.name, models=list(model_ids)):
+            variants = _perform_ocr_on_screenshot(screenshot, model_ids, until)
+        # Results of a run stopped early are incomplete
+        if len(variants) == 3 * len(model_ids):
+            self.ocr_cache[model_ids] = (digest, list(variants))
+        return variants
 
     def get_screen_text_variants(self) -> list[str]:
         """
@@ -1031,11 +1579,13 @@ class Machine:
         :::
         """
 
+        def matches(text: str) -> bool:
+            return re.search(regex, text) is not None
+
         def screen_matches(last_try: bool) -> bool:
-            variants = self.get_screen_text_variants()
-            for text in variants:
-                if re.search(regex, text) is not None:
-                    return True
+            variants = self._get_screen_text_variants([0, 1, 2], until=matches)
+            if any(matches(text) for text in variants):
+                return True
 
             if last_try:
                 self.log(f"Last OCR attempt failed. Text was: {variants}")
@@ -1045,34 +1595,41 @@ class Machine:
         with self.nested(f"waiting for {regex} to appear on screen"):
             retry(screen_matches, timeout)
 
-    def wait_for_console_text(self, regex: str, timeout: int | None = None) -> None:
+    def wait_for_console_text(
+        self, regex: str, timeout: int | None = None, since: int | None = None
+    ) -> None:
         """
-        Wait until the supplied regular expressions match a line of the
-        serial console output.
+        Wait until the supplied regular expressions match the serial console
+        output, which may span several lines (`^` and `$` match at the start
+        and end of each line).
         This method is useful when OCR is not possible or inaccurate.
-        """
-        # Buffer the console output, this is needed
-        # to match multiline regexes.
-        console = io.StringIO()
 
-        def console_matches(_last_try: bool) -> bool:
-            nonlocal console
-            try:
-                # This will return as soon as possible and
-                # sleep 1 second.
-                console.write(self.last_lines.get(block=False))
-            except queue.Empty:
-                pass
-            console.seek(0)
-            matches = re.search(regex, console.read())
-            return matches is not None
+        Only output following the previous match is considered, unless a
+        cursor obtained from `get_console_cursor` is passed as `since`, e.g.
+
+        ```py
+        cursor = machine.get_console_cursor()
+        machine.send_console("\n")
+        machine.wait_for_console_text("login:", since=cursor)
+        ```
 
+        Output is only searched once as it arrives, so a match of a pattern
+        without a maximum length (e.g. one containing `.*` or `\\s+`) is only
+        found if it starts at most 65536 characters before the line completing it.
+        """
+        start = self.console_cursor if since is None else since
         with self.nested(f"waiting for {regex} to appear on console"):
-            if timeout is not None:
-                retry(console_matches, timeout)
-            else:
-                while not console_matches(False):
-                    pass
+            end = self.console.search(regex, start, timeout)
+            if end is None:
+                raise Exception(f"action timed out after {timeout} seconds")
+            self.console_cursor = end
+
+    def get_console_cursor(self) -> int:
+        """
+        Return a cursor pointing behind the serial console output received so
+        far, to be passed as `since` to `wait_for_console_text`.
+        """
+        return self.console.end
 
     def send_key(
         self, key: str, delay: float | None = 0.01, log: bool | None = True
@@ -1123,43 +1680,154 @@ class Machine:
             s.listen(1)
             return s
 
-        monitor_socket = create_socket(clear(self.monitor_path))
-        shell_socket = create_socket(clear(self.shell_path))
-        self.process = self.start_command.run(
-            self.state_dir,
-            self.shared_dir,
-            self.monitor_path,
-            self.qmp_path,
-            self.shell_path,
-            allow_reboot,
-        )
-        self.monitor, _ = monitor_socket.accept()
-        self.shell, _ = shell_socket.accept()
-        self.qmp_client = QMPSession.from_path(self.qmp_path)
+        # Resume from a snapshot of a previous run of the same configuration
+        # instead of booting, see `snapshot`
+        loadvm = None
+        if self.keep_vm_state and self.BOOT_SNAPSHOT in self._recorded_snapshots():
+            self.log(f"resuming from snapshot '{self.BOOT_SNAPSHOT}'")
+            loadvm = self.BOOT_SNAPSHOT
+
+        with profiler.span("start", "boot", self.name, loadvm=loadvm):
+            monitor_socket = create_socket(clear(self.monitor_path))
+            shell_socket = create_socket(clear(self.shell_path))
+            self.process = self.start_command.run(
+                self.state_dir,
+                self.shared_dir,
+                self.monitor_path,
+                self.qmp_path,
+                self.shell_path,
+                allow_reboot,
+                loadvm,
+            )
+            self.monitor, _ = monitor_socket.accept()
+            self.shell, _ = shell_socket.accept()
+            self.qmp_client = QMPSession.from_path(self.qmp_path)
 
-        # Store last serial console lines for use
-        # of wait_for_console_text
-        self.last_lines: Queue = Queue()
+            # Only output of this run is of interest to wait_for_console_text
+            self.console_cursor = self.console.end
 
-        def process_serial_output() -> None:
-            assert self.process
-            assert self.process.stdout
-            for _line in self.process.stdout:
-                # Ignore undecodable bytes that may occur in boot menus
-                line = _line.decode(errors="ignore").replace("\r", "").rstrip()
-                self.last_lines.put(line)
-                self.log_serial(line)
+            def process_serial_output() -> None:
+                assert self.process
+                assert self.process.stdout
+                for _line in self.process.stdout:
+                    # Ignore undecodable bytes that may occur in boot menus
+                    line = _line.decode(errors="ignore").replace("\r", "").rstrip()
+                    self.console.append(line)
+                    self.log_serial(line)
 
-        self.serial_thread = threading.Thread(target=process_serial_output)
-        self.serial_thread.start()
+            self.serial_thread = threading.Thread(target=process_serial_output)
+            self.serial_thread.start()
 
-        self.wait_for_monitor_prompt()
+            self.wait_for_monitor_prompt()
 
         self.pid = self.process.pid
         self.booted = True
 
         self.log(f"QEMU running (pid {self.pid})")
 
+        if loadvm is not None:
+            # Snapshots are only taken while connected to the guest shell
+            self._reset_shell_state()
+            self._setup_framed_shell()
+            self.connected = True
+
+    def _recorded_snapshots(self) -> list[str]:
+        """Names of the snapshots in the VM state that were taken with the
+        current start command.
+        """
+        try:
+            snapshots = json.loads(self.snapshots_path.read_text())
+        except FileNotFoundError:
+            return []
+        cache_key = self.start_command.cache_key
+        return [name for name, key in snapshots.items() if key == cache_key]
+
+    def _human_monitor_command(self, command: str, timeout: int = 900) -> str:
+        if self.qmp_client is None:
+            raise RuntimeError("QMP API is not ready yet, is the VM ready?")
+        # Saving and loading snapshots takes a while for machines with a lot
+        # of memory
+        return self.qmp_client.send(
+            "human-monitor-command", {"command-line": command}, timeout=timeout
+        )["return"]
+
+    def snapshot(self, name: str = BOOT_SNAPSHOT) -> None:
+        """
+        Save the complete state of the running machine (memory, devices and
+        disks) under the given name, so it can later be brought back with
+        `restore_snapshot`, e.g., to give each subtest a clean machine
+        without booting again.
+
+        Snapshots with the default name double as a boot cache: if the test
+        runs again with `--keep-vm-state` and the machine configuration is
+        unchanged, `start` resumes from the snapshot instead of booting.
+
+        ::: {.note}
+        QEMU refuses to snapshot machines with 9p file systems mounted, which
+        test VMs use by default for the host's Nix store and for exchanging
+        files with the host. Machines to snapshot need
+        [`virtualisation.useNixStoreImage`](#opt-virtualisation.useNixStoreImage)
+        and no [`virtualisation.sharedDirectories`](#opt-virtualisation.sharedDirectories),
+        which also means that `copy_from_host` and `copy_from_vm` do not work
+        for them:
+
+        ```nix
+        {
+          nodes.machine = { lib, ... }: {
+            virtualisation.useNixStoreImage = true;
+            virtualisation.sharedDirectories = lib.mkForce { };
+          };
+        }
+        ```
+        :::
+        """
+        self.connect()
+        with self.nested(f"saving snapshot '{name}'"):
+            mounts = self.succeed("awk '$3 == \"9p\" { print $2 }' /proc/mounts")
+            if mounts.split():
+                raise Exception(
+                    f"cannot snapshot {self.name}: QEMU does not support "
+                    f"snapshots while 9p file systems are mounted "
+                    f"({', '.join(mounts.split())}), see the documentation of "
+                    "`snapshot` for the configuration needed"
+                )
+            output = self._human_monitor_command(f"savevm {name}")
+            if output.strip():
+                raise Exception(f"saving snapshot '{name}' failed: {output}")
+
+            try:
+                snapshots = json.loads(self.snapshots_path.read_text())
+            except FileNotFoundError:
+                snapshots = {}
+            snapshots[name] = self.start_command.cache_key
+            self.snapshots_path.write_text(json.dumps(snapshots))
+
+    def restore_snapshot(self, name: str = BOOT_SNAPSHOT) -> None:
+        """
+        Restore the machine to the state saved by `snapshot` under the given
+        name. Commands still running in the background are lost, their
+        futures (see `execute_async`) fail.
+        """
+        with self.nested(f"restoring snapshot '{name}'"):
+            output = self._human_monitor_command(f"loadvm {name}")
+            if output.strip():
+                raise Exception(f"restoring snapshot '{name}' failed: {output}")
+            self._reset_shell_state()
+            self.connected = True
+
+    def _reset_shell_state(self) -> None:
+        """Forget about the commands sent to the guest shell so far, failing
+        those still waiting for their output.
+        """
+        with self.frame_condition:
+            self.shell_generation += 1
+            self.frames = {}
+            self.frame_condition.notify_all()
+            # A thread blocked reading frames gives up within a second
+            while self.frame_reader_busy:
+                self.frame_condition.wait()
+            self.shell_buffer = b""
+
     def cleanup_statedir(self) -> None:
         shutil.rmtree(self.state_dir)
         self.logger.log(f"deleting VM state directory {self.state_dir}")
@@ -1281,6 +1949,9 @@ class Machine:
         self.monitor.close()
         self.serial_thread.join()
 
+        if self.async_executor:
+            self.async_executor.shutdown(wait=False, cancel_futures=True)
+
         if self.qmp_client:
             self.qmp_client.close()
 
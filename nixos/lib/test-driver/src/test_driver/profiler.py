@@ -0,0 +1,167 @@
+import json
+import os
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import AbstractContextManager, contextmanager, nullcontext
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any
+
+
+def self_durations(events: list[dict[str, Any]], threads: list[int]) -> list[float]:
+    """The duration of each event minus the time spent in the events nested
+    in it, in microseconds. `threads` holds the thread each event was
+    recorded in, events only nest within a thread.
+    """
+    durations = [event["dur"] for event in events]
+    # Innermost open events per thread, as (end, index)
+    open_events: dict[int, list[tuple[float, int]]] = {}
+    for index in sorted(
+        range(len(events)),
+        key=lambda index: (events[index]["ts"], -events[index]["dur"]),
+    ):
+        event = events[index]
+        end = event["ts"] + event["dur"]
+        stack = open_events.setdefault(threads[index], [])
+        while stack and stack[-1][0] <= event["ts"]:
+            stack.pop()
+        if stack:
+            parent = stack[-1][1]
+            durations[parent] = max(durations[parent] - event["dur"], 0.0)
+        stack.append((end, index))
+    return durations
+
+
+class Profiler:
+    """Records how long the actions of a test take, per machine, and writes
+    them as a trace in Chrome's trace event format, which can be viewed with
+    e.g. https://ui.perfetto.dev or turned into a flame graph.
+
+    Profiling is disabled until `enable` is called; until then `span` costs
+    next to nothing.
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.events: list[dict[str, Any]] = []
+        # The thread each event was recorded in, see `self_durations`
+        self.threads: list[int] = []
+        self.tracks: dict[str, int] = {}
+        # Spans without an explicit track, e.g. those of `retry`, end up on
+        # the track of the span they are nested in
+        self.current_track: ContextVar[str | None] = ContextVar(
+            "current_track", default=None
+        )
+        self.origin = time.perf_counter_ns()
+
+    def enable(self) -> None:
+        self.enabled = True
+        self.origin = time.perf_counter_ns()
+
+    def span(
+        self, name: str, category: str, track: str | None = None, **args: Any
+    ) -> AbstractContextManager[None]:
+        """Record the time spent in the context as an event named `name`"""
+        if not self.enabled:
+            return nullcontext()
+        return self._span(name, category, track, args)
+
+    @contextmanager
+    def _span(
+        self, name: str, category: str, track: str | None, args: dict[str, Any]
+    ) -> Iterator[None]:
+        if track is None:
+            track = self.current_track.get() or threading.current_thread().name
+        token = self.current_track.set(track)
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            end = time.perf_counter_ns()
+            self.current_track.reset(token)
+            with self.lock:
+                tid = self.tracks.setdefault(track, len(self.tracks) + 1)
+                self.events.append(
+                    {
+                        "name": name,
+                        "cat": category,
+                        "ph": "X",
+                        "ts": (start - self.origin) / 1000,
+                        "dur": (end - start) / 1000,
+                        "pid": os.getpid(),
+                        "tid": tid,
+                        "args": args,
+                    }
+                )
+                self.threads.append(threading.get_ident())
+
+    def write_trace(self, path: Path) -> None:
+        with self.lock:
+            events = list(self.events)
+            tracks = dict(self.tracks)
+        metadata = [
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": os.getpid(),
+                "tid": tid,
+                "args": {"name": track},
+            }
+            for track, tid in tracks.items()
+        ]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": metadata + events, "displayTimeUnit": "ms"}, f)
+
+    def summary(self, top: int = 10) -> list[str]:
+        """A table of the time spent per category, followed by the longest
+        waits and the number of retries and shell round trips.
+
+        Spans nest, e.g. a wait contains the shell commands it runs, so the
+        totals of the categories overlap. The self time only counts the time
+        not spent in nested spans, so it doesn't.
+        """
+        with self.lock:
+            events = list(self.events)
+            threads = list(self.threads)
+            tracks = {tid: track for track, tid in self.tracks.items()}
+
+        totals: dict[str, tuple[int, float, float]] = {}
+        for event, self_duration in zip(events, self_durations(events, threads)):
+            calls, total, self_total = totals.get(event["cat"], (0, 0.0, 0.0))
+            totals[event["cat"]] = (
+                calls + 1,
+                total + event["dur"] / 1e6,
+                self_total + self_duration / 1e6,
+            )
+
+        lines = [
+            f"{'category':<12} {'calls':>8} {'self':>10} {'total':>10} {'mean':>10}"
+        ]
+        for category, (calls, total, self_total) in sorted(
+            totals.items(), key=lambda item: item[1][2], reverse=True
+        ):
+            lines.append(
+                f"{category:<12} {calls:>8} {self_total:>9.2f}s {total:>9.2f}s"
+                f" {total / calls:>9.3f}s"
+            )
+
+        waits = sorted(
+            (event for event in events if event["cat"] == "wait"),
+            key=lambda event: event["dur"],
+            reverse=True,
+        )
+        if waits:
+            lines.append("longest waits:")
+            for event in waits[:top]:
+                lines.append(
+                    f"  {event['dur'] / 1e6:>9.2f}s  {tracks[event['tid']]}: {event['name']}"
+                )
+
+        lines.append(f"retries: {totals.get('retry', (0, 0.0, 0.0))[0]}")
+        lines.append(f"shell round trips: {totals.get('shell', (0, 0.0, 0.0))[0]}")
+        return lines
+
+
+profiler = Profiler()
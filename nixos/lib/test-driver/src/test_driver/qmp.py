@@ -1,21 +1,29 @@
+import itertools
 import json
 import logging
-import os
 import socket
+import threading
 from collections.abc import Iterator
+from concurrent.futures import Future
 from pathlib import Path
-from queue import Queue
+from queue import Empty, Queue
 from typing import Any
 
+from test_driver.profiler import profiler
+
 logger = logging.getLogger(__name__)
 
+# Seconds to wait for the result of a command that should be answered right
+# away, passed to `QMPSession.send` where a hanging QEMU should fail the test
+QMP_COMMAND_TIMEOUT = 60
+
 
 class QMPAPIError(RuntimeError):
     def __init__(self, message: dict[str, Any]):
         assert "error" in message, "Not an error message!"
         try:
-            self.class_name = message["class"]
-            self.description = message["desc"]
+            self.class_name = message["error"]["class"]
+            self.description = message["error"]["desc"]
             # NOTE: Some errors can occur before the Server is able to read the
             # id member; in these cases the id member will not be part of the
             # error response, even if provided by the client.
@@ -28,20 +36,36 @@ class QMPAPIError(RuntimeError):
 
 
 class QMPSession:
+    """A session with QEMU's QMP API. A reader thread blocks on the socket and
+    dispatches results to the futures of the commands they belong to (matched
+    by their `id`) and events to all subscribers, so that neither waiting for
+    a result nor for an event keeps a CPU busy, and several commands can be
+    in flight at the same time.
+    """
+
     def __init__(self, sock: socket.socket) -> None:
         self.sock = sock
-        self.results: Queue[dict[str, str]] = Queue()
-        self.pending_events: Queue[dict[str, Any]] = Queue()
         self.reader = sock.makefile("r")
         self.writer = sock.makefile("w")
-        # Make the reader non-blocking so we can kind of select on it.
-        os.set_blocking(self.reader.fileno(), False)
-        hello = self._wait_for_new_result()
+        self.write_lock = threading.Lock()
+        self.transaction_ids = itertools.count()
+        self.pending_results: dict[int, Future[dict[str, Any]]] = {}
+        self.subscribers: list[Queue[dict[str, Any]]] = []
+        self.lock = threading.Lock()
+        # Events nobody explicitly subscribed to, see `wait_for_event`
+        self.pending_events: Queue[dict[str, Any]] = self.subscribe_queue()
+
+        hello = json.loads(self.reader.readline())
         logger.debug(f"Got greeting from QMP API: {hello}")
         # The greeting message format is:
         # { "QMP": { "version": json-object, "capabilities": json-array } }
         assert "QMP" in hello, f"Unexpected result: {hello}"
-        self.send("qmp_capabilities")
+
+        self.reader_thread = threading.Thread(
+            target=self._read_messages, name="qmp-reader", daemon=True
+        )
+        self.reader_thread.start()
+        self.send("qmp_capabilities", timeout=QMP_COMMAND_TIMEOUT)
 
     @classmethod
     def from_path(cls, path: Path) -> "QMPSession":
@@ -50,49 +74,101 @@ class QMPSession:
         return cls(sock)
 
     def close(self) -> None:
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         self.sock.close()
 
-    def _wait_for_new_result(self) -> dict[str, str]:
-        assert self.results.empty(), "Results set is not empty, missed results!"
-        while self.results.empty():
-            self.read_pending_messages()
-        return self.results.get()
-
-    def read_pending_messages(self) -> None:
-        line = self.reader.readline()
-        if not line:
+    def _read_messages(self) -> None:
+        try:
+            for line in self.reader:
+                self._dispatch(json.loads(line))
+        except (OSError, ValueError) as e:
+            logger.debug(f"QMP reader stopped: {e}")
+        finally:
+            with self.lock:
+                pending = list(self.pending_results.values())
+                self.pending_results.clear()
+            for future in pending:
+                future.set_exception(ConnectionError("QMP connection closed"))
+
+    def _dispatch(self, message: dict[str, Any]) -> None:
+        logger.debug(f"Received a message: {message}")
+
+        if "event" in message:
+            with self.lock:
+                subscribers = list(self.subscribers)
+            for subscriber in subscribers:
+                subscriber.put(message)
             return
-        evt_or_result = json.loads(line)
-        logger.debug(f"Received a message: {evt_or_result}")
-
-        # It's a result
-        if "return" in evt_or_result or "QMP" in evt_or_result:
-            self.results.put(evt_or_result)
-        # It's an event
-        elif "event" in evt_or_result:
-            self.pending_events.put(evt_or_result)
-        else:
-            raise QMPAPIError(evt_or_result)
-
-    def wait_for_event(self, timeout: int = 10) -> dict[str, Any]:
-        while self.pending_events.empty():
-            self.read_pending_messages()
 
-        return self.pending_events.get(timeout=timeout)
+        with self.lock:
+            transaction_id: int = message.get("id", -1)
+            if "id" not in message and "error" in message and self.pending_results:
+                # QEMU could not read the id of the command, which fails before
+                # the commands sent after it as they are handled in order
+                transaction_id = min(self.pending_results)
+            future = self.pending_results.pop(transaction_id, None)
+        if future is None:
+            logger.warning(f"Dropping unexpected QMP message: {message}")
+        elif "return" in message:
+            future.set_result(message)
+        else:
+            future.set_exception(QMPAPIError(message))
+
+    def subscribe_queue(self) -> Queue[dict[str, Any]]:
+        """Return a queue that receives all events from now on"""
+        events: Queue[dict[str, Any]] = Queue()
+        with self.lock:
+            self.subscribers.append(events)
+        return events
+
+    def wait_for_event(self, timeout: float | None = 10) -> dict[str, Any]:
+        """Return the oldest event not yet returned, waiting up to `timeout`
+        seconds for one to arrive.
+        """
+        try:
+            return self.pending_events.get(timeout=timeout)
+        except Empty:
+            raise TimeoutError(f"no QMP event within {timeout} seconds")
 
     def events(self, timeout: int = 10) -> Iterator[dict[str, Any]]:
         while not self.pending_events.empty():
             yield self.pending_events.get(timeout=timeout)
 
-    def send(self, cmd: str, args: dict[str, str] = {}) -> dict[str, str]:
-        self.read_pending_messages()
-        assert self.results.empty(), "Results set is not empty, missed results!"
-        data: dict[str, Any] = dict(execute=cmd)
-        if args != {}:
-            data["arguments"] = args
-
-        logger.debug(f"Sending {data} to QMP...")
-        json.dump(data, self.writer)
-        self.writer.write("\n")
-        self.writer.flush()
-        return self._wait_for_new_result()
+    def send_async(self, cmd: str, args: dict[str, Any] = {}) -> Future[dict[str, Any]]:
+        """Send a command without waiting for its result"""
+        future: Future[dict[str, Any]] = Future()
+
+        # Ids are handed out in the order commands are written, see `_dispatch`
+        with self.write_lock:
+            transaction_id = next(self.transaction_ids)
+            data: dict[str, Any] = dict(execute=cmd, id=transaction_id)
+            if args != {}:
+                data["arguments"] = args
+            with self.lock:
+                self.pending_results[transaction_id] = future
+
+            logger.debug(f"Sending {data} to QMP...")
+            json.dump(data, self.writer)
+            self.writer.write("\n")
+            self.writer.flush()
+        return future
+
+    def send(
+        self,
+        cmd: str,
+        args: dict[str, Any] = {},
+        timeout: float | None = None,
+    ) -> dict[str, Any]:
+        """Send a command and wait for its result, up to `timeout` seconds if
+        given.
+        """
+        with profiler.span(cmd, "qmp"):
+            try:
+                return self.send_async(cmd, args).result(timeout=timeout)
+            except TimeoutError:
+                raise TimeoutError(
+                    f"no result for QMP command {cmd} within {timeout} seconds"
+                )
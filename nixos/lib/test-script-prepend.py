@@ -26,6 +26,13 @@ class PollingConditionProtocol(Protocol):
         raise Exception("This is just type information for the Nix test driver")
 
 
+class SubtestProtocol(Protocol):
+    def __call__(
+        self, name: str, restore: Optional[str] = None
+    ) -> ContextManager[None]:
+        raise Exception("This is just type information for the Nix test driver")
+
+
 class CreateMachineProtocol(Protocol):
     def __call__(
         self,
@@ -38,7 +45,7 @@ class CreateMachineProtocol(Protocol):
 
 
 start_all: Callable[[], None]
-subtest: Callable[[str], ContextManager[None]]
+subtest: SubtestProtocol
 retry: RetryProtocol
 test_script: Callable[[], None]
 machines: List[Machine]
@@ -1274,6 +1274,9 @@ in
           file = ''"$TMPDIR"/store.img'';
           deviceExtraOpts.bootindex = "2";
           driveExtraOpts.format = "raw";
+          # The image is only ever mounted read-only. As a read-only drive,
+          # it does not prevent snapshots of the VM, which raw images do.
+          driveExtraOpts.readonly = "on";
         }
       ])
       (imap0 (idx: _: {
@@ -132,6 +132,13 @@ in {
     lib-extend = handleTestOn [ "x86_64-linux" "aarch64-linux" ] ./nixos-test-driver/lib-extend.nix {};
     node-name = runTest ./nixos-test-driver/node-name.nix;
     busybox = runTest ./nixos-test-driver/busybox.nix;
+    console = runTest ./nixos-test-driver/console.nix;
+    copy-via-shell = runTest ./nixos-test-driver/copy-via-shell.nix;
+    execute-async = runTest ./nixos-test-driver/execute-async.nix;
+    framed-shell = runTest ./nixos-test-driver/framed-shell.nix;
+    json-log = runTest ./nixos-test-driver/json-log.nix;
+    snapshot = runTest ./nixos-test-driver/snapshot.nix;
+    send-chars = runTest ./nixos-test-driver/send-chars.nix;
     driver-timeout = pkgs.runCommand "ensure-timeout-induced-failure" {
       failed = pkgs.testers.testBuildFailure ((runTest ./nixos-test-driver/timeout.nix).config.rawTestDerivation);
     } ''
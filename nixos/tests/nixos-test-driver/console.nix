@@ -0,0 +1,27 @@
+{
+  name = "nixos-test-driver.console";
+  nodes.machine = { };
+
+  testScript = ''
+    machine.wait_for_unit("multi-user.target")
+
+    with subtest("patterns may span several lines"):
+      machine.succeed("printf 'marker-one\\nmarker-two\\n' > /dev/console")
+      machine.wait_for_console_text(r"^marker-one\nmarker-two$")
+
+    with subtest("waits resume behind the previous match"):
+      cursor = machine.get_console_cursor()
+      machine.succeed("echo marker-three > /dev/console")
+      machine.wait_for_console_text("marker-three")
+      try:
+        machine.wait_for_console_text("marker-one", timeout=1)
+      except Exception:
+        pass
+      else:
+        raise Exception("output before the previous match was matched again")
+
+    with subtest("waits can start at a cursor"):
+      machine.wait_for_console_text("marker-three", since=cursor)
+      machine.wait_for_console_text("marker-one", since=0)
+  '';
+}
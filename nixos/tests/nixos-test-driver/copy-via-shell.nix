@@ -0,0 +1,33 @@
+{
+  name = "nixos-test-driver.copy-via-shell";
+  nodes.machine = {
+    virtualisation.memorySize = 256;
+  };
+
+  testScript = ''
+    import hashlib
+    import os
+    import tempfile
+
+    machine.wait_for_unit("multi-user.target")
+
+    with subtest("files larger than a quarter of the guest's memory can be copied"):
+      with tempfile.NamedTemporaryFile() as source:
+        digest = hashlib.sha256()
+        for _ in range(96):
+          chunk = os.urandom(1024 * 1024)
+          digest.update(chunk)
+          source.write(chunk)
+        source.flush()
+
+        machine.copy_from_host_via_shell(source.name, "/root/copied/file")
+
+      copied = machine.succeed("sha256sum /root/copied/file").split()[0]
+      assert copied == digest.hexdigest(), "the copy differs from the original"
+
+    with subtest("empty files can be copied"):
+      with tempfile.NamedTemporaryFile() as source:
+        machine.copy_from_host_via_shell(source.name, "/root/copied/empty")
+      machine.succeed("test -f /root/copied/empty && ! test -s /root/copied/empty")
+  '';
+}
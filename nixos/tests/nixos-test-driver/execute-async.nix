@@ -0,0 +1,37 @@
+{
+  name = "nixos-test-driver.execute-async";
+  nodes.machine = { };
+
+  testScript = ''
+    machine.wait_for_unit("multi-user.target")
+
+    with subtest("background commands run concurrently"):
+      # Each command waits for the other one, so they only finish when
+      # they run at the same time
+      first = machine.execute_async(
+        "touch /tmp/first; until [ -e /tmp/second ]; do sleep 0.1; done; echo first",
+        timeout=60,
+      )
+      second = machine.execute_async(
+        "touch /tmp/second; until [ -e /tmp/first ]; do sleep 0.1; done; echo second",
+        timeout=60,
+      )
+      assert first.result() == (0, "first\n"), first.result()
+      assert second.result() == (0, "second\n"), second.result()
+
+    with subtest("the machine stays usable while commands run"):
+      waiting = machine.execute_async(
+        "until [ -e /tmp/go ]; do sleep 0.1; done; echo done", timeout=60
+      )
+      machine.succeed("touch /tmp/go")
+      assert waiting.result() == (0, "done\n"), waiting.result()
+
+    with subtest("results are matched to their commands"):
+      failing = machine.execute_async("sleep 1; echo out; exit 7")
+      large = machine.execute_async("head -c 1000000 /dev/zero | tr '\\0' y")
+      quick = machine.execute_async("echo quick")
+      assert quick.result() == (0, "quick\n"), quick.result()
+      assert large.result() == (0, "y" * 1000000), "large output was altered"
+      assert failing.result() == (7, "out\n"), failing.result()
+  '';
+}
@@ -0,0 +1,31 @@
+{
+  name = "nixos-test-driver.framed-shell";
+  nodes.machine = { };
+
+  testScript = ''
+    machine.wait_for_unit("multi-user.target")
+
+    assert machine.framed_shell, "the guest shell did not set up the framed protocol"
+
+    with subtest("output arrives unaltered"):
+      status, output = machine.execute("printf 'a\\nb\\n\\n  c'")
+      assert (status, output) == (0, "a\nb\n\n  c"), (status, output)
+
+    with subtest("the status of a command arrives with its output"):
+      status, output = machine.execute("echo partial; exit 3")
+      assert (status, output) == (3, "partial\n"), (status, output)
+
+    with subtest("output resembling a frame header is not mistaken for one"):
+      output = machine.succeed("echo '7 0 5'; echo hello")
+      assert output == "7 0 5\nhello\n", output
+
+    with subtest("large output is read completely"):
+      output = machine.succeed("head -c 1000000 /dev/zero | tr '\\0' x")
+      assert output == "x" * 1000000, f"got {len(output)} characters"
+
+    with subtest("the shell stays in sync after a timeout"):
+      status, _ = machine.execute("sleep 10", timeout=1)
+      assert status == 124, status
+      assert machine.succeed("echo still here") == "still here\n"
+  '';
+}
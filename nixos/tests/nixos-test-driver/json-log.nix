@@ -0,0 +1,43 @@
+{
+  name = "nixos-test-driver.json-log";
+  nodes.machine = { };
+  extraDriverArgs = [
+    "--json-log"
+    "log.jsonl"
+  ];
+
+  testScript = ''
+    import json
+
+    def records():
+      lines = (driver.out_dir / "log.jsonl").read_text().splitlines(keepends=True)
+      # The last line may still be in the middle of being written
+      return [json.loads(line) for line in lines if line.endswith("\n")]
+
+    def logged(predicate):
+      def check(_last_try):
+        return any(predicate(record) for record in records())
+      retry(check, timeout=30)
+
+    machine.wait_for_unit("multi-user.target")
+
+    with subtest("subtests and nested blocks are logged with their duration"):
+      machine.succeed("true")
+      logged(lambda r: r["type"] == "subtest_start" and "their duration" in r["message"])
+      logged(
+        lambda r: r["type"] == "nested_end"
+        and r["message"] == "must succeed: true"
+        and r["status"] == "succeeded"
+        and r["duration"] >= 0
+        and r["machine"] == "machine"
+      )
+
+    with subtest("serial output is logged"):
+      machine.succeed("echo json-log-marker > /dev/console")
+      logged(lambda r: r["type"] == "serial" and "json-log-marker" in r["message"])
+
+    with subtest("control characters are removed"):
+      log.log("coloured \x1b[31mjson-log\x1b[0m message")
+      logged(lambda r: r["type"] == "log" and r["message"] == "coloured [31mjson-log[0m message")
+  '';
+}
@@ -0,0 +1,36 @@
+{
+  name = "nixos-test-driver.send-chars";
+  nodes = {
+    machine = {
+      services.getty.autologinUser = "root";
+    };
+    # USB keyboards only take one key event per poll, so typing must not
+    # send them bursts of keys. AArch64 machines have one anyway.
+    usb =
+      { lib, pkgs, ... }:
+      {
+        services.getty.autologinUser = "root";
+        virtualisation.qemu.options = lib.optionals pkgs.stdenv.hostPlatform.isx86 [
+          "-device usb-kbd,bus=usb-bus.0"
+        ];
+      };
+  };
+
+  testScript = ''
+    # Long enough for many batches of key events, with plenty of characters
+    # that need the shift key
+    text = "The Quick Brown Fox Jumps Over The Lazy Dog 0123456789 -=[];,./ _+{}:<>?|@#$%&*()~" * 4
+
+    start_all()
+
+    assert usb._has_usb_keyboard(), "the USB keyboard was not detected"
+
+    for m in [machine, usb]:
+      with subtest(f"characters typed on {m.name} arrive in order"):
+        m.wait_until_tty_matches("1", f"root@{m.name}")
+        m.send_chars(f"printf '%s\\n' '{text}' > /tmp/typing && mv /tmp/typing /tmp/typed\n")
+        m.wait_for_file("/tmp/typed")
+        typed = m.succeed("cat /tmp/typed")
+        assert typed == text + "\n", f"expected {text!r}, got {typed!r}"
+  '';
+}
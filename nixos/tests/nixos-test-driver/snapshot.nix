@@ -0,0 +1,56 @@
+{
+  name = "nixos-test-driver.snapshot";
+
+  nodes = {
+    machine =
+      { lib, ... }:
+      {
+        # QEMU cannot snapshot VMs with 9p file systems mounted
+        virtualisation.useNixStoreImage = true;
+        virtualisation.sharedDirectories = lib.mkForce { };
+      };
+    shared = { };
+  };
+
+  testScript = ''
+    start_all()
+    machine.wait_for_unit("multi-user.target")
+    machine.succeed("echo saved > /root/state")
+    machine.snapshot("clean")
+
+    with subtest("restoring brings back the saved state"):
+      machine.succeed("echo changed > /root/state")
+      machine.restore_snapshot("clean")
+      assert machine.succeed("cat /root/state").strip() == "saved"
+
+    with subtest("commands run after restoring repeatedly"):
+      for _ in range(3):
+        machine.succeed("touch /root/marker")
+        machine.restore_snapshot("clean")
+        machine.fail("test -e /root/marker")
+
+    with subtest("background commands fail when restoring"):
+      pending = machine.execute_async("sleep 600; echo never")
+      machine.restore_snapshot("clean")
+      try:
+        pending.result(timeout=30)
+      except Exception as e:
+        assert "snapshot restore" in str(e), str(e)
+      else:
+        raise Exception("a command lost by restoring a snapshot returned")
+      assert machine.succeed("echo alive") == "alive\n"
+      assert machine.execute_async("echo alive").result(timeout=30) == (0, "alive\n")
+
+    with subtest("subtests can start from a snapshot", restore="clean"):
+      assert machine.succeed("cat /root/state").strip() == "saved"
+
+    with subtest("machines with 9p file systems fail with a clear error"):
+      shared.wait_for_unit("multi-user.target")
+      try:
+        shared.snapshot("clean")
+      except Exception as e:
+        assert "9p" in str(e), str(e)
+      else:
+        raise Exception("snapshotting a machine with 9p mounts succeeded")
+  '';
+}
@@ -28,23 +28,49 @@ on the first iteration we calculate the file size and the checksum,
 and on the second one we actually stream the contents. 'add_layer_dir'
 function does all this.
 
+Since this reads and archives every file twice, '--spool-dir' can be
+used instead to write each layer tarball once to a temporary file there
+while calculating its checksum, and then copy that file into the outer
+tarball. This trades disk space for reading the store only once.
+
+Otherwise, the first iteration is pure CPU work that doesn't depend
+on the outer tarball, so with '--jobs' it is done ahead of time for all
+layers in parallel processes, while earlier layers are being streamed.
+
+Store paths never change, so with '--cache-dir' the checksums and sizes
+of layers are kept across runs, and only layers with new store paths
+need the first iteration at all.
+
+With '--format oci', the image is written in the OCI image layout [3]
+instead, where layers can be compressed ('--compression'). Blobs are
+named after the checksum of their compressed contents, so each layer is
+compressed once into a temporary file, in '--jobs' parallel threads,
+and the files are added to the outer tarball in order.
+
 [1]: https://github.com/moby/moby/blob/master/image/spec/v1.2.md
 [2]: https://github.com/moby/moby/blob/4fb59c20a4fb54f944fe170d0ff1d00eb4a24d6f/image/spec/v1.2.md#image-json-field-descriptions
+[3]: https://github.com/opencontainers/image-spec/blob/v1.1.0/image-layout.md
 """  # noqa: E501
 
 import argparse
+import gzip
 import io
 import os
 import re
 import sys
 import json
+import shutil
+import subprocess
 import hashlib
 import pathlib
 import tarfile
+import tempfile
 import itertools
 import threading
 from datetime import datetime, timezone
-from collections import namedtuple
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 
 
 def archive_paths_to(obj, paths, mtime, uid, gid, uname, gname):
@@ -111,16 +137,20 @@ def archive_paths_to(obj, paths, mtime, uid, gid, uname, gname):
 class ExtractChecksum:
     """
     A writable stream which only calculates the final file size and
-    sha256sum, while discarding the actual contents.
+    sha256sum, while discarding the actual contents, or passing them on
+    to 'obj' if given.
     """
 
-    def __init__(self):
+    def __init__(self, obj=None):
+        self._obj = obj
         self._digest = hashlib.sha256()
         self._size = 0
 
     def write(self, data):
         self._digest.update(data)
         self._size += len(data)
+        if self._obj is not None:
+            self._obj.write(data)
 
     def extract(self):
         """
@@ -129,9 +159,126 @@ class ExtractChecksum:
         return (self._digest.hexdigest(), self._size)
 
 
+def layer_checksum(paths, mtime, uid, gid, uname, gname):
+    """
+    Calculates the checksum and size of the layer tarball with the given
+    store paths, without keeping its contents.
+
+    Returns: Hex-encoded sha256sum and size as a tuple.
+    """
+    extract_checksum = ExtractChecksum()
+    archive_paths_to(extract_checksum, paths, mtime, uid, gid, uname, gname)
+    return extract_checksum.extract()
+
+
+class LayerChecksumCache:
+    """
+    An on-disk cache of the checksums and sizes of layer tarballs.
+
+    A layer tarball only depends on its store paths, which never change,
+    and on the file metadata applied to them, so both are part of the
+    key. So is the Python version, in case 'tarfile' changes how it
+    encodes headers. Every entry is a file, written atomically, so
+    concurrent runs can share the cache.
+    """
+
+    # Bump when 'archive_paths_to' produces different tarballs
+    VERSION = 2
+
+    def __init__(self, directory, mtime, uid, gid, uname, gname):
+        self._directory = pathlib.Path(directory)
+        self._metadata = [
+            self.VERSION,
+            list(sys.version_info[:2]),
+            mtime,
+            uid,
+            gid,
+            uname,
+            gname,
+        ]
+
+    def _entry(self, paths):
+        # The paths are archived in the given order, so a different order
+        # is a different tarball
+        key = json.dumps([list(paths), self._metadata]).encode("utf-8")
+        return self._directory / hashlib.sha256(key).hexdigest()
+
+    def get(self, paths):
+        """
+        Returns: Checksum and size of the layer tarball with the given
+                 store paths as a tuple, or 'None' if not cached.
+        """
+        try:
+            checksum, size = self._entry(paths).read_text().split()
+            return (checksum, int(size))
+        except (OSError, ValueError):
+            return None
+
+    def put(self, paths, checksum, size):
+        entry = self._entry(paths)
+        if entry.exists():
+            return
+        try:
+            self._directory.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                "w", dir=self._directory, delete=False
+            ) as f:
+                f.write(f"{checksum} {size}\n")
+            os.replace(f.name, entry)
+        except OSError as e:
+            print("Could not cache layer checksum:", e, file=sys.stderr)
+
+
+def precompute_checksums(
+    store_layers, jobs, cache, mtime, uid, gid, uname, gname
+):
+    """
+    Calculates the checksums and sizes of the layer tarballs of all
+    'store_layers' that are not in 'cache' in 'jobs' parallel processes.
+
+    Yields: Each layer with its checksum and size as a tuple, in order and
+            as soon as it is known. With a single job, the checksum and
+            size of uncached layers are 'None', so 'add_layer_dir'
+            calculates them instead.
+    """
+    cached = [
+        cache.get(paths) if cache is not None else None
+        for paths in store_layers
+    ]
+    if jobs <= 1 or all(cached):
+        yield from zip(store_layers, cached)
+        return
+
+    executor = ProcessPoolExecutor(max_workers=jobs)
+    try:
+        futures = [
+            executor.submit(
+                layer_checksum, paths, mtime, uid, gid, uname, gname
+            )
+            if checksum is None
+            else None
+            for paths, checksum in zip(store_layers, cached)
+        ]
+        for paths, checksum, future in zip(store_layers, cached, futures):
+            yield (paths, checksum if future is None else future.result())
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
 FromImage = namedtuple("FromImage", ["tar", "manifest_json", "image_json"])
 # Some metadata for a layer
 LayerInfo = namedtuple("LayerInfo", ["size", "checksum", "path", "paths"])
+# Some metadata for a layer of an OCI image, where 'checksum' is the one
+# of the uncompressed layer tarball and 'digest' the one of the blob
+BlobInfo = namedtuple(
+    "BlobInfo", ["size", "digest", "checksum", "media_type", "paths"]
+)
+
+OCI_LAYER_MEDIA_TYPES = {
+    "none": "application/vnd.oci.image.layer.v1.tar",
+    "gz": "application/vnd.oci.image.layer.v1.tar+gzip",
+    "zstd": "application/vnd.oci.image.layer.v1.tar+zstd",
+}
 
 
 def load_from_image(from_image_str):
@@ -210,7 +357,20 @@ def overlay_base_config(from_image, final_config):
     return final_config
 
 
-def add_layer_dir(tar, paths, store_dir, mtime, uid, gid, uname, gname):
+def add_layer_dir(
+    tar,
+    paths,
+    store_dir,
+    mtime,
+    uid,
+    gid,
+    uname,
+    gname,
+    spool_dir=None,
+    checksum=None,
+    size=None,
+    cache=None,
+):
     """
     Appends given store paths to a TarFile object as a new layer.
 
@@ -219,6 +379,12 @@ def add_layer_dir(tar, paths, store_dir, mtime, uid, gid, uname, gname):
     store_dir: the root directory of the nix store
     mtime: 'mtime' of the added files and the layer tarball.
            Should be an integer representing a POSIX time.
+    spool_dir: If set, archive the paths only once into a temporary file
+               in this directory, instead of archiving them twice.
+    checksum: Checksum of the layer tarball, if already known.
+    size: Size of the layer tarball, if already known.
+    cache: 'LayerChecksumCache' to look up the checksum and size in, and
+           to add them to.
 
     Returns: A 'LayerInfo' object containing some metadata of
              the layer added.
@@ -229,10 +395,37 @@ def add_layer_dir(tar, paths, store_dir, mtime, uid, gid, uname, gname):
         len(invalid_paths) == 0
     ), f"Expecting absolute paths from {store_dir}, but got: {invalid_paths}"
 
+    if checksum is None and cache is not None:
+        (checksum, size) = cache.get(paths) or (None, None)
+
+    # With a known checksum, there is nothing to gain from spooling
+    if spool_dir is not None and checksum is None:
+        with tempfile.TemporaryFile(dir=spool_dir) as spool:
+            extract_checksum = ExtractChecksum(spool)
+            archive_paths_to(
+                extract_checksum, paths, mtime, uid, gid, uname, gname
+            )
+            (checksum, size) = extract_checksum.extract()
+
+            path = f"{checksum}/layer.tar"
+            layer_tarinfo = tarfile.TarInfo(path)
+            layer_tarinfo.size = size
+            layer_tarinfo.mtime = mtime
+
+            spool.seek(0)
+            tar.addfile(layer_tarinfo, spool)
+
+        if cache is not None:
+            cache.put(paths, checksum, size)
+        return LayerInfo(size=size, checksum=checksum, path=path, paths=paths)
+
     # First, calculate the tarball checksum and the size.
-    extract_checksum = ExtractChecksum()
-    archive_paths_to(extract_checksum, paths, mtime, uid, gid, uname, gname)
-    (checksum, size) = extract_checksum.extract()
+    if checksum is None:
+        (checksum, size) = layer_checksum(
+            paths, mtime, uid, gid, uname, gname
+        )
+    if cache is not None:
+        cache.put(paths, checksum, size)
 
     path = f"{checksum}/layer.tar"
     layer_tarinfo = tarfile.TarInfo(path)
@@ -307,6 +500,275 @@ def add_bytes(tar, path, content, mtime):
     tar.addfile(ti, io.BytesIO(content))
 
 
+def image_json_bytes(conf, from_image, created, checksums, paths):
+    """
+    Returns: The image configuration JSON, encoded, for layers with the
+             given (uncompressed) checksums, containing the given paths.
+    """
+    image_json = {
+        "created": datetime.isoformat(created),
+        "architecture": conf["architecture"],
+        "os": "linux",
+        "config": overlay_base_config(from_image, conf["config"]),
+        "rootfs": {
+            "diff_ids": [f"sha256:{checksum}" for checksum in checksums],
+            "type": "layers",
+        },
+        "history": [
+            {
+                "created": datetime.isoformat(created),
+                "comment": f"store paths: {layer_paths}",
+            }
+            for layer_paths in paths
+        ],
+    }
+    return json.dumps(image_json, indent=4).encode("utf-8")
+
+
+def compress_layer(write_layer, compression, spool_dir):
+    """
+    Writes a layer tarball to a temporary file, compressed with the given
+    method, while calculating the checksum of the uncompressed tarball.
+
+    write_layer: Function writing the layer tarball to the given stream.
+    compression: Key of 'OCI_LAYER_MEDIA_TYPES'.
+    spool_dir: Directory of the temporary file, the default if 'None'.
+
+    Returns: The rewound temporary file and a 'BlobInfo' object without
+             paths as a tuple.
+    """
+    spool = tempfile.TemporaryFile(dir=spool_dir)
+    try:
+        if compression == "zstd":
+            # zstd writes straight to the temporary file
+            zstd = subprocess.Popen(
+                ["zstd", "--quiet", "--stdout"],
+                stdin=subprocess.PIPE,
+                stdout=spool,
+            )
+            with zstd.stdin:
+                extract_checksum = ExtractChecksum(zstd.stdin)
+                write_layer(extract_checksum)
+            if zstd.wait() != 0:
+                raise RuntimeError(f"zstd failed with {zstd.returncode}")
+        elif compression == "gz":
+            with gzip.GzipFile(
+                fileobj=spool, mode="wb", compresslevel=6, mtime=0
+            ) as gz:
+                extract_checksum = ExtractChecksum(gz)
+                write_layer(extract_checksum)
+        else:
+            extract_checksum = ExtractChecksum(spool)
+            write_layer(extract_checksum)
+        (checksum, size) = extract_checksum.extract()
+
+        if compression == "none":
+            digest = checksum
+        else:
+            spool.seek(0)
+            digest = hashlib.file_digest(spool, "sha256").hexdigest()
+            size = spool.tell()
+        spool.seek(0)
+    except BaseException:
+        spool.close()
+        raise
+
+    media_type = OCI_LAYER_MEDIA_TYPES[compression]
+    return (spool, BlobInfo(size, digest, checksum, media_type, None))
+
+
+def copy_file_to(obj, path):
+    with open(path, "rb") as f:
+        shutil.copyfileobj(f, obj)
+
+
+def ordered_map(executor, fn, items, window):
+    """
+    Like 'executor.map', but only runs up to 'window' items ahead of the
+    one whose result was yielded last.
+    """
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) > window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def add_oci_image(
+    tar,
+    conf,
+    from_image,
+    repo_tag,
+    created,
+    mtime,
+    uid,
+    gid,
+    uname,
+    gname,
+    compression,
+    jobs,
+    spool_dir,
+):
+    """
+    Adds an image in the OCI image layout to a TarFile object.
+
+    compression: Key of 'OCI_LAYER_MEDIA_TYPES' to compress layers with.
+    jobs: Number of layers to compress in parallel.
+    spool_dir: Directory for compressed layers, the default if 'None'.
+    Other arguments are the same as in 'main'.
+    """
+    layers = []
+
+    def add_blob(spool, info, paths):
+        with spool:
+            ti = tarfile.TarInfo(f"blobs/sha256/{info.digest}")
+            ti.size = info.size
+            ti.mtime = mtime
+            tar.addfile(ti, spool)
+        layers.append(info._replace(paths=paths))
+
+    def add_json(value):
+        content = json.dumps(value, indent=4).encode("utf-8")
+        digest = hashlib.sha256(content).hexdigest()
+        add_bytes(tar, f"blobs/sha256/{digest}", content, mtime=mtime)
+        return {"digest": f"sha256:{digest}", "size": len(content)}
+
+    if from_image is None:
+        print("No 'fromImage' provided", file=sys.stderr)
+    else:
+        # Members of the base image can only be read one after another
+        for num, layer in enumerate(
+            from_image.manifest_json[0]["Layers"], start=1
+        ):
+            print("Adding base layer", num, "from", layer, file=sys.stderr)
+            member = from_image.tar.extractfile(layer)
+            write_layer = partial(shutil.copyfileobj, member)
+            add_blob(
+                *compress_layer(write_layer, compression, spool_dir), [layer]
+            )
+        from_image.tar.close()
+
+    store_dir = conf["store_dir"]
+    invalid_paths = [
+        path
+        for store_layer in conf["store_layers"]
+        for path in store_layer
+        if not path.startswith(store_dir)
+    ]
+    assert (
+        len(invalid_paths) == 0
+    ), f"Expecting absolute paths from {store_dir}, but got: {invalid_paths}"
+
+    sources = [
+        (
+            partial(
+                archive_paths_to,
+                paths=store_layer,
+                mtime=mtime,
+                uid=uid,
+                gid=gid,
+                uname=uname,
+                gname=gname,
+            ),
+            store_layer,
+        )
+        for store_layer in conf["store_layers"]
+    ]
+    customisation_layer = conf["customisation_layer"]
+    sources.append(
+        (
+            partial(
+                copy_file_to,
+                path=os.path.join(customisation_layer, "layer.tar"),
+            ),
+            [customisation_layer],
+        )
+    )
+
+    def compress(source):
+        (write_layer, paths) = source
+        return (*compress_layer(write_layer, compression, spool_dir), paths)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for spool, info, paths in ordered_map(
+            executor, compress, sources, 2 * jobs
+        ):
+            print(
+                "Adding layer",
+                len(layers) + 1,
+                "from paths:",
+                paths,
+                file=sys.stderr,
+            )
+            add_blob(spool, info, paths)
+
+    print("Adding manifests...", file=sys.stderr)
+
+    image_json = image_json_bytes(
+        conf,
+        from_image,
+        created,
+        [layer.checksum for layer in layers],
+        [layer.paths for layer in layers],
+    )
+    image_json_digest = hashlib.sha256(image_json).hexdigest()
+    add_bytes(
+        tar, f"blobs/sha256/{image_json_digest}", image_json, mtime=mtime
+    )
+
+    manifest = add_json(
+        {
+            "schemaVersion": 2,
+            "mediaType": "application/vnd.oci.image.manifest.v1+json",
+            "config": {
+                "mediaType": "application/vnd.oci.image.config.v1+json",
+                "digest": f"sha256:{image_json_digest}",
+                "size": len(image_json),
+            },
+            "layers": [
+                {
+                    "mediaType": layer.media_type,
+                    "digest": f"sha256:{layer.digest}",
+                    "size": layer.size,
+                }
+                for layer in layers
+            ],
+        }
+    )
+
+    # The reference name is just the tag, 'io.containerd.image.name' (used
+    # by e.g. 'docker load') the full name
+    tag = repo_tag.rsplit("/", 1)[-1].partition(":")[2] or "latest"
+    index = {
+        "schemaVersion": 2,
+        "mediaType": "application/vnd.oci.image.index.v1+json",
+        "manifests": [
+            {
+                "mediaType": "application/vnd.oci.image.manifest.v1+json",
+                **manifest,
+                "annotations": {
+                    "io.containerd.image.name": repo_tag,
+                    "org.opencontainers.image.ref.name": tag,
+                },
+            }
+        ],
+    }
+    add_bytes(
+        tar,
+        "index.json",
+        json.dumps(index, indent=4).encode("utf-8"),
+        mtime=mtime,
+    )
+    add_bytes(
+        tar,
+        "oci-layout",
+        json.dumps({"imageLayoutVersion": "1.0.0"}).encode("utf-8"),
+        mtime=mtime,
+    )
+
+
 now = datetime.now(tz=timezone.utc)
 
 
@@ -346,8 +808,57 @@ Docker Image Specification v1.2 as reference [1].
         "--repo_tag", "-t", type=str,
         help="Override the RepoTags from the configuration"
     )
+    arg_parser.add_argument(
+        "--spool-dir", type=str,
+        help="""
+        Archive each layer only once, into a temporary file in this
+        directory, instead of archiving it twice to learn its checksum.
+        Needs as much free space as the largest layer.
+    """,
+    )
+    arg_parser.add_argument(
+        "--jobs", "-j", type=int, default=1,
+        help="""
+        Number of processes calculating the checksums of layers ahead of
+        time, while earlier layers are streamed. Not used with
+        '--spool-dir'. With '--format oci', the number of layers
+        compressed in parallel.
+    """,
+    )
+    arg_parser.add_argument(
+        "--cache-dir", type=str,
+        help="""
+        Directory to keep the checksums and sizes of layers in, so they
+        only have to be calculated once for the same store paths. Not
+        supported with '--format oci'.
+    """,
+    )
+
+    arg_parser.add_argument(
+        "--format", choices=["docker", "oci"], default="docker",
+        help="""
+        Write a Docker image archive, or an OCI image layout as tarball.
+    """,
+    )
+    arg_parser.add_argument(
+        "--compression", choices=list(OCI_LAYER_MEDIA_TYPES),
+        default="none",
+        help="""
+        Compression of the layers, only supported with '--format oci'.
+        'zstd' runs the zstd command, which must be on PATH.
+        Compressed layers are written to temporary files in '--spool-dir'
+        (or the default temporary directory) first.
+    """,
+    )
 
     args = arg_parser.parse_args()
+    if args.format != "oci" and args.compression != "none":
+        arg_parser.error("--compression needs '--format oci'")
+    if args.format == "oci" and args.cache_dir is not None:
+        arg_parser.error("--cache-dir is not supported with '--format oci'")
+    # zstd is only needed for this, so it is not part of the closure
+    if args.compression == "zstd" and shutil.which("zstd") is None:
+        arg_parser.error("--compression zstd needs the zstd command on PATH")
     with open(args.conf, "r") as f:
         conf = json.load(f)
 
@@ -361,12 +872,45 @@ Docker Image Specification v1.2 as reference [1].
 
     from_image = load_from_image(conf["from_image"])
 
+    if args.format == "oci":
+        with tarfile.open(mode="w|", fileobj=sys.stdout.buffer) as tar:
+            add_oci_image(
+                tar,
+                conf,
+                from_image,
+                args.repo_tag or conf["repo_tag"],
+                created,
+                mtime,
+                uid,
+                gid,
+                uname,
+                gname,
+                compression=args.compression,
+                jobs=args.jobs,
+                spool_dir=args.spool_dir,
+            )
+        print("Done.", file=sys.stderr)
+        return
+
+    cache = None
+    if args.cache_dir is not None:
+        cache = LayerChecksumCache(
+            args.cache_dir, mtime, uid, gid, uname, gname
+        )
+
     with tarfile.open(mode="w|", fileobj=sys.stdout.buffer) as tar:
         layers = []
         layers.extend(add_base_layers(tar, from_image))
 
         start = len(layers) + 1
-        for num, store_layer in enumerate(conf["store_layers"], start=start):
+        jobs = args.jobs if args.spool_dir is None else 1
+        store_layers = precompute_checksums(
+            conf["store_layers"], jobs, cache, mtime, uid, gid, uname, gname
+        )
+        for num, (store_layer, known) in enumerate(
+            store_layers, start=start
+        ):
+            (checksum, size) = known or (None, None)
             print(
                 "Creating layer",
                 num,
@@ -375,7 +919,11 @@ Docker Image Specification v1.2 as reference [1].
                 file=sys.stderr,
             )
             info = add_layer_dir(
-                tar, store_layer, store_dir, mtime, uid, gid, uname, gname
+                tar, store_layer, store_dir, mtime, uid, gid, uname, gname,
+                spool_dir=args.spool_dir,
+                checksum=checksum,
+                size=size,
+                cache=cache,
             )
             layers.append(info)
 
@@ -393,25 +941,13 @@ Docker Image Specification v1.2 as reference [1].
 
         print("Adding manifests...", file=sys.stderr)
 
-        image_json = {
-            "created": datetime.isoformat(created),
-            "architecture": conf["architecture"],
-            "os": "linux",
-            "config": overlay_base_config(from_image, conf["config"]),
-            "rootfs": {
-                "diff_ids": [f"sha256:{layer.checksum}" for layer in layers],
-                "type": "layers",
-            },
-            "history": [
-                {
-                    "created": datetime.isoformat(created),
-                    "comment": f"store paths: {layer.paths}",
-                }
-                for layer in layers
-            ],
-        }
-
-        image_json = json.dumps(image_json, indent=4).encode("utf-8")
+        image_json = image_json_bytes(
+            conf,
+            from_image,
+            created,
+            [layer.checksum for layer in layers],
+            [layer.paths for layer in layers],
+        )
         image_json_checksum = hashlib.sha256(image_json).hexdigest()
         image_json_path = f"{image_json_checksum}.json"
         add_bytes(tar, image_json_path, image_json, mtime=mtime)
@@ -112,6 +112,8 @@
 
 import sys
 import json
+import random
+import time
 import unittest
 
 from pprint import pprint
@@ -501,6 +503,137 @@ class TestOrderByPopularity(unittest.TestCase):
             ]
         )
 
+# Calculate the same popularity as graph_popularity_contest does for the
+# full graph of all roots, without building that graph.
+#
+# Unrolling the recursion of graph_popularity_contest, the popularity of
+# a path X is:
+#
+#     chains(X) + sum(chains(M) for M in ancestors(X))
+#
+# where chains(M) is the number of distinct chains of references from
+# any root to M (1 for a root), and ancestors(X) is the set of paths which
+# transitively refer to X. In the example at the top, F is reached by 3
+# chains (via D, via C - E and via B - E) and its ancestors A, B, C, D, E
+# are reached by 1, 1, 1, 1 and 2 chains, so its popularity is 3 + 6 = 9.
+#
+# Paths are numbered and visited in topological order, so both the chain
+# counts and the ancestors (as bitsets in Python ints) are propagated from
+# each path to its references in a single pass. Summing the chain counts
+# over a set of ancestors is then done per bit of the chain counts, by
+# counting the ancestors whose chain count has that bit set.
+def popularity_contest(closures):
+    lookup = make_lookup(closures)
+
+    ids = {}
+    for path, references in lookup.items():
+        ids.setdefault(path, len(ids))
+        for reference in references:
+            ids.setdefault(reference, len(ids))
+    names = list(ids)
+
+    children = [[] for _ in names]
+    parents = [0] * len(names)
+    for path, references in lookup.items():
+        for reference in dict.fromkeys(references):
+            children[ids[path]].append(ids[reference])
+            parents[ids[reference]] += 1
+
+    order = [node for node, count in enumerate(parents) if count == 0]
+    chains = [1 if count == 0 else 0 for count in parents]
+    ancestors = [0] * len(names)
+    # Grows while iterating, each path is appended once all of the paths
+    # referring to it have been visited
+    for node in order:
+        node_ancestors = ancestors[node] | (1 << node)
+        for child in children[node]:
+            chains[child] += chains[node]
+            ancestors[child] |= node_ancestors
+            parents[child] -= 1
+            if parents[child] == 0:
+                order.append(child)
+
+    debug("Summing chains of {} paths", len(order))
+    # Bitsets of the paths whose chain count has a given bit set
+    bits = max((chains[node].bit_length() for node in order), default=0)
+    masks = [
+        int("".join(str(count >> bit & 1) for count in reversed(chains)), 2)
+        for bit in range(bits)
+    ]
+
+    popularity = {}
+    for node in order:
+        popularity[names[node]] = chains[node] + sum(
+            (ancestors[node] & mask).bit_count() << bit
+            for bit, mask in enumerate(masks)
+        )
+    return popularity
+
+class TestPopularityContest(unittest.TestCase):
+    def test_counts_popularity(self):
+        # The example at the top
+        self.assertDictEqual(
+            popularity_contest([
+                {"path": "A", "references": ["A", "B", "G"]},
+                {"path": "B", "references": ["B", "C", "E"]},
+                {"path": "C", "references": ["C", "D", "E"]},
+                {"path": "D", "references": ["D", "F"]},
+                {"path": "E", "references": ["E", "F"]},
+                {"path": "F", "references": ["F"]},
+                {"path": "G", "references": ["G"]},
+            ]),
+            {"A": 1, "B": 2, "C": 3, "D": 4, "E": 5, "F": 9, "G": 2}
+        )
+
+    def test_matches_graph_popularity_contest(self):
+        rng = random.Random(0)
+        for size in [1, 2, 10, 50, 200]:
+            closures = synthetic_closures(size, rng)
+            self.assertDictEqual(
+                popularity_contest(closures),
+                full_graph_popularity_contest(closures)
+            )
+
+# The popularity contest of the full graph of all roots, the way main
+# used to calculate it. Way slower than popularity_contest, but the
+# reference for it.
+def full_graph_popularity_contest(closures):
+    # Both functions cache their results per path
+    subgraphs_cache.clear()
+    popularity_cache.clear()
+
+    lookup = make_lookup(closures)
+    full_graph = {}
+    for root in find_roots(closures):
+        full_graph[root] = make_graph_segment_from_root(root, lookup)
+    return graph_popularity_contest(full_graph)
+
+# Generate a closure of `size` paths which looks roughly like a real
+# one: few applications at the top, referring to libraries, which mostly
+# refer to a small number of very popular paths (like glibc) at the
+# bottom.
+def synthetic_closures(size, rng):
+    paths = [
+        "/nix/store/{:032x}-package-{}".format(rng.getrandbits(128), i)
+        for i in range(size)
+    ]
+    popular = max(1, size // 100)
+    closures = []
+    for i, path in enumerate(paths):
+        # Paths only refer to paths after them, so there are no cycles
+        candidates = range(i + 1, size)
+        references = set(rng.sample(
+            candidates,
+            min(len(candidates), rng.randint(0, 8))
+        ))
+        if i < size - popular:
+            references.add(rng.randrange(size - popular, size))
+        closures.append({
+            "path": path,
+            "references": [path] + [paths[j] for j in sorted(references)],
+        })
+    return closures
+
 def package_name(path):
     parts = path.split('-')
     start = parts.pop(0)
@@ -537,31 +670,44 @@ def main():
     # ]
     graph = data[key]
 
-    debug("Finding roots from {}", key)
-    roots = find_roots(graph);
-    debug("Making lookup for {}", key)
-    lookup = make_lookup(graph)
-
-    full_graph = {}
-    for root in roots:
-        debug("Making full graph for {}", root)
-        full_graph[root] = make_graph_segment_from_root(root, lookup)
-
-    debug("Running contest")
-    contest = graph_popularity_contest(full_graph)
+    debug("Running contest for {}", key)
+    contest = popularity_contest(graph)
     debug("Ordering by popularity")
     ordered = order_by_popularity(contest)
     debug("Checking for missing paths")
+    seen = set(ordered)
     missing = []
     for path in all_paths(graph):
-        if path not in ordered:
+        if path not in seen:
             missing.append(path)
 
     ordered.extend(missing)
     print("\n".join(ordered))
 
+# Time popularity_contest (and the full graph contest, for closures small
+# enough for it to finish in reasonable time) on synthetic closures:
+#
+#     python3 ./closure-graph.py --benchmark
+def benchmark():
+    rng = random.Random(0)
+    for size in [1000, 2000, 5000, 10000, 20000]:
+        closures = synthetic_closures(size, rng)
+        contests = [popularity_contest]
+        if size <= 2000:
+            contests.append(full_graph_popularity_contest)
+        for contest in contests:
+            start = time.perf_counter()
+            contest(closures)
+            print("{:>6} paths  {:<30} {:8.3f}s".format(
+                size,
+                contest.__name__,
+                time.perf_counter() - start
+            ))
+
 if "--test" in sys.argv:
     # Don't pass --test otherwise unittest gets mad
     unittest.main(argv = [f for f in sys.argv if f != "--test" ])
+elif "--benchmark" in sys.argv:
+    benchmark()
 else:
     main()
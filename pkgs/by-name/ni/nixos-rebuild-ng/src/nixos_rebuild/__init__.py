@@ -3,6 +3,8 @@ import json
 import logging
 import os
 import sys
+from collections.abc import Callable
+from dataclasses import replace
 from pathlib import Path
 from subprocess import CalledProcessError, run
 from typing import assert_never
@@ -10,7 +12,7 @@ from typing import assert_never
 from . import nix, tmpdir
 from .constants import EXECUTABLE, WITH_NIX_2_18, WITH_REEXEC, WITH_SHELL_FILES
 from .models import Action, BuildAttr, Flake, ImageVariants, NRError, Profile
-from .process import Remote, cleanup_ssh
+from .process import Remote, cleanup_ssh, ensure_ssh_master
 from .utils import Args, LogFormatter, tabulate
 
 logger = logging.getLogger()
@@ -178,7 +180,34 @@ def get_parser() -> tuple[argparse.ArgumentParser, dict[str, argparse.ArgumentPa
     )
     main_parser.add_argument("--build-host", help="Specifies host to perform the build")
     main_parser.add_argument(
-        "--target-host", help="Specifies host to activate the configuration"
+        "--pipeline-copy",
+        action="store_true",
+        help="Copy paths from --build-host to the target while the build is "
+        + "still running",
+    )
+    main_parser.add_argument(
+        "--eval-cache",
+        action="store_true",
+        help="Reuse the evaluation of an unchanged flake when using --build-host",
+    )
+    main_parser.add_argument(
+        "--target-host",
+        action="append",
+        help="Specifies host to activate the configuration, "
+        + "can be given multiple times to deploy to many hosts",
+    )
+    main_parser.add_argument(
+        "--max-parallel-hosts",
+        type=int,
+        default=8,
+        help="Maximum number of hosts to copy to or activate concurrently "
+        + "when deploying to many target hosts",
+    )
+    main_parser.add_argument(
+        "--activation-batch-size",
+        type=int,
+        help="Number of hosts to activate at a time when deploying to many "
+        + "target hosts, defaults to --max-parallel-hosts",
     )
     main_parser.add_argument("--no-build-nix", action="store_true", help="Deprecated")
     main_parser.add_argument(
@@ -246,10 +275,31 @@ def parse_args(
     if args.no_build_nix:
         parser_warn("--no-build-nix is deprecated, we do not build nix anymore")
 
+    args.target_hosts = args.target_host or []
+    args.target_host = args.target_hosts[0] if len(args.target_hosts) == 1 else None
+
+    if len(args.target_hosts) > 1:
+        if args.action not in (
+            Action.SWITCH.value,
+            Action.BOOT.value,
+            Action.TEST.value,
+            Action.DRY_ACTIVATE.value,
+        ):
+            parser.error(
+                f"multiple --target-host are not supported with '{args.action}'"
+            )
+        if args.rollback:
+            parser.error("multiple --target-host are not supported with --rollback")
+
+    if args.max_parallel_hosts < 1:
+        parser.error("--max-parallel-hosts must be at least 1")
+    if args.activation_batch_size is not None and args.activation_batch_size < 1:
+        parser.error("--activation-batch-size must be at least 1")
+
     if args.action == Action.EDIT.value and (args.file or args.attr):
         parser.error("--file and --attr are not supported with 'edit'")
 
-    if (args.target_host or args.build_host) and args.action not in (
+    if (args.target_hosts or args.build_host) and args.action not in (
         Action.SWITCH.value,
         Action.BOOT.value,
         Action.TEST.value,
@@ -258,6 +308,7 @@ def parse_args(
         Action.DRY_ACTIVATE.value,
         Action.BUILD_VM.value,
         Action.BUILD_VM_WITH_BOOTLOADER.value,
+        Action.LIST_GENERATIONS.value,
     ):
         parser.error(
             f"--target-host/--build-host is not supported with '{args.action}'"
@@ -364,6 +415,9 @@ def execute(argv: list[str]) -> None:
     profile = Profile.from_arg(args.profile_name)
     target_host = Remote.from_arg(args.target_host, args.ask_sudo_password)
     build_host = Remote.from_arg(args.build_host, False, validate_opts=False)
+    for remote in (build_host, target_host):
+        if remote:
+            ensure_ssh_master(remote)
     build_attr = BuildAttr.from_arg(args.attr, args.file)
     flake = Flake.from_arg(args.flake, target_host)
 
@@ -421,6 +475,65 @@ def execute(argv: list[str]) -> None:
                 case _:
                     attr = "config.system.build.toplevel"
 
+            # With several target hosts, the closure is copied to each of
+            # them once the build is done
+            pipeline_copy = args.pipeline_copy and len(args.target_hosts) <= 1
+
+            def build_system(flake: Flake | None) -> Path:
+                match (build_host, flake):
+                    case (Remote(_), Flake(_)):
+                        return nix.build_remote_flake(
+                            attr,
+                            flake,
+                            build_host,
+                            eval_flags=flake_common_flags,
+                            flake_build_flags=flake_build_flags
+                            | {"no_link": no_link, "dry_run": dry_run},
+                            copy_flags=copy_flags,
+                            use_eval_cache=args.eval_cache,
+                            pipeline_copy=pipeline_copy,
+                            target_host=target_host,
+                        )
+                    case (None, Flake(_)):
+                        return nix.build_flake(
+                            attr,
+                            flake,
+                            flake_build_flags=flake_build_flags
+                            | {"no_link": no_link, "dry_run": dry_run},
+                        )
+                    case (Remote(_), None):
+                        return nix.build_remote(
+                            attr,
+                            build_attr,
+                            build_host,
+                            realise_flags=common_flags,
+                            instantiate_flags=build_flags,
+                            copy_flags=copy_flags,
+                            pipeline_copy=pipeline_copy,
+                            target_host=target_host,
+                        )
+                    case (None, None):
+                        return nix.build(
+                            attr,
+                            build_attr,
+                            build_flags=build_flags
+                            | {"no_out_link": no_link, "dry_run": dry_run},
+                        )
+                    case never:
+                        # should never happen, but mypy is not smart enough to
+                        # handle this with assert_never
+                        # https://github.com/python/mypy/issues/16650
+                        # https://github.com/python/mypy/issues/16722
+                        raise AssertionError(
+                            f"expected code to be unreachable, but got: {never}"
+                        )
+
+            if len(args.target_hosts) > 1:
+                deploy_fleet(
+                    args, action, profile, build_system, build_host, copy_flags
+                )
+                return
+
             match (action, rollback, build_host, flake):
                 case (Action.SWITCH | Action.BOOT, True, _, _):
                     path_to_config = nix.rollback(profile, target_host, sudo=args.sudo)
@@ -436,47 +549,8 @@ def execute(argv: list[str]) -> None:
                         raise NRError("could not find previous generation")
                 case (_, True, _, _):
                     raise NRError(f"--rollback is incompatible with '{action}'")
-                case (_, False, Remote(_), Flake(_)):
-                    path_to_config = nix.build_remote_flake(
-                        attr,
-                        flake,
-                        build_host,
-                        eval_flags=flake_common_flags,
-                        flake_build_flags=flake_build_flags
-                        | {"no_link": no_link, "dry_run": dry_run},
-                        copy_flags=copy_flags,
-                    )
-                case (_, False, None, Flake(_)):
-                    path_to_config = nix.build_flake(
-                        attr,
-                        flake,
-                        flake_build_flags=flake_build_flags
-                        | {"no_link": no_link, "dry_run": dry_run},
-                    )
-                case (_, False, Remote(_), None):
-                    path_to_config = nix.build_remote(
-                        attr,
-                        build_attr,
-                        build_host,
-                        realise_flags=common_flags,
-                        instantiate_flags=build_flags,
-                        copy_flags=copy_flags,
-                    )
-                case (_, False, None, None):
-                    path_to_config = nix.build(
-                        attr,
-                        build_attr,
-                        build_flags=build_flags
-                        | {"no_out_link": no_link, "dry_run": dry_run},
-                    )
-                case never:
-                    # should never happen, but mypy is not smart enough to
-                    # handle this with assert_never
-                    # https://github.com/python/mypy/issues/16650
-                    # https://github.com/python/mypy/issues/16722
-                    raise AssertionError(
-                        f"expected code to be unreachable, but got: {never}"
-                    )
+                case _:
+                    path_to_config = build_system(flake)
 
             if not rollback:
                 nix.copy_closure(
@@ -485,13 +559,6 @@ def execute(argv: list[str]) -> None:
                     from_host=build_host,
                     copy_flags=copy_flags,
                 )
-                if action in (Action.SWITCH, Action.BOOT):
-                    nix.set_profile(
-                        profile,
-                        path_to_config,
-                        target_host=target_host,
-                        sudo=args.sudo,
-                    )
 
             # Print only the result to stdout to make it easier to script
             def print_result(msg: str, result: str | Path) -> None:
@@ -507,6 +574,11 @@ def execute(argv: list[str]) -> None:
                         sudo=args.sudo,
                         specialisation=args.specialisation,
                         install_bootloader=args.install_bootloader,
+                        profile=(
+                            profile
+                            if not rollback and action in (Action.SWITCH, Action.BOOT)
+                            else None
+                        ),
                     )
                     print_result("Done. The new configuration is", path_to_config)
                 case Action.BUILD:
@@ -528,7 +600,7 @@ def execute(argv: list[str]) -> None:
             raise AssertionError("DRY_RUN should be a DRY_BUILD alias")
 
         case Action.LIST_GENERATIONS:
-            generations = nix.list_generations(profile)
+            generations = nix.list_generations(profile, target_host)
             if args.json:
                 print(json.dumps(generations, indent=2))
             else:
@@ -553,6 +625,80 @@ def execute(argv: list[str]) -> None:
             assert_never(action)
 
 
+def deploy_fleet(
+    args: argparse.Namespace,
+    action: Action,
+    profile: Profile,
+    build_system: Callable[[Flake | None], Path],
+    build_host: Remote | None,
+    copy_flags: Args,
+) -> None:
+    from concurrent.futures import ThreadPoolExecutor
+
+    from . import fleet
+
+    # Ask for the sudo password only once, it is used for all hosts
+    first_host = Remote.from_arg(args.target_hosts[0], args.ask_sudo_password)
+    assert first_host is not None
+    target_hosts = [replace(first_host, host=host) for host in args.target_hosts]
+
+    def activate(path_to_config: Path, target_host: Remote) -> None:
+        match action:
+            case Action.SWITCH | Action.BOOT | Action.TEST | Action.DRY_ACTIVATE:
+                nix.switch_to_configuration(
+                    path_to_config,
+                    action,
+                    target_host=target_host,
+                    sudo=args.sudo,
+                    specialisation=args.specialisation,
+                    install_bootloader=args.install_bootloader,
+                    profile=(
+                        profile if action in (Action.SWITCH, Action.BOOT) else None
+                    ),
+                )
+            case _:
+                raise AssertionError(f"cannot activate with '{action}'")
+
+    # Without an explicit attribute, each host's own hostname selects the
+    # flake configuration, which needs a round trip to every host
+    with ThreadPoolExecutor(max_workers=args.max_parallel_hosts) as executor:
+        flakes = list(
+            executor.map(lambda h: Flake.from_arg(args.flake, h), target_hosts)
+        )
+
+    results = fleet.deploy(
+        list(zip(target_hosts, flakes, strict=True)),
+        build_system,
+        activate,
+        build_host=build_host,
+        copy_flags=copy_flags,
+        max_parallel=args.max_parallel_hosts,
+        batch_size=args.activation_batch_size,
+    )
+    print(
+        tabulate(
+            [
+                {
+                    "host": r.host,
+                    "configuration": r.path or "",
+                    "result": r.status,
+                    "error": r.error,
+                }
+                for r in results
+            ],
+            headers={
+                "host": "Host",
+                "configuration": "Configuration",
+                "result": "Result",
+                "error": "Error",
+            },
+        )
+    )
+
+    if failed := sum(r.status != "ok" for r in results):
+        raise NRError(f"deployment did not succeed on {failed} of {len(results)} hosts")
+
+
 def main() -> None:
     ch = logging.StreamHandler()
     ch.setFormatter(LogFormatter())
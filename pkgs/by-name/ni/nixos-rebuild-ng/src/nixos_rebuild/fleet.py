@@ -0,0 +1,112 @@
+import logging
+from collections.abc import Callable, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from subprocess import CalledProcessError
+from typing import Final
+
+from . import nix
+from .models import Flake, NRError
+from .process import Remote, ensure_ssh_master
+from .utils import Args
+
+logger = logging.getLogger(__name__)
+
+# Errors that fail a single host instead of the whole deployment
+HOST_ERRORS: Final = (CalledProcessError, NRError, OSError)
+
+
+@dataclass
+class HostResult:
+    host: str
+    path: Path | None = None
+    status: str = "skipped"
+    error: str = ""
+
+
+def deploy(
+    targets: Sequence[tuple[Remote, Flake | None]],
+    build: Callable[[Flake | None], Path],
+    activate: Callable[[Path, Remote], None],
+    build_host: Remote | None = None,
+    copy_flags: Args | None = None,
+    max_parallel: int = 8,
+    batch_size: int | None = None,
+) -> list[HostResult]:
+    """Deploy configurations to many target hosts at once.
+
+    Every distinct configuration (e.g.: flake attribute) is only built once,
+    then the closures are copied to up to `max_parallel` hosts concurrently.
+    Hosts are activated in rolling batches of `batch_size` (by default
+    `max_parallel`), and after a batch with a failure the remaining hosts are
+    skipped.
+
+    Returns the result of each host, in the order of `targets`.
+    """
+    results = [HostResult(remote.host) for remote, _ in targets]
+
+    paths: dict[Flake | None, Path] = {}
+    for remote, flake in targets:
+        if flake in paths:
+            continue
+        logger.info("building the system configuration for %s...", remote.host)
+        try:
+            paths[flake] = build(flake)
+        except HOST_ERRORS as ex:
+            logger.error("building the configuration for %s failed", remote.host)
+            for result, (_, f) in zip(results, targets, strict=True):
+                if f == flake:
+                    result.status = "failed"
+                    result.error = f"build: {ex}"
+
+    def copy(result: HostResult, remote: Remote, flake: Flake | None) -> None:
+        if result.status == "failed":
+            return
+        result.path = paths[flake]
+        try:
+            ensure_ssh_master(remote)
+            logger.info("copying the closure to %s...", remote.host)
+            nix.copy_closure(
+                result.path,
+                to_host=remote,
+                from_host=build_host,
+                copy_flags=copy_flags,
+            )
+        except HOST_ERRORS as ex:
+            result.status = "failed"
+            result.error = f"copy: {ex}"
+
+    def activate_host(result: HostResult, remote: Remote) -> None:
+        assert result.path is not None
+        try:
+            logger.info("activating the configuration on %s...", remote.host)
+            activate(result.path, remote)
+            result.status = "ok"
+        except HOST_ERRORS as ex:
+            result.status = "failed"
+            result.error = f"activation: {ex}"
+
+    with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+        list(
+            executor.map(
+                copy, results, [r for r, _ in targets], [f for _, f in targets]
+            )
+        )
+
+    pending = [
+        (result, remote)
+        for result, (remote, _) in zip(results, targets, strict=True)
+        if result.status != "failed"
+    ]
+    batch_size = batch_size or max_parallel
+    with ThreadPoolExecutor(max_workers=min(batch_size, max_parallel)) as executor:
+        for start in range(0, len(pending), batch_size):
+            batch = pending[start : start + batch_size]
+            list(executor.map(lambda p: activate_host(*p), batch))
+            if any(result.status == "failed" for result, _ in batch):
+                for result, _ in pending[start + batch_size :]:
+                    result.error = "not activated after a failure in an earlier batch"
+                break
+
+    return results
@@ -153,6 +153,20 @@ class Generation:
     current: bool
 
 
+class EvalCacheEntry(TypedDict):
+    drv: str
+    # Build hosts the closure of the derivation was copied to
+    hosts: list[str]
+
+
+# camelCase since this is merged into `GenerationJson`
+class GenerationInfo(TypedDict):
+    nixosVersion: str
+    kernelVersion: str
+    configurationRevision: str
+    specialisations: list[str]
+
+
 # camelCase since this will be used as output for `--json` flag
 class GenerationJson(TypedDict):
     generation: int
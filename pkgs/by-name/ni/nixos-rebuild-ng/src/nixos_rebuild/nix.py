@@ -1,23 +1,30 @@
 import json
 import logging
 import os
+import re
 import textwrap
-from concurrent.futures import ThreadPoolExecutor
+import threading
+from collections.abc import Iterator, Sequence
+from contextlib import contextmanager
 from datetime import datetime
-from importlib.resources import files
 from pathlib import Path
-from string import Template
 from subprocess import PIPE, CalledProcessError
-from typing import Final, Literal
+from typing import Any, Final, Literal
 from uuid import uuid4
 
+# Modules that only a few code paths need (e.g.: `hashlib`,
+# `importlib.resources`) are imported at the start of the functions using them,
+# since every invocation pays for what is imported here. `re` and `threading`
+# are imported by `argparse` and `logging` anyway.
 from . import tmpdir
 from .constants import WITH_NIX_2_18
 from .models import (
     Action,
     BuildAttr,
+    EvalCacheEntry,
     Flake,
     Generation,
+    GenerationInfo,
     GenerationJson,
     ImageVariants,
     NRError,
@@ -29,6 +36,60 @@ from .utils import Args, dict_to_flags
 
 FLAKE_FLAGS: Final = ["--extra-experimental-features", "nix-command flakes"]
 FLAKE_REPL_TEMPLATE: Final = "repl.nix.template"
+# Realise a derivation behind a temporary GC root and print the resulting path,
+# all in a single remote shell instead of one SSH session per step
+REMOTE_REALISE_SCRIPT: Final = """
+set -e
+tmpdir=$(mktemp -d -t nixos-rebuild.XXXXX)
+trap 'rm -rf "$tmpdir"' EXIT
+root=$(nix-store --realise "$@" --add-root "$tmpdir/result")
+readlink -f "$root"
+"""
+# Set the system profile and switch to the configuration in a single remote
+# shell, instead of one round trip each
+REMOTE_SWITCH_SCRIPT: Final = """
+set -e
+nix-env -p "$1" --set "$2"
+exec "$3" "$4"
+"""
+# Seconds between two checks for newly built paths with `pipeline_copy`
+PIPELINE_COPY_INTERVAL: Final = 10
+# Store paths per remote `nix-store --check-validity`, so the remote command
+# stays well below the MAX_ARG_STRLEN limit (128 KiB) of a single argument
+CHECK_VALIDITY_BATCH_SIZE: Final = 256
+# Outputs in the first list of a `.drv` file, `(name, path, hashAlgo, hash)`
+DRV_OUTPUT_RE: Final = re.compile(r'\("[^"]*","([^"]*)","([^"]*)","[^"]*"\)')
+# Files in `$XDG_CACHE_HOME/nixos-rebuild`
+EVAL_CACHE: Final = "eval-cache.json"
+# Evaluations kept in `EVAL_CACHE`, the least recently used ones are dropped
+EVAL_CACHE_SIZE: Final = 32
+GENERATIONS_INDEX: Final = "generations.json"
+# Print the current generation, then one line per generation with its ID,
+# store path, creation time and, unless the store path is one of the
+# arguments, its information, all in a single remote shell
+REMOTE_LIST_GENERATIONS_SCRIPT: Final = r"""
+profile=$1
+shift
+basename "$(readlink "$profile")"
+for link in "$profile"-*-link; do
+    [ -e "$link" ] || continue
+    id=${link#"$profile"-}
+    id=${id%-link}
+    path=$(readlink -f "$link")
+    printf '%s\t%s\t%s' "$id" "$path" "$(stat -L -c %Z "$link")"
+    for known in "$@"; do
+        if [ "$known" = "$path" ]; then
+            printf '\n'
+            continue 2
+        fi
+    done
+    printf '\t%s\t%s\t%s\t%s\n' \
+        "$(cat "$link/nixos-version" 2>/dev/null)" \
+        "$(ls "$link/kernel-modules/lib/modules" 2>/dev/null | head -n 1)" \
+        "$("$link/sw/bin/nixos-version" --configuration-revision 2>/dev/null)" \
+        "$(cd "$link/specialisation" 2>/dev/null && echo *)"
+done
+"""
 logger = logging.getLogger(__name__)
 
 
@@ -80,6 +141,8 @@ def build_remote(
     realise_flags: Args | None = None,
     instantiate_flags: Args | None = None,
     copy_flags: Args | None = None,
+    pipeline_copy: bool = False,
+    target_host: Remote | None = None,
 ) -> Path:
     # We need to use `--add-root` otherwise Nix will print this warning:
     # > warning: you did not specify '--add-root'; the result might be removed
@@ -99,32 +162,22 @@ def build_remote(
     drv = Path(r.stdout.strip()).resolve()
     copy_closure(drv, to_host=build_host, from_host=None, copy_flags=copy_flags)
 
-    # Need a temporary directory in remote to use in `nix-store --add-root`
-    r = run_wrapper(
-        ["mktemp", "-d", "-t", "nixos-rebuild.XXXXX"], remote=build_host, stdout=PIPE
-    )
-    remote_tmpdir = Path(r.stdout.strip())
-    try:
+    # When you use `--add-root`, `nix-store` returns the root and not the path
+    # inside Nix store, so the script resolves it
+    with stream_outputs(drv, build_host, target_host, copy_flags, pipeline_copy):
         r = run_wrapper(
             [
-                "nix-store",
-                "--realise",
+                "sh",
+                "-c",
+                REMOTE_REALISE_SCRIPT,
+                "sh",
                 drv,
-                "--add-root",
-                remote_tmpdir / uuid4().hex,
                 *dict_to_flags(realise_flags),
             ],
             remote=build_host,
             stdout=PIPE,
         )
-        # When you use `--add-root`, `nix-store` returns the root and not the
-        # path inside Nix store
-        r = run_wrapper(
-            ["readlink", "-f", r.stdout.strip()], remote=build_host, stdout=PIPE
-        )
-        return Path(r.stdout.strip())
-    finally:
-        run_wrapper(["rm", "-rf", remote_tmpdir], remote=build_host, check=False)
+    return Path(r.stdout.strip())
 
 
 def build_remote_flake(
@@ -134,44 +187,275 @@ def build_remote_flake(
     eval_flags: Args | None = None,
     copy_flags: Args | None = None,
     flake_build_flags: Args | None = None,
+    use_eval_cache: bool = False,
+    pipeline_copy: bool = False,
+    target_host: Remote | None = None,
 ) -> Path:
+    cache_key = (
+        get_flake_eval_cache_key(attr, flake, eval_flags) if use_eval_cache else None
+    )
+    cache: dict[str, EvalCacheEntry] = read_cache(EVAL_CACHE) if cache_key else {}
+    cached = cache.get(cache_key) if cache_key else None
+
+    if cached and Path(cached["drv"]).exists():
+        drv = Path(cached["drv"])
+        logger.debug("using cached evaluation of '%s': %s", flake, drv)
+    else:
+        r = run_wrapper(
+            [
+                "nix",
+                *FLAKE_FLAGS,
+                "eval",
+                "--raw",
+                flake.to_attr(attr, "drvPath"),
+                *dict_to_flags(eval_flags),
+            ],
+            stdout=PIPE,
+        )
+        drv = Path(r.stdout.strip())
+        cached = {"drv": str(drv), "hosts": []}
+
+    # The build host may have garbage collected the derivation since we copied
+    # it, but checking is still a lot cheaper than copying its closure again
+    copied = build_host.host in cached["hosts"] and not (
+        run_wrapper(
+            ["nix-store", "--check-validity", drv], remote=build_host, check=False
+        ).returncode
+    )
+    if not copied:
+        copy_closure(drv, to_host=build_host, from_host=None, copy_flags=copy_flags)
+        if build_host.host not in cached["hosts"]:
+            cached["hosts"] = [*cached["hosts"], build_host.host]
+
+    if cache_key:
+        # Entries are ordered from least to most recently used
+        cache.pop(cache_key, None)
+        cache[cache_key] = cached
+        write_cache(EVAL_CACHE, dict(list(cache.items())[-EVAL_CACHE_SIZE:]))
+
+    with stream_outputs(drv, build_host, target_host, copy_flags, pipeline_copy):
+        r = run_wrapper(
+            [
+                "nix",
+                *FLAKE_FLAGS,
+                "build",
+                f"{drv}^*",
+                "--print-out-paths",
+                *dict_to_flags(flake_build_flags),
+            ],
+            remote=build_host,
+            stdout=PIPE,
+        )
+    return Path(r.stdout.strip())
+
+
+def get_cache_path(name: str) -> Path:
+    cache_home = os.getenv("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cache_home) / "nixos-rebuild" / name
+
+
+def read_cache(name: str) -> dict[str, Any]:
+    try:
+        cache: dict[str, Any] = json.loads(get_cache_path(name).read_text())
+        return cache
+    except (OSError, ValueError) as ex:
+        logger.debug("could not read cache '%s': %s", name, ex)
+        return {}
+
+
+def write_cache(name: str, cache: dict[str, Any]) -> None:
+    path = get_cache_path(name)
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write and rename, so concurrent runs never see a partial file
+        tmp_path = path.with_name(f"{path.name}.{uuid4().hex}")
+        tmp_path.write_text(json.dumps(cache))
+        tmp_path.replace(path)
+    except OSError as ex:
+        logger.warning("could not write cache '%s': %s", name, ex)
+
+
+def get_flake_eval_cache_key(
+    attr: str,
+    flake: Flake,
+    eval_flags: Args | None = None,
+) -> str | None:
+    """Get a key identifying the evaluation of a flake attribute.
+
+    The NAR hash of the locked flake covers the configuration as well as its
+    `flake.lock`, overridden inputs are part of the lock information. Returns
+    `None` if the result of the evaluation may depend on anything else.
+    """
+    import hashlib
+
+    if eval_flags and eval_flags.get("impure"):
+        return None
+
     r = run_wrapper(
         [
             "nix",
             *FLAKE_FLAGS,
-            "eval",
-            "--raw",
-            flake.to_attr(attr, "drvPath"),
+            "flake",
+            "metadata",
+            "--json",
+            str(flake.path),
             *dict_to_flags(eval_flags),
         ],
         stdout=PIPE,
+        check=False,
     )
-    drv = Path(r.stdout.strip())
-    copy_closure(drv, to_host=build_host, from_host=None, copy_flags=copy_flags)
+    if r.returncode:
+        return None
+    try:
+        metadata = json.loads(r.stdout)
+        locked = metadata["locked"]
+    except (ValueError, KeyError):
+        return None
+    if "narHash" not in locked:
+        return None
+
+    key = json.dumps(
+        [locked, metadata.get("locks"), flake.to_attr(attr), eval_flags],
+        sort_keys=True,
+    )
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def get_drv_outputs(drv: Path) -> list[Path]:
+    """Get the output paths of all derivations needed to build a derivation.
+
+    Fixed-output derivations (e.g.: sources) are left out, since they are
+    hardly ever needed at runtime.
+    """
+    r = run_wrapper(["nix-store", "--query", "--requisites", drv], stdout=PIPE)
+    outputs = []
+    for line in r.stdout.splitlines():
+        if not line.endswith(".drv"):
+            continue
+        text = Path(line).read_text()
+        # The outputs are the first list in the derivation
+        for path, hash_algo in DRV_OUTPUT_RE.findall(text[: text.find("],")]):
+            if hash_algo:
+                break
+            if path:
+                outputs.append(Path(path))
+    return outputs
+
+
+def get_package_name(path: Path) -> str:
+    """Get the name of a store path without its hash and version, e.g.:
+    `firefox-man` for `/nix/store/<hash>-firefox-128.0-man`."""
+    _, _, name = path.name.partition("-")
+    return "-".join(part for part in name.split("-") if not part[:1].isdigit())
+
+
+def get_current_system_packages(target_host: Remote | None) -> set[str]:
+    "Get the package names in the closure of the current system of a host."
     r = run_wrapper(
-        [
-            "nix",
-            *FLAKE_FLAGS,
-            "build",
-            f"{drv}^*",
-            "--print-out-paths",
-            *dict_to_flags(flake_build_flags),
-        ],
-        remote=build_host,
+        ["nix-store", "--query", "--requisites", "/run/current-system"],
+        remote=target_host,
         stdout=PIPE,
+        check=False,
     )
-    return Path(r.stdout.strip())
+    return {get_package_name(Path(p)) for p in r.stdout.split()}
+
+
+def get_invalid_paths(paths: Sequence[Path], host: Remote | None) -> set[Path]:
+    "Get the paths that are not valid (e.g.: not built yet) on a host."
+    invalid = set()
+    for start in range(0, len(paths), CHECK_VALIDITY_BATCH_SIZE):
+        r = run_wrapper(
+            [
+                "nix-store",
+                "--check-validity",
+                "--print-invalid",
+                *paths[start : start + CHECK_VALIDITY_BATCH_SIZE],
+            ],
+            remote=host,
+            stdout=PIPE,
+        )
+        invalid |= {Path(p) for p in r.stdout.split()}
+    return invalid
+
+
+@contextmanager
+def stream_outputs(
+    drv: Path,
+    build_host: Remote | None,
+    target_host: Remote | None,
+    copy_flags: Args | None = None,
+    enabled: bool = True,
+) -> Iterator[None]:
+    """Copy paths the system built from a derivation will likely need from
+    build host to target host as soon as they are built, while the context
+    is active.
+
+    This overlaps the transfer with building, so copying the result
+    afterwards only has to transfer what was built last. Which paths end
+    up in the runtime closure is only known once the system is built, so
+    only outputs of packages that the current system of the target host
+    also contains (in any version) are copied. This leaves out toolchains
+    and other paths only needed at build time.
+    """
+    # Compare the hosts only, not e.g. sudo passwords
+    same_host = (build_host and build_host.host) == (target_host and target_host.host)
+    if not enabled or same_host:
+        yield
+        return
+
+    stop = threading.Event()
+
+    def stream() -> None:
+        try:
+            packages = get_current_system_packages(target_host)
+            pending = sorted(
+                path
+                for path in get_drv_outputs(drv)
+                if get_package_name(path) in packages
+            )
+        except (OSError, CalledProcessError) as ex:
+            logger.warning("not copying paths while building: %s", ex)
+            return
+        logger.debug("copying %d paths as soon as they are built", len(pending))
+
+        while pending and not stop.wait(PIPELINE_COPY_INTERVAL):
+            try:
+                invalid = get_invalid_paths(pending, build_host)
+                if built := [p for p in pending if p not in invalid]:
+                    logger.debug("copying %d newly built paths", len(built))
+                    copy_closure(
+                        built,
+                        to_host=target_host,
+                        from_host=build_host,
+                        copy_flags=copy_flags,
+                    )
+                pending = [p for p in pending if p in invalid]
+            except CalledProcessError as ex:
+                # The closure is copied after the build anyway
+                logger.warning("stopped copying paths while building: %s", ex)
+                return
+
+    thread = threading.Thread(target=stream, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
 
 
 def copy_closure(
-    closure: Path,
+    closure: Path | Sequence[Path],
     to_host: Remote | None,
     from_host: Remote | None = None,
     copy_flags: Args | None = None,
 ) -> None:
     """Copy a nix closure to or from host to localhost.
 
-    Also supports copying a closure from a remote to another remote."""
+    Also supports copying a closure from a remote to another remote, and
+    copying the closures of several paths at once."""
+
+    closures = [closure] if isinstance(closure, Path) else closure
 
     sshopts = os.getenv("NIX_SSHOPTS", "")
     extra_env = {
@@ -185,7 +469,7 @@ def copy_closure(
                 *dict_to_flags(copy_flags),
                 "--to" if to else "--from",
                 host.host,
-                closure,
+                *closures,
             ],
             extra_env=extra_env,
         )
@@ -200,7 +484,7 @@ def copy_closure(
                 f"ssh://{from_host.host}",
                 "--to",
                 f"ssh://{to_host.host}",
-                closure,
+                *closures,
             ],
             extra_env=extra_env,
         )
@@ -417,7 +701,90 @@ def get_generations_from_nix_env(
     )
 
 
-def list_generations(profile: Profile) -> list[GenerationJson]:
+def get_generation_info(generation_path: Path) -> GenerationInfo:
+    """Get OS information like the NixOS version, kernel version,
+    configuration revision and specialisations of a local generation."""
+    try:
+        nixos_version = (generation_path / "nixos-version").read_text().strip()
+    except OSError as ex:
+        logger.debug("could not get nixos-version: %s", ex)
+        nixos_version = "Unknown"
+    try:
+        kernel_version = next(
+            (generation_path / "kernel-modules/lib/modules").iterdir()
+        ).name
+    except OSError as ex:
+        logger.debug("could not get kernel version: %s", ex)
+        kernel_version = "Unknown"
+    specialisations = [
+        s.name for s in (generation_path / "specialisation").glob("*") if s.is_dir()
+    ]
+    try:
+        configuration_revision = run_wrapper(
+            [generation_path / "sw/bin/nixos-version", "--configuration-revision"],
+            capture_output=True,
+        ).stdout.strip()
+    except (OSError, CalledProcessError) as ex:
+        logger.debug("could not get configuration revision: %s", ex)
+        configuration_revision = "Unknown"
+
+    return GenerationInfo(
+        nixosVersion=nixos_version,
+        kernelVersion=kernel_version,
+        configurationRevision=configuration_revision,
+        specialisations=specialisations,
+    )
+
+
+def get_remote_generations(
+    profile: Profile,
+    target_host: Remote,
+    known_paths: Sequence[str] = (),
+) -> tuple[list[tuple[Generation, str]], dict[str, GenerationInfo]]:
+    """Get all NixOS generations from a profile on a remote host, together
+    with their store paths, with a single SSH call.
+
+    Returns the information of every generation whose store path is not in
+    `known_paths` as well.
+    """
+    r = run_wrapper(
+        ["sh", "-c", REMOTE_LIST_GENERATIONS_SCRIPT, "sh", profile.path, *known_paths],
+        remote=target_host,
+        stdout=PIPE,
+    )
+    current, *lines = r.stdout.splitlines() or [""]
+    if not current:
+        raise NRError(f"no profile '{profile.name}' found")
+
+    generations = []
+    infos = {}
+    for line in lines:
+        entry_id, path, ctime, *info = line.split("\t")
+        generation = Generation(
+            id=int(entry_id),
+            timestamp=datetime.fromtimestamp(int(ctime)).strftime("%Y-%m-%d %H:%M:%S"),
+            current=current == f"{profile.path.name}-{entry_id}-link",
+        )
+        generations.append((generation, path))
+        if info:
+            nixos_version, kernel_version, configuration_revision, specialisations = (
+                info
+            )
+            infos[path] = GenerationInfo(
+                nixosVersion=nixos_version or "Unknown",
+                kernelVersion=kernel_version or "Unknown",
+                configurationRevision=configuration_revision or "Unknown",
+                # `echo *` prints the pattern itself without specialisations
+                specialisations=[s for s in specialisations.split() if s != "*"],
+            )
+
+    return sorted(generations, key=lambda g: g[0].id), infos
+
+
+def list_generations(
+    profile: Profile,
+    target_host: Remote | None = None,
+) -> list[GenerationJson]:
     """Get all NixOS generations from profile, including extra information.
 
     Includes OS information like the commit, kernel version, configuration
@@ -425,54 +792,62 @@ def list_generations(profile: Profile) -> list[GenerationJson]:
 
     Will be formatted in a way that is expected by the output of
     `nixos-rebuild list-generations --json`.
+
+    The information of a generation only depends on its store path, so it is
+    kept in an index and only computed for new generations.
     """
+    from concurrent.futures import ThreadPoolExecutor
 
-    def get_generation_info(generation: Generation) -> GenerationJson:
-        generation_path = (
-            profile.path.parent / f"{profile.path.name}-{generation.id}-link"
-        )
-        try:
-            nixos_version = (generation_path / "nixos-version").read_text().strip()
-        except OSError as ex:
-            logger.debug("could not get nixos-version: %s", ex)
-            nixos_version = "Unknown"
-        try:
-            kernel_version = next(
-                (generation_path / "kernel-modules/lib/modules").iterdir()
-            ).name
-        except OSError as ex:
-            logger.debug("could not get kernel version: %s", ex)
-            kernel_version = "Unknown"
-        specialisations = [
-            s.name for s in (generation_path / "specialisation").glob("*") if s.is_dir()
+    index: dict[str, dict[str, GenerationInfo]] = read_cache(GENERATIONS_INDEX)
+    host = target_host.host if target_host else "localhost"
+    known = index.get(host, {})
+
+    if target_host:
+        generations, infos = get_remote_generations(profile, target_host, list(known))
+    else:
+        generations = [
+            (
+                generation,
+                str(
+                    (
+                        profile.path.parent
+                        / f"{profile.path.name}-{generation.id}-link"
+                    ).resolve()
+                ),
+            )
+            for generation in get_generations(profile)
         ]
-        try:
-            configuration_revision = run_wrapper(
-                [generation_path / "sw/bin/nixos-version", "--configuration-revision"],
-                capture_output=True,
-            ).stdout.strip()
-        except (OSError, CalledProcessError) as ex:
-            logger.debug("could not get configuration revision: %s", ex)
-            configuration_revision = "Unknown"
-
-        return GenerationJson(
-            generation=generation.id,
-            date=generation.timestamp,
-            nixosVersion=nixos_version,
-            kernelVersion=kernel_version,
-            configurationRevision=configuration_revision,
-            specialisations=specialisations,
-            current=generation.current,
-        )
+        new_paths = {path for _, path in generations if path not in known}
+        # This can be surprisingly slow, especially with lots of generations,
+        # but it is basically IO work so we can run in parallel
+        with ThreadPoolExecutor() as executor:
+            infos = dict(
+                zip(
+                    new_paths,
+                    executor.map(get_generation_info, map(Path, new_paths)),
+                    strict=True,
+                )
+            )
 
-    # This can be surprisingly slow, especially with lots of generations,
-    # but it is basically IO work so we can run in parallel
-    with ThreadPoolExecutor() as executor:
-        return sorted(
-            executor.map(get_generation_info, get_generations(profile)),
-            key=lambda x: x["generation"],
-            reverse=True,
-        )
+    # Only keep the generations that still exist, so the index stays small
+    paths = {path for _, path in generations}
+    entries = {path: info for path, info in (known | infos).items() if path in paths}
+    if entries != known:
+        write_cache(GENERATIONS_INDEX, index | {host: entries})
+
+    return sorted(
+        (
+            GenerationJson(
+                generation=generation.id,
+                date=generation.timestamp,
+                **entries[path],
+                current=generation.current,
+            )
+            for generation, path in generations
+        ),
+        key=lambda x: x["generation"],
+        reverse=True,
+    )
 
 
 def repl(attr: str, build_attr: BuildAttr, nix_flags: Args | None = None) -> None:
@@ -483,6 +858,9 @@ def repl(attr: str, build_attr: BuildAttr, nix_flags: Args | None = None) -> Non
 
 
 def repl_flake(attr: str, flake: Flake, flake_flags: Args | None = None) -> None:
+    from importlib.resources import files
+    from string import Template
+
     expr = Template(
         files(__package__).joinpath(FLAKE_REPL_TEMPLATE).read_text()
     ).substitute(
@@ -559,12 +937,15 @@ def switch_to_configuration(
     sudo: bool,
     install_bootloader: bool = False,
     specialisation: str | None = None,
+    profile: Profile | None = None,
 ) -> None:
     """Call `<config>/bin/switch-to-configuration <action>`.
 
     Expects a built path to run, like one generated with `nixos_build` or
-    `nixos_build_flake` functions.
+    `nixos_build_flake` functions. With `profile`, first set the path as the
+    current active profile, like `set_profile`.
     """
+    toplevel = path_to_config
     if specialisation:
         if action not in (Action.SWITCH, Action.TEST):
             raise NRError(
@@ -575,9 +956,30 @@ def switch_to_configuration(
         if not path_to_config.exists():
             raise NRError(f"specialisation not found: {specialisation}")
 
+    extra_env = {"NIXOS_INSTALL_BOOTLOADER": "1" if install_bootloader else "0"}
+    if profile and target_host:
+        run_wrapper(
+            [
+                "sh",
+                "-c",
+                REMOTE_SWITCH_SCRIPT,
+                "sh",
+                profile.path,
+                toplevel,
+                path_to_config / "bin/switch-to-configuration",
+                str(action),
+            ],
+            extra_env=extra_env,
+            remote=target_host,
+            sudo=sudo,
+        )
+        return
+
+    if profile:
+        set_profile(profile, toplevel, target_host=target_host, sudo=sudo)
     run_wrapper(
         [path_to_config / "bin/switch-to-configuration", str(action)],
-        extra_env={"NIXOS_INSTALL_BOOTLOADER": "1" if install_bootloader else "0"},
+        extra_env=extra_env,
         remote=target_host,
         sudo=sudo,
     )
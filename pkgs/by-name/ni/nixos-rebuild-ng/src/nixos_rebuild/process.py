@@ -20,6 +20,11 @@ SSH_DEFAULT_OPTS: Final = [
     "-o",
     "ControlPersist=60",
 ]
+# Options for a master connection that lives until `cleanup_ssh`, or until it
+# was unused for 10 minutes in case that never runs (e.g.: on SIGKILL). They
+# take precedence over `SSH_DEFAULT_OPTS` since SSH uses the first value given,
+# but come after the user's options from NIX_SSHOPTS for the same reason
+SSH_MASTER_OPTS: Final = ["-o", "ControlMaster=yes", "-o", "ControlPersist=600"]
 
 
 @dataclass(frozen=True)
@@ -68,8 +73,37 @@ class RunKwargs(TypedDict, total=False):
     stdout: int | None
 
 
+# Remotes `ensure_ssh_master` started a master connection to
+SSH_MASTERS: Final[list[Remote]] = []
+
+
+def get_ssh_option(opts: Sequence[str], name: str) -> str | None:
+    "Get the value SSH uses for a `-o` option, i.e.: the first one given."
+    for i, opt in enumerate(opts):
+        if opt == "-o" and i + 1 < len(opts):
+            value = opts[i + 1]
+        elif opt.startswith("-o") and len(opt) > 2:
+            value = opt[2:]
+        else:
+            continue
+        # Both `Name=value` and `Name value` are accepted
+        key, _, rest = value.replace("=", " ", 1).partition(" ")
+        if key.lower() == name.lower():
+            return rest.strip()
+    return None
+
+
 def cleanup_ssh() -> None:
     "Close SSH ControlMaster connection."
+    # Through the ControlPath they were started with, which may come from
+    # NIX_SSHOPTS
+    while SSH_MASTERS:
+        remote = SSH_MASTERS.pop()
+        run_wrapper(
+            ["ssh", *remote.opts, *SSH_DEFAULT_OPTS, "-O", "exit", remote.host],
+            check=False,
+            capture_output=True,
+        )
     for ctrl in tmpdir.TMPDIR_PATH.glob("ssh-*"):
         run_wrapper(
             ["ssh", "-o", f"ControlPath={ctrl}", "-O", "exit", "dummyhost"],
@@ -81,6 +115,53 @@ def cleanup_ssh() -> None:
 atexit.register(cleanup_ssh)
 
 
+def ensure_ssh_master(remote: Remote) -> None:
+    """Make sure a SSH master connection to the remote is running.
+
+    All remote commands are multiplexed over this connection, so they don't
+    pay for a SSH handshake each. Unlike a master started on demand by the
+    first command, it does not time out while e.g. a long local evaluation
+    runs between two remote commands.
+
+    Does nothing if the user disabled connection sharing in NIX_SSHOPTS.
+    """
+    if (get_ssh_option(remote.opts, "ControlMaster") or "").lower() == "no" or (
+        get_ssh_option(remote.opts, "ControlPath") or ""
+    ).lower() == "none":
+        return
+
+    ssh = ["ssh", *remote.opts, *SSH_DEFAULT_OPTS]
+    r = subprocess.run(
+        [*ssh, "-O", "check", remote.host],
+        check=False,
+        capture_output=True,
+    )
+    if r.returncode == 0:
+        return
+
+    logger.debug("starting SSH master connection to %s", remote.host)
+    # `-f` only forks once the connection is established (and authenticated,
+    # possibly interactively), `-N` keeps it open without running a command
+    r = subprocess.run(
+        [
+            "ssh",
+            *remote.opts,
+            *SSH_MASTER_OPTS,
+            *SSH_DEFAULT_OPTS,
+            "-f",
+            "-N",
+            remote.host,
+        ],
+        check=False,
+        stdin=subprocess.DEVNULL,
+    )
+    if r.returncode == 0:
+        SSH_MASTERS.append(remote)
+    else:
+        # Remote commands will still establish their own connections
+        logger.debug("could not start SSH master connection to %s", remote.host)
+
+
 def run_wrapper(
     args: Sequence[str | bytes | os.PathLike[str] | os.PathLike[bytes]],
     *,
@@ -0,0 +1,101 @@
+from pathlib import Path
+from subprocess import CalledProcessError
+from unittest.mock import Mock, call, patch
+
+import nixos_rebuild.fleet as f
+import nixos_rebuild.models as m
+
+from .helpers import get_qualified_name
+
+
+def remote(host: str) -> m.Remote:
+    return m.Remote(host, [], None)
+
+
+@patch(get_qualified_name(f.ensure_ssh_master, f), autospec=True)
+@patch(get_qualified_name(f.nix.copy_closure, f.nix), autospec=True)
+def test_deploy(mock_copy_closure: Mock, mock_ensure_ssh_master: Mock) -> None:
+    flake_a = m.Flake("/flake", "nixosConfigurations.a")
+    flake_b = m.Flake("/flake", "nixosConfigurations.b")
+    targets = [
+        (remote("host1"), flake_a),
+        (remote("host2"), flake_b),
+        (remote("host3"), flake_a),
+    ]
+    build = Mock(side_effect=lambda flake: Path(f"/nix/store/{flake.attr}"))
+    activate = Mock()
+    build_host = remote("builder")
+
+    results = f.deploy(
+        targets,
+        build,
+        activate,
+        build_host=build_host,
+        copy_flags={"copy": True},
+        max_parallel=2,
+    )
+
+    # Every configuration is only built once
+    assert build.call_args_list == [call(flake_a), call(flake_b)]
+    mock_copy_closure.assert_has_calls(
+        [
+            call(
+                Path(f"/nix/store/{flake.attr}"),
+                to_host=host,
+                from_host=build_host,
+                copy_flags={"copy": True},
+            )
+            for host, flake in targets
+        ],
+        any_order=True,
+    )
+    assert activate.call_count == 3
+    assert mock_ensure_ssh_master.call_count == 3
+    assert results == [
+        f.HostResult("host1", Path("/nix/store/nixosConfigurations.a"), "ok"),
+        f.HostResult("host2", Path("/nix/store/nixosConfigurations.b"), "ok"),
+        f.HostResult("host3", Path("/nix/store/nixosConfigurations.a"), "ok"),
+    ]
+
+
+@patch(get_qualified_name(f.ensure_ssh_master, f), autospec=True)
+@patch(get_qualified_name(f.nix.copy_closure, f.nix), autospec=True)
+def test_deploy_failures(mock_copy_closure: Mock, mock_ensure_ssh_master: Mock) -> None:
+    flake = m.Flake("/flake", "nixosConfigurations.a")
+    broken_flake = m.Flake("/flake", "nixosConfigurations.broken")
+    targets = [
+        (remote("host1"), flake),
+        (remote("host2"), broken_flake),
+        (remote("host3"), flake),
+        (remote("host4"), flake),
+        (remote("host5"), flake),
+    ]
+
+    def build(flake: m.Flake | None) -> Path:
+        if flake == broken_flake:
+            raise CalledProcessError(1, "nix")
+        return Path("/nix/store/config")
+
+    def copy_closure(closure: Path, to_host: m.Remote, **kwargs: object) -> None:
+        if to_host.host == "host3":
+            raise CalledProcessError(1, "nix-copy-closure")
+
+    mock_copy_closure.side_effect = copy_closure
+
+    def activate(path: Path, target_host: m.Remote) -> None:
+        if target_host.host == "host4":
+            raise CalledProcessError(1, "switch-to-configuration")
+
+    results = f.deploy(targets, build, activate, max_parallel=4, batch_size=1)
+
+    assert [(r.host, r.status) for r in results] == [
+        ("host1", "ok"),
+        ("host2", "failed"),
+        ("host3", "failed"),
+        ("host4", "failed"),
+        # Rolling activation stops after the first failed batch
+        ("host5", "skipped"),
+    ]
+    assert results[1].error.startswith("build:")
+    assert results[2].error.startswith("copy:")
+    assert results[3].error.startswith("activation:")
@@ -1,6 +1,10 @@
 import logging
+import os
+import subprocess
+import sys
 import textwrap
 import uuid
+import warnings
 from pathlib import Path
 from subprocess import PIPE, CompletedProcess
 from typing import Any
@@ -34,6 +38,14 @@ def test_parse_args() -> None:
         nr.parse_args(["nixos-rebuild", "edit", "--attr", "attr"])
     assert e.value.code == 2
 
+    with pytest.raises(SystemExit) as e:
+        nr.parse_args(["nixos-rebuild", "switch", "--max-parallel-hosts", "0"])
+    assert e.value.code == 2
+
+    with pytest.raises(SystemExit) as e:
+        nr.parse_args(["nixos-rebuild", "switch", "--activation-batch-size", "-1"])
+    assert e.value.code == 2
+
     r1, g1 = nr.parse_args(
         [
             "nixos-rebuild",
@@ -125,6 +137,29 @@ def test_parse_args() -> None:
         "include2",
     ]
 
+    r3, _ = nr.parse_args(["nixos-rebuild", "switch", "--target-host", "host1"])
+    assert r3.target_host == "host1"
+    assert r3.target_hosts == ["host1"]
+
+    r4, _ = nr.parse_args(
+        [
+            "nixos-rebuild",
+            "switch",
+            "--target-host",
+            "host1",
+            "--target-host",
+            "host2",
+        ]
+    )
+    assert r4.target_host is None
+    assert r4.target_hosts == ["host1", "host2"]
+
+    with pytest.raises(SystemExit) as e:
+        nr.parse_args(
+            ["nixos-rebuild", "build", "--target-host", "a", "--target-host", "b"]
+        )
+    assert e.value.code == 2
+
 
 @patch.dict(nr.os.environ, {}, clear=True)
 @patch(get_qualified_name(nr.os.execve, nr.os), autospec=True)
@@ -481,9 +516,11 @@ def test_execute_nix_switch_flake(mock_run: Mock, tmp_path: Path) -> None:
 @patch.dict(nr.process.os.environ, {}, clear=True)
 @patch(get_qualified_name(nr.process.subprocess.run), autospec=True)
 @patch(get_qualified_name(nr.cleanup_ssh, nr), autospec=True)
+@patch(get_qualified_name(nr.ensure_ssh_master, nr), autospec=True)
 @patch(get_qualified_name(nr.nix.uuid4, nr.nix), autospec=True)
 def test_execute_nix_switch_build_target_host(
     mock_uuid4: Mock,
+    mock_ensure_ssh_master: Mock,
     mock_cleanup_ssh: Mock,
     mock_run: Mock,
     tmp_path: Path,
@@ -498,11 +535,7 @@ def test_execute_nix_switch_build_target_host(
             return CompletedProcess([], 1)
         elif args[0] == "nix-instantiate":
             return CompletedProcess([], 0, str(config_path))
-        elif args[0] == "ssh" and "nix-store" in args:
-            return CompletedProcess([], 0, "/tmp/tmpdir/config")
-        elif args[0] == "ssh" and "mktemp" in args:
-            return CompletedProcess([], 0, "/tmp/tmpdir")
-        elif args[0] == "ssh" and "readlink" in args:
+        elif args[0] == "ssh" and "sh" in args:
             return CompletedProcess([], 0, str(config_path))
         else:
             return CompletedProcess([], 0)
@@ -529,7 +562,11 @@ def test_execute_nix_switch_build_target_host(
         ]
     )
 
-    assert mock_run.call_count == 10
+    assert mock_run.call_count == 6
+    assert [c.args[0].host for c in mock_ensure_ssh_master.call_args_list] == [
+        "user@build-host",
+        "user@target-host",
+    ]
     mock_run.assert_has_calls(
         [
             call(
@@ -574,58 +611,16 @@ def test_execute_nix_switch_build_target_host(
                     *nr.process.SSH_DEFAULT_OPTS,
                     "user@build-host",
                     "--",
-                    "mktemp",
-                    "-d",
-                    "-t",
-                    "nixos-rebuild.XXXXX",
-                ],
-                check=True,
-                stdout=PIPE,
-                **DEFAULT_RUN_KWARGS,
-            ),
-            call(
-                [
-                    "ssh",
-                    *nr.process.SSH_DEFAULT_OPTS,
-                    "user@build-host",
-                    "--",
-                    "nix-store",
-                    "--realise",
+                    "sh",
+                    "-c",
+                    nr.process.shlex.quote(nr.nix.REMOTE_REALISE_SCRIPT),
+                    "sh",
                     str(config_path),
-                    "--add-root",
-                    "/tmp/tmpdir/00000000000000000000000000000000",
-                ],
-                check=True,
-                stdout=PIPE,
-                **DEFAULT_RUN_KWARGS,
-            ),
-            call(
-                [
-                    "ssh",
-                    *nr.process.SSH_DEFAULT_OPTS,
-                    "user@build-host",
-                    "--",
-                    "readlink",
-                    "-f",
-                    "/tmp/tmpdir/config",
                 ],
                 check=True,
                 stdout=PIPE,
                 **DEFAULT_RUN_KWARGS,
             ),
-            call(
-                [
-                    "ssh",
-                    *nr.process.SSH_DEFAULT_OPTS,
-                    "user@build-host",
-                    "--",
-                    "rm",
-                    "-rf",
-                    "/tmp/tmpdir",
-                ],
-                check=False,
-                **DEFAULT_RUN_KWARGS,
-            ),
             call(
                 [
                     "nix",
@@ -639,22 +634,6 @@ def test_execute_nix_switch_build_target_host(
                 check=True,
                 **DEFAULT_RUN_KWARGS,
             ),
-            call(
-                [
-                    "ssh",
-                    *nr.process.SSH_DEFAULT_OPTS,
-                    "user@target-host",
-                    "--",
-                    "sudo",
-                    "nix-env",
-                    "-p",
-                    "/nix/var/nix/profiles/system",
-                    "--set",
-                    str(config_path),
-                ],
-                check=True,
-                **DEFAULT_RUN_KWARGS,
-            ),
             call(
                 [
                     "ssh",
@@ -664,6 +643,12 @@ def test_execute_nix_switch_build_target_host(
                     "sudo",
                     "env",
                     "NIXOS_INSTALL_BOOTLOADER=0",
+                    "sh",
+                    "-c",
+                    nr.process.shlex.quote(nr.nix.REMOTE_SWITCH_SCRIPT),
+                    "sh",
+                    "/nix/var/nix/profiles/system",
+                    str(config_path),
                     str(config_path / "bin/switch-to-configuration"),
                     "switch",
                 ],
@@ -677,7 +662,9 @@ def test_execute_nix_switch_build_target_host(
 @patch.dict(nr.process.os.environ, {}, clear=True)
 @patch(get_qualified_name(nr.process.subprocess.run), autospec=True)
 @patch(get_qualified_name(nr.cleanup_ssh, nr), autospec=True)
+@patch(get_qualified_name(nr.ensure_ssh_master, nr), autospec=True)
 def test_execute_nix_switch_flake_target_host(
+    mock_ensure_ssh_master: Mock,
     mock_cleanup_ssh: Mock,
     mock_run: Mock,
     tmp_path: Path,
@@ -706,7 +693,7 @@ def test_execute_nix_switch_flake_target_host(
         ]
     )
 
-    assert mock_run.call_count == 4
+    assert mock_run.call_count == 3
     mock_run.assert_has_calls(
         [
             call(
@@ -728,22 +715,6 @@ def test_execute_nix_switch_flake_target_host(
                 check=True,
                 **DEFAULT_RUN_KWARGS,
             ),
-            call(
-                [
-                    "ssh",
-                    *nr.process.SSH_DEFAULT_OPTS,
-                    "user@localhost",
-                    "--",
-                    "sudo",
-                    "nix-env",
-                    "-p",
-                    "/nix/var/nix/profiles/system",
-                    "--set",
-                    str(config_path),
-                ],
-                check=True,
-                **DEFAULT_RUN_KWARGS,
-            ),
             call(
                 [
                     "ssh",
@@ -753,6 +724,12 @@ def test_execute_nix_switch_flake_target_host(
                     "sudo",
                     "env",
                     "NIXOS_INSTALL_BOOTLOADER=0",
+                    "sh",
+                    "-c",
+                    nr.process.shlex.quote(nr.nix.REMOTE_SWITCH_SCRIPT),
+                    "sh",
+                    "/nix/var/nix/profiles/system",
+                    str(config_path),
                     str(config_path / "bin/switch-to-configuration"),
                     "switch",
                 ],
@@ -766,7 +743,9 @@ def test_execute_nix_switch_flake_target_host(
 @patch.dict(nr.process.os.environ, {}, clear=True)
 @patch(get_qualified_name(nr.process.subprocess.run), autospec=True)
 @patch(get_qualified_name(nr.cleanup_ssh, nr), autospec=True)
+@patch(get_qualified_name(nr.ensure_ssh_master, nr), autospec=True)
 def test_execute_nix_switch_flake_build_host(
+    mock_ensure_ssh_master: Mock,
     mock_cleanup_ssh: Mock,
     mock_run: Mock,
     tmp_path: Path,
@@ -1060,3 +1039,48 @@ def test_execute_test_rollback(
             ),
         ]
     )
+
+
+# How much longer than `argparse` importing nixos_rebuild may take. Both are
+# measured in the same interpreter, so a loaded machine slows down both, but
+# since the timing is still noisy this only warns unless
+# NIXOS_REBUILD_STRICT_STARTUP_BUDGET is set.
+STARTUP_BUDGET = 10
+
+
+def test_startup() -> None:
+    r = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import argparse, nixos_rebuild"],
+        env=os.environ | {"PYTHONPATH": str(Path(nr.__file__).parent.parent)},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    # Lines look like `import time:       self |  cumulative | module`, where
+    # nested imports are indented
+    imports = {}
+    for line in r.stderr.splitlines():
+        self_us, cumulative_us, module = line.removeprefix("import time:").split("|")
+        if self_us.strip().isdigit():
+            imports[module.strip()] = int(cumulative_us)
+
+    # Only needed by some actions, so imported where they are used
+    for module in (
+        "concurrent.futures",
+        "hashlib",
+        "importlib.resources",
+        "nixos_rebuild.fleet",
+    ):
+        assert module not in imports
+
+    # argparse is imported first, so it is not part of the time nixos_rebuild
+    # takes
+    ratio = imports["nixos_rebuild"] / imports["argparse"]
+    if ratio > STARTUP_BUDGET:
+        message = (
+            f"importing nixos_rebuild took {ratio:.1f} times as long as argparse,"
+            f" more than the budget of {STARTUP_BUDGET}"
+        )
+        if os.environ.get("NIXOS_REBUILD_STRICT_STARTUP_BUDGET"):
+            pytest.fail(message)
+        warnings.warn(message, stacklevel=1)
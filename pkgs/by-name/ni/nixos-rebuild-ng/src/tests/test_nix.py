@@ -1,7 +1,8 @@
+import json
 import textwrap
 import uuid
 from pathlib import Path
-from subprocess import PIPE, CompletedProcess
+from subprocess import PIPE, CalledProcessError, CompletedProcess
 from typing import Any
 from unittest.mock import ANY, Mock, call, patch
 
@@ -90,17 +91,13 @@ def test_build_remote(
     ) -> CompletedProcess[str]:
         if args[0] == "nix-instantiate":
             return CompletedProcess([], 0, stdout=" \n/path/to/file\n ")
-        elif args[0] == "mktemp":
-            return CompletedProcess([], 0, stdout=" \n/tmp/tmpdir\n ")
-        elif args[0] == "nix-store":
-            return CompletedProcess([], 0, stdout=" \n/tmp/tmpdir/config\n ")
-        elif args[0] == "readlink":
+        elif args[0] == "sh":
             return CompletedProcess([], 0, stdout=" \n/path/to/config\n ")
         else:
             return CompletedProcess([], 0)
 
     mock_run.side_effect = run_wrapper_side_effect
-    mock_uuid4.side_effect = [uuid.UUID(int=1), uuid.UUID(int=2)]
+    mock_uuid4.side_effect = [uuid.UUID(int=1)]
 
     assert n.build_remote(
         "config.system.build.toplevel",
@@ -137,29 +134,18 @@ def test_build_remote(
                     "NIX_SSHOPTS": " ".join([*p.SSH_DEFAULT_OPTS, "--ssh opts"])
                 },
             ),
-            call(
-                ["mktemp", "-d", "-t", "nixos-rebuild.XXXXX"],
-                remote=build_host,
-                stdout=PIPE,
-            ),
             call(
                 [
-                    "nix-store",
-                    "--realise",
+                    "sh",
+                    "-c",
+                    n.REMOTE_REALISE_SCRIPT,
+                    "sh",
                     Path("/path/to/file"),
-                    "--add-root",
-                    Path("/tmp/tmpdir/00000000000000000000000000000002"),
                     "--realise",
                 ],
                 remote=build_host,
                 stdout=PIPE,
             ),
-            call(
-                ["readlink", "-f", "/tmp/tmpdir/config"],
-                remote=build_host,
-                stdout=PIPE,
-            ),
-            call(["rm", "-rf", Path("/tmp/tmpdir")], remote=build_host, check=False),
         ]
     )
 
@@ -228,6 +214,87 @@ def test_build_remote_flake(
     )
 
 
+@patch(get_qualified_name(n.run_wrapper, n), autospec=True)
+def test_build_remote_flake_eval_cache(
+    mock_run: Mock, monkeypatch: MonkeyPatch, tmp_path: Path
+) -> None:
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    flake = m.Flake("/flake", "nixosConfigurations.hostname")
+    build_host = m.Remote("user@host", [], None)
+    drv = tmp_path / "config.drv"
+    drv.touch()
+    metadata = {"locked": {"narHash": "sha256-foo"}, "locks": {}}
+
+    def run_side_effect(args: list[str], **kwargs: Any) -> CompletedProcess[str]:
+        if "metadata" in args:
+            return CompletedProcess([], 0, json.dumps(metadata))
+        return CompletedProcess([], 0, str(drv))
+
+    mock_run.side_effect = run_side_effect
+
+    def build() -> Path:
+        return n.build_remote_flake(
+            "config.system.build.toplevel",
+            flake,
+            build_host,
+            use_eval_cache=True,
+        )
+
+    assert build() == drv
+    commands = [c.args[0][:4] for c in mock_run.call_args_list]
+    assert ["nix", *n.FLAKE_FLAGS, "eval"] in commands
+    assert ["nix-copy-closure", "--to", "user@host", drv] in commands
+
+    # Unchanged flake: no evaluation and no copy, only a validity check
+    mock_run.reset_mock()
+    assert build() == drv
+    commands = [c.args[0][:4] for c in mock_run.call_args_list]
+    assert ["nix", *n.FLAKE_FLAGS, "flake"] in commands
+    assert ["nix-store", "--check-validity", drv] in commands
+    assert not any("eval" in c.args[0] for c in mock_run.call_args_list)
+    assert not any("nix-copy-closure" in c.args[0] for c in mock_run.call_args_list)
+
+    # Changed flake: evaluate again
+    metadata["locked"]["narHash"] = "sha256-bar"
+    mock_run.reset_mock()
+    assert build() == drv
+    assert any("eval" in c.args[0] for c in mock_run.call_args_list)
+
+    # Only the most recently used evaluations are kept
+    monkeypatch.setattr(n, "EVAL_CACHE_SIZE", 2)
+    metadata["locked"]["narHash"] = "sha256-foo"
+    build()
+    metadata["locked"]["narHash"] = "sha256-baz"
+    build()
+    assert len(n.read_cache(n.EVAL_CACHE)) == 2
+    mock_run.reset_mock()
+    metadata["locked"]["narHash"] = "sha256-bar"
+    build()
+    assert any("eval" in c.args[0] for c in mock_run.call_args_list)
+
+
+@patch(
+    get_qualified_name(n.run_wrapper, n),
+    autospec=True,
+    return_value=CompletedProcess([], 0, stdout='{"locked": {"type": "path"}}'),
+)
+def test_get_flake_eval_cache_key(mock_run: Mock) -> None:
+    flake = m.Flake("/flake", "nixosConfigurations.hostname")
+    assert n.get_flake_eval_cache_key("attr", flake, {"impure": True}) is None
+    mock_run.assert_not_called()
+
+    # Not locked to a content hash
+    assert n.get_flake_eval_cache_key("attr", flake) is None
+
+    mock_run.return_value = CompletedProcess(
+        [], 0, stdout='{"locked": {"narHash": "sha256-foo"}}'
+    )
+    key = n.get_flake_eval_cache_key("attr", flake)
+    assert key is not None
+    assert key != n.get_flake_eval_cache_key("other", flake)
+    assert key != n.get_flake_eval_cache_key("attr", flake, {"option": "foo"})
+
+
 def test_copy_closure(monkeypatch: MonkeyPatch) -> None:
     closure = Path("/path/to/closure")
     with patch(get_qualified_name(n.run_wrapper, n), autospec=True) as mock_run:
@@ -291,6 +358,158 @@ def test_copy_closure(monkeypatch: MonkeyPatch) -> None:
         )
 
 
+def test_get_drv_outputs(tmp_path: Path) -> None:
+    system_drv = tmp_path / "system.drv"
+    system_drv.write_text(
+        'Derive([("out","/nix/store/system","","")],'
+        '[("/nix/store/src.drv",["out"])],[],"x86_64-linux","builder",[],[])'
+    )
+    multi_drv = tmp_path / "multi.drv"
+    multi_drv.write_text(
+        'Derive([("dev","/nix/store/multi-dev","",""),'
+        '("out","/nix/store/multi","","")],[],[],"x86_64-linux","builder",[],[])'
+    )
+    src_drv = tmp_path / "src.drv"
+    src_drv.write_text(
+        'Derive([("out","/nix/store/src","sha256","abc")],'
+        '[],[],"x86_64-linux","builtin:fetchurl",[],[])'
+    )
+    with patch(
+        get_qualified_name(n.run_wrapper, n),
+        autospec=True,
+        return_value=CompletedProcess(
+            [], 0, stdout=f"{src_drv}\n/nix/store/source\n{multi_drv}\n{system_drv}\n"
+        ),
+    ) as mock_run:
+        assert n.get_drv_outputs(system_drv) == [
+            Path("/nix/store/multi-dev"),
+            Path("/nix/store/multi"),
+            Path("/nix/store/system"),
+        ]
+        mock_run.assert_called_with(
+            ["nix-store", "--query", "--requisites", system_drv], stdout=PIPE
+        )
+
+
+def test_get_package_name() -> None:
+    assert n.get_package_name(Path("/nix/store/abc-firefox-128.0-man")) == "firefox-man"
+    assert n.get_package_name(Path("/nix/store/abc-python3.12-foo-1.0")) == (
+        "python3.12-foo"
+    )
+    assert n.get_package_name(Path("/nix/store/abc-etc")) == "etc"
+
+
+@patch(get_qualified_name(n.run_wrapper, n), autospec=True)
+def test_get_invalid_paths(mock_run: Mock, monkeypatch: MonkeyPatch) -> None:
+    monkeypatch.setattr(n, "CHECK_VALIDITY_BATCH_SIZE", 2)
+    build_host = m.Remote("user@build.host", [], None)
+    paths = [Path(f"/nix/store/{i}") for i in range(3)]
+    mock_run.side_effect = [
+        CompletedProcess([], 0, stdout="/nix/store/1\n"),
+        CompletedProcess([], 0, stdout="/nix/store/2\n"),
+    ]
+
+    assert n.get_invalid_paths(paths, build_host) == {
+        Path("/nix/store/1"),
+        Path("/nix/store/2"),
+    }
+    assert mock_run.call_args_list == [
+        call(
+            ["nix-store", "--check-validity", "--print-invalid", *paths[:2]],
+            remote=build_host,
+            stdout=PIPE,
+        ),
+        call(
+            ["nix-store", "--check-validity", "--print-invalid", paths[2]],
+            remote=build_host,
+            stdout=PIPE,
+        ),
+    ]
+
+
+@patch(get_qualified_name(n.copy_closure, n), autospec=True)
+@patch(get_qualified_name(n.get_drv_outputs, n), autospec=True)
+@patch(get_qualified_name(n.run_wrapper, n), autospec=True)
+def test_stream_outputs(
+    mock_run: Mock,
+    mock_get_drv_outputs: Mock,
+    mock_copy_closure: Mock,
+    monkeypatch: MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(n, "PIPELINE_COPY_INTERVAL", 0)
+    build_host = m.Remote("user@build.host", [], None)
+    target_host = m.Remote("user@target.host", [], None)
+    drv = Path("/nix/store/system.drv")
+    mock_get_drv_outputs.return_value = [
+        Path("/nix/store/a-foo-2.0"),
+        Path("/nix/store/b-bar"),
+        # Not in the current system, e.g. a compiler
+        Path("/nix/store/c-gcc-13.2.0"),
+    ]
+    mock_run.side_effect = [
+        CompletedProcess([], 0, stdout="/nix/store/x-foo-1.0\n/nix/store/y-bar\n"),
+        CompletedProcess([], 0, stdout="/nix/store/a-foo-2.0\n/nix/store/b-bar\n"),
+        CompletedProcess([], 0, stdout="/nix/store/b-bar\n"),
+        CompletedProcess([], 0, stdout=""),
+    ]
+
+    with n.stream_outputs(drv, build_host, target_host, {"copy_flag": True}):
+        # Wait until everything was copied
+        while mock_run.call_count < 4:
+            pass
+
+    assert mock_run.call_args_list[0] == call(
+        ["nix-store", "--query", "--requisites", "/run/current-system"],
+        remote=target_host,
+        stdout=PIPE,
+        check=False,
+    )
+    mock_run.assert_called_with(
+        ["nix-store", "--check-validity", "--print-invalid", Path("/nix/store/b-bar")],
+        remote=build_host,
+        stdout=PIPE,
+    )
+    assert mock_copy_closure.call_args_list == [
+        call(
+            [Path("/nix/store/a-foo-2.0")],
+            to_host=target_host,
+            from_host=build_host,
+            copy_flags={"copy_flag": True},
+        ),
+        call(
+            [Path("/nix/store/b-bar")],
+            to_host=target_host,
+            from_host=build_host,
+            copy_flags={"copy_flag": True},
+        ),
+    ]
+
+    # Stops on errors, the closure is copied after the build anyway
+    mock_run.reset_mock()
+    mock_copy_closure.reset_mock()
+    mock_run.side_effect = [
+        CompletedProcess([], 0, stdout="/nix/store/y-bar\n"),
+        CalledProcessError(1, "ssh"),
+    ]
+    with n.stream_outputs(drv, build_host, target_host):
+        while mock_run.call_count < 2:
+            pass
+    assert mock_run.call_count == 2
+    mock_copy_closure.assert_not_called()
+
+    # Disabled, or nothing to do since both hosts are the same
+    mock_get_drv_outputs.reset_mock()
+    with n.stream_outputs(drv, build_host, target_host, enabled=False):
+        pass
+    with n.stream_outputs(
+        drv, build_host, m.Remote("user@build.host", ["-v"], "password")
+    ):
+        pass
+    with n.stream_outputs(drv, None, None):
+        pass
+    mock_get_drv_outputs.assert_not_called()
+
+
 @patch(get_qualified_name(n.run_wrapper, n), autospec=True)
 def test_edit(mock_run: Mock, monkeypatch: MonkeyPatch, tmpdir: Path) -> None:
     # Flake
@@ -550,10 +769,13 @@ def test_get_generations_from_nix_env(tmp_path: Path) -> None:
         ),
     ],
 )
-def test_list_generations(mock_get_generations: Mock, tmp_path: Path) -> None:
+def test_list_generations(
+    mock_get_generations: Mock, monkeypatch: MonkeyPatch, tmp_path: Path
+) -> None:
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
     # Probably better to test this function in a real system, this test is
     # mostly to make sure it doesn't break horribly
-    assert n.list_generations(m.Profile("system", tmp_path)) == [
+    expected = [
         {
             "configurationRevision": "Unknown",
             "current": True,
@@ -573,6 +795,110 @@ def test_list_generations(mock_get_generations: Mock, tmp_path: Path) -> None:
             "specialisations": [],
         },
     ]
+    assert n.list_generations(m.Profile("system", tmp_path / "system")) == expected
+    assert json.loads((tmp_path / "cache/nixos-rebuild/generations.json").read_text())[
+        "localhost"
+    ] == {
+        str(tmp_path / f"system-{i}-link"): {
+            "configurationRevision": "Unknown",
+            "kernelVersion": "Unknown",
+            "nixosVersion": "Unknown",
+            "specialisations": [],
+        }
+        for i in (1, 2)
+    }
+
+    # Generations in the index are not inspected again
+    with patch(
+        get_qualified_name(n.get_generation_info, n), autospec=True
+    ) as mock_get_generation_info:
+        assert n.list_generations(m.Profile("system", tmp_path / "system")) == expected
+        mock_get_generation_info.assert_not_called()
+
+
+@patch(get_qualified_name(n.run_wrapper, n), autospec=True)
+def test_list_generations_remote(
+    mock_run: Mock, monkeypatch: MonkeyPatch, tmp_path: Path
+) -> None:
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    target_host = m.Remote("user@host", [], None)
+    profile = m.Profile("system", Path("/nix/var/nix/profiles/system"))
+    mock_run.return_value = CompletedProcess(
+        [],
+        0,
+        stdout=textwrap.dedent("""\
+        system-2-link
+        2\t/nix/store/system-2\t1730000000\t24.11\t6.6.1\trev2\tspec1 spec2
+        1\t/nix/store/system-1\t1720000000\t\t\t\t*
+        """),
+    )
+
+    generations = n.list_generations(profile, target_host)
+    assert generations == [
+        {
+            "configurationRevision": "rev2",
+            "current": True,
+            "date": ANY,
+            "generation": 2,
+            "kernelVersion": "6.6.1",
+            "nixosVersion": "24.11",
+            "specialisations": ["spec1", "spec2"],
+        },
+        {
+            "configurationRevision": "Unknown",
+            "current": False,
+            "date": ANY,
+            "generation": 1,
+            "kernelVersion": "Unknown",
+            "nixosVersion": "Unknown",
+            "specialisations": [],
+        },
+    ]
+    mock_run.assert_called_once_with(
+        ["sh", "-c", n.REMOTE_LIST_GENERATIONS_SCRIPT, "sh", profile.path],
+        remote=target_host,
+        stdout=PIPE,
+    )
+
+    # Known store paths are passed to the script, which then only prints the
+    # generation itself
+    mock_run.reset_mock()
+    mock_run.return_value = CompletedProcess(
+        [],
+        0,
+        stdout=textwrap.dedent("""\
+        system-3-link
+        2\t/nix/store/system-2\t1730000000
+        3\t/nix/store/system-2\t1740000000
+        """),
+    )
+    assert [
+        (g["generation"], g["current"], g["nixosVersion"])
+        for g in n.list_generations(profile, target_host)
+    ] == [(3, True, "24.11"), (2, False, "24.11")]
+    mock_run.assert_called_once_with(
+        [
+            "sh",
+            "-c",
+            n.REMOTE_LIST_GENERATIONS_SCRIPT,
+            "sh",
+            profile.path,
+            "/nix/store/system-2",
+            "/nix/store/system-1",
+        ],
+        remote=target_host,
+        stdout=PIPE,
+    )
+    # Generations that are gone are dropped from the index
+    assert list(
+        json.loads((tmp_path / "cache/nixos-rebuild/generations.json").read_text())[
+            "user@host"
+        ]
+    ) == ["/nix/store/system-2"]
+
+    mock_run.return_value = CompletedProcess([], 0, stdout="\n")
+    with pytest.raises(m.NRError):
+        n.list_generations(profile, target_host)
 
 
 @patch(get_qualified_name(n.run_wrapper, n), autospec=True)
@@ -748,6 +1074,35 @@ def test_switch_to_configuration(mock_run: Mock, monkeypatch: MonkeyPatch) -> No
         remote=target_host,
     )
 
+    # Setting the profile shares the remote shell, and uses the toplevel
+    # even with a specialisation
+    with monkeypatch.context() as mp:
+        mp.setattr(Path, Path.exists.__name__, lambda self: True)
+
+        n.switch_to_configuration(
+            config_path,
+            m.Action.SWITCH,
+            sudo=True,
+            target_host=target_host,
+            specialisation="special",
+            profile=m.Profile("system", profile_path),
+        )
+    mock_run.assert_called_with(
+        [
+            "sh",
+            "-c",
+            n.REMOTE_SWITCH_SCRIPT,
+            "sh",
+            profile_path,
+            config_path,
+            config_path / "specialisation/special/bin/switch-to-configuration",
+            "switch",
+        ],
+        extra_env={"NIXOS_INSTALL_BOOTLOADER": "0"},
+        sudo=True,
+        remote=target_host,
+    )
+
 
 @patch(
     get_qualified_name(n.Path.glob, n),
@@ -113,3 +113,86 @@ def test_remote_from_name(monkeypatch: MonkeyPatch) -> None:
             opts=["-f", "foo", "-b", "bar", "-t"],
             sudo_password="password",
         )
+
+
+def test_get_ssh_option() -> None:
+    opts = [
+        "-p",
+        "22",
+        "-o",
+        "ControlPath=/a",
+        "-oControlPath /b",
+        "-ocontrolmaster=no",
+    ]
+    assert p.get_ssh_option(opts, "ControlPath") == "/a"
+    assert p.get_ssh_option(opts, "ControlMaster") == "no"
+    assert p.get_ssh_option(opts, "ControlPersist") is None
+
+
+@patch(get_qualified_name(p.subprocess.run), autospec=True)
+def test_ensure_ssh_master(mock_run: Any, monkeypatch: MonkeyPatch) -> None:
+    monkeypatch.setattr(p, "SSH_MASTERS", [])
+    remote = m.Remote("user@localhost", ["--ssh", "opt"], None)
+
+    mock_run.return_value = p.subprocess.CompletedProcess([], 0)
+    p.ensure_ssh_master(remote)
+    mock_run.assert_called_once_with(
+        ["ssh", "--ssh", "opt", *p.SSH_DEFAULT_OPTS, "-O", "check", "user@localhost"],
+        check=False,
+        capture_output=True,
+    )
+    assert p.SSH_MASTERS == []
+
+    mock_run.reset_mock()
+    mock_run.side_effect = [
+        p.subprocess.CompletedProcess([], 255),
+        p.subprocess.CompletedProcess([], 0),
+    ]
+    p.ensure_ssh_master(remote)
+    mock_run.assert_called_with(
+        [
+            "ssh",
+            "--ssh",
+            "opt",
+            *p.SSH_MASTER_OPTS,
+            *p.SSH_DEFAULT_OPTS,
+            "-f",
+            "-N",
+            "user@localhost",
+        ],
+        check=False,
+        stdin=p.subprocess.DEVNULL,
+    )
+    assert p.SSH_MASTERS == [remote]
+
+    # Connection sharing disabled by the user
+    mock_run.reset_mock()
+    p.ensure_ssh_master(m.Remote("user@localhost", ["-o", "ControlMaster=no"], None))
+    p.ensure_ssh_master(m.Remote("user@localhost", ["-oControlPath=none"], None))
+    mock_run.assert_not_called()
+
+
+@patch(get_qualified_name(p.subprocess.run), autospec=True)
+def test_cleanup_ssh(mock_run: Any, monkeypatch: MonkeyPatch) -> None:
+    # The master is closed through the user's ControlPath
+    remote = m.Remote("user@localhost", ["-o", "ControlPath=/ctl/%C"], None)
+    monkeypatch.setattr(p, "SSH_MASTERS", [remote])
+    p.cleanup_ssh()
+    mock_run.assert_any_call(
+        [
+            "ssh",
+            "-o",
+            "ControlPath=/ctl/%C",
+            *p.SSH_DEFAULT_OPTS,
+            "-O",
+            "exit",
+            "user@localhost",
+        ],
+        check=False,
+        env=None,
+        input=None,
+        text=True,
+        errors="surrogateescape",
+        capture_output=True,
+    )
+    assert p.SSH_MASTERS == []